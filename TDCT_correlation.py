@@ -36,7 +36,7 @@ import tifffile as tf
 import qimage2ndarray
 ## Colored stdout, custom Qt functions (mostly to handle events), CSV handler
 ## and correlation algorithm
-from tdct import clrmsg, TDCT_debug, QtCustom, csvHandler, correlation
+from tdct import clrmsg, TDCT_debug, QtCustom, csvHandler, correlation, tiffMeta, stackProcessing
 from tools3dct.find_beads import find_beads_GUI
 from tools3dct.predict_FIB import predict_FIB_GUI
 
@@ -1024,57 +1024,21 @@ class MainWidget(QtWidgets.QMainWindow, Ui_WidgetWindow):
             return None, None, None
 
     def pxSize(self,img_path,z=False):
-        with tf.TiffFile(img_path) as tif:
-            try:
-                pixelSize = float(tif.pages[0].tags['FEI_HELIOSs'].value['Scan']['PixelWidth'])
-                if debug is True: print(clrmsg.DEBUG + "Pixel size found. FEI_HELIOS standard.")
-                return pixelSize*1E6  # from meters to microns
-            except KeyError:
-                if debug is True: print(clrmsg.DEBUG + "Pixel size not found.")
-                return np.nan  # so imageProps is passed to correlation.main()
-        # Old pixel size parser
-        # with tf.TiffFile(img_path) as tif:
-        #     for page in tif.pages:
-        #         for tag in list(page.tags.values()):
-        #             if isinstance(tag.value, str):
-        #                 for keyword in ['PhysicalSizeX','PixelWidth','PixelSize'] if not z else ['PhysicalSizeZ','FocusStepSize']:
-        #                     tagposs = [m.start() for m in re.finditer(keyword, tag.value)]
-        #                     for tagpos in tagposs:
-        #                         if keyword == 'PhysicalSizeX' or keyword == 'PhysicalSizeZ':
-        #                             for piece in tag.value[tagpos:tagpos+30].split('"'):
-        #                                 try:
-        #                                     pixelSize = float(piece)
-        #                                     if debug is True: print(clrmsg.DEBUG + "Pixel size from exif metakey:", keyword)
-        #                                     ## Value is in um from CorrSight/LA tiff files
-        #                                     if z:
-        #                                         pixelSize = pixelSize*1000
-        #                                     return pixelSize
-        #                                 except Exception as e:
-        #                                     if debug is True: print(clrmsg.DEBUG + "Pixel size parser:", e)
-        #                                     pass
-        #                         elif keyword == 'PixelWidth':
-        #                             for piece in tag.value[tagpos:tagpos+30].split('='):
-        #                                 try:
-        #                                     try:
-        #                                         pixelSize = float(piece.strip().split('\r\n')[0])
-        #                                     except:
-        #                                         pixelSize = float(piece.strip().split(r'\r\n')[0])
-        #                                     if debug is True: print(clrmsg.DEBUG + "Pixel size from exif metakey:", keyword)
-        #                                     ## *1E6 because these values from SEM/FIB image is in m
-        #                                     return pixelSize*1E6
-        #                                 except Exception as e:
-        #                                     if debug is True: print(clrmsg.DEBUG + "Pixel size parser:", e)
-        #                                     pass
-        #                         elif keyword == 'PixelSize' or 'FocusStepSize':
-        #                             for piece in tag.value[tagpos:tagpos+30].split('"'):
-        #                                 try:
-        #                                     pixelSize = float(piece)
-        #                                     if debug is True: print(clrmsg.DEBUG + "Pixel size from exif metakey:", keyword)
-        #                                     ## Value is in um from CorrSight/LA tiff files
-        #                                     return pixelSize
-        #                                 except Exception as e:
-        #                                     if debug is True: print(clrmsg.DEBUG + "Pixel size parser:", e)
-        #                                     pass
+        """Pixel size in um (xy) or nm (z) from the cached tiff header index, np.nan if not found"""
+        meta = tiffMeta.read(img_path)
+        pixelSize, key = (meta.pixelsizeZ, meta.pixelsizeZKey) if z else (meta.pixelsize, meta.pixelsizeKey)
+        if pixelSize is None:
+            if debug is True: print(clrmsg.DEBUG + "Pixel size not found.")
+            return np.nan  # so imageProps is passed to correlation.main()
+        if debug is True: print(clrmsg.DEBUG + "Pixel size from exif metakey:", key)
+        if key in ['FEI_HELIOS', 'PixelWidth']:
+            ## *1E6 because these values from SEM/FIB image is in m
+            return pixelSize*1E6
+        elif key in ['PhysicalSizeZ', 'FocusStepSize']:
+            ## Value is in um from CorrSight/LA and 3DCT resliced tiff files
+            return pixelSize*1000
+        else:
+            return pixelSize
 
     ## Convert opencv image (numpy array in BGR) to RGB QImage and return pixmap. Only takes 2D images
     def cv2Qimage(self,img,combobox=None):
@@ -1148,33 +1112,7 @@ class MainWidget(QtWidgets.QMainWindow, Ui_WidgetWindow):
     ## Normalize Image
     def norm_img(self,img,copy=False):
         if debug is True: print(clrmsg.DEBUG + "===== norm_img")
-        if copy is True:
-            img = np.copy(img)
-        dtype = str(img.dtype)
-        ## Determine data type
-        if dtype == "uint16" or dtype == "int16":
-            typesize = 65535
-        elif dtype == "uint8" or dtype == "int8":
-            typesize = 255
-        elif dtype == "float32" or dtype == "float64":
-            typesize = 1
-        else:
-            print(clrmsg.ERROR + "Sorry, I don't know this file type yet: ", dtype)
-        ## 2D image
-        if img.ndim == 2:
-            img = np.multiply(img, typesize/img.max(), out=img, casting="unsafe")
-        ## 3D or multichannel image
-        elif img.ndim == 3:
-            ## tifffile reads z,y,x for stacks but y,x,c if it is multichannel image (or z,c,y,x if it is a multicolor image stack)
-            if img.shape[-1] > 4:
-                if debug is True: print(clrmsg.DEBUG + "image stack")
-                for i in range(int(img.shape[0])):
-                    img[i,:,:] = np.multiply(img[i,:,:], typesize/img[i,:,:].max(), out=img[i,:,:], casting="unsafe")
-            else:
-                if debug is True: print(clrmsg.DEBUG + "multichannel image")
-                for i in range(int(img.shape[2])):
-                    img[:,:,i] = np.multiply(img[:,:,i], typesize/img[:,:,i].max(), out=img[:,:,i], casting="unsafe")
-        return img
+        return stackProcessing.norm_img(img, copy=copy)
 
     def selectSlice(self):
         if self.label_selimg.text() == 'left':
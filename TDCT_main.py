@@ -168,13 +168,32 @@ class APP(QtWidgets.QMainWindow, Ui_MainWindow):
 
         ## Deconvolution tab
         ### Select buttons
-        self.toolButton_DeconvRLDataSelect.clicked.connect(lambda: self.selectFile(self.lineEdit_DeconvRL_DataImPath))
+        ### Several data files (separated by ';') can be deconvolved with the same psf
+        self.lineEdit_DeconvRL_DataImPath.multipleFiles = True
+        self.toolButton_DeconvRLDataSelect.clicked.connect(lambda: self.selectFile(self.lineEdit_DeconvRL_DataImPath, multiple=True))
         self.toolButton_DeconvRLPSFDataSelect.clicked.connect(lambda: self.selectFile(self.lineEdit_DeconvRL_PSFImPath))
         ### Line edits change update (colors change to inform whether the file is valid)
         self.lineEdit_DeconvRL_DataImPath.textChanged.connect(lambda: self.isValidFile(self.lineEdit_DeconvRL_DataImPath))
         self.lineEdit_DeconvRL_PSFImPath.textChanged.connect(lambda: self.isValidFile(self.lineEdit_DeconvRL_PSFImPath))
+        ### Threads for the FFTs per process, defaults to all cores in one process
+        self.spinBox_DeconvRL_workers.setMaximum(deconvolution.workerCount(-1))
+        self.spinBox_DeconvRL_workers.setValue(deconvolution.workerCount(-1))
+        ### Processes: files deconvolved at the same time, or tiles at the same time for tiled runs
+        self.spinBox_DeconvRL_processes.setMaximum(deconvolution.workerCount(-1))
         ###Command button
         self.commandLinkButton_Deconvolve.clicked.connect(self.runDeconvolutionTool)
+        ### Deconvolutions run in background processes, every click on Deconvolve queues the selected files
+        self.deconvolutionQueue = deconvolution.DeconvolutionQueue(parent=self)
+        self.deconvolutionQueue.progress.connect(self.progressBar_DeconvRL.setValue)
+        self.deconvolutionQueue.change.connect(self.showDeconvolutionChange)
+        self.deconvolutionQueue.fileFinished.connect(
+            lambda datapath, fname: print(clrmsg.INFO + "Deconvolution saved: " + fname))
+        self.deconvolutionQueue.fileFailed.connect(
+            lambda datapath, errmsg: print(clrmsg.WARNING + "Deconvolution of " + datapath + ": " + errmsg))
+        self.deconvolutionQueue.finished.connect(lambda: self.pushButton_DeconvRLCancel.setEnabled(False))
+        self.deconvolutionQueue.finished.connect(lambda: self.setDeconvolutionTiled(self.checkBox_DeconvRL_tiled.isChecked()))
+        self.pushButton_DeconvRLCancel.clicked.connect(self.deconvolutionQueue.cancel)
+        self.checkBox_DeconvRL_tiled.toggled.connect(self.setDeconvolutionTiled)
 
 
     def createMask(self):
@@ -190,13 +209,14 @@ class APP(QtWidgets.QMainWindow, Ui_MainWindow):
         #Set default unless conditions are met
         lineEdit.fileIsValid = False
         lineEdit.fileIsTiff = False
-        if lineEdit.text() == "":
+        paths = self.filePaths(lineEdit)
+        if not paths:
             lineEdit.setStyleSheet(
                 "QLineEdit{background-color: white;} QLineEdit:hover{border: 1px solid grey; background-color white;}")
-        elif os.path.isfile(lineEdit.text()):
+        elif all(os.path.isfile(path) for path in paths):
             lineEdit.fileIsValid = True
             #Check if file has tif or tiff extension, makes green if true, otherwise orange
-            if os.path.splitext(str(lineEdit.text()))[1] in ['.tif','.tiff']:
+            if all(os.path.splitext(path)[1] in ['.tif','.tiff'] for path in paths):
                 lineEdit.setStyleSheet(
                     "QLineEdit{background-color: rgba(0,255,0,80);}\
                     QLineEdit:hover{border: 1px solid grey; background-color rgba(0,255,0,80);}")
@@ -354,6 +374,9 @@ class APP(QtWidgets.QMainWindow, Ui_MainWindow):
         quit_msg = "Are you sure you want to exit the\n3D Correlation Toolbox?\n\nUnsaved data will be lost!"
         reply = QtWidgets.QMessageBox.question(self, 'Message', quit_msg, QtWidgets.QMessageBox.Yes, QtWidgets.QMessageBox.No)
         if reply == QtWidgets.QMessageBox.Yes:
+            ## stop queued/running deconvolutions
+            self.deconvolutionQueue.cancel()
+            self.deconvolutionQueue.wait()
             ## if loaded, close correlationModul
             if hasattr(self, "correlationModul"):
                 if hasattr(self.correlationModul, "window"):
@@ -386,15 +409,31 @@ class APP(QtWidgets.QMainWindow, Ui_MainWindow):
             else:
                 pathLine.setText(path)
 
-    def selectFile(self, pathLine):
+    def selectFile(self, pathLine, multiple=False):
         """
         File selection. File path is displayed in corresponding QLineEdit GUI element.
-        """
+        With multiple=True several files can be selected, they are displayed separated by ';'.
+        """
+        if multiple is True:
+            paths = QtWidgets.QFileDialog.getOpenFileNames(
+                None,"Select tiff image files", self.workingdir,"Image Files (*.tif *.tiff);; All (*.*)")[0]
+            if paths:
+                pathLine.setText('; '.join(os.path.normpath(str(path)) for path in paths))
+            return
         path = os.path.normpath(str(QtWidgets.QFileDialog.getOpenFileName(
             None,"Select tiff image file", self.workingdir,"Image Files (*.tif *.tiff);; All (*.*)")[0]))
         if path:
             pathLine.setText(path)
 
+    def filePaths(self, lineEdit):
+        """
+        File paths of the QLineEdit, split at ';' if the line edit accepts multiple files (lineEdit.multipleFiles).
+        """
+        text = str(lineEdit.text())
+        if getattr(lineEdit, 'multipleFiles', False) is True:
+            return [path.strip() for path in text.split(';') if path.strip()]
+        return [text] if text else []
+
     def getPixelSize(self):
         """
         Extract pixel size. Pixel size can be extracted from FEI CorrSight and Dual Beam Electron Microscope tiff images.
@@ -624,7 +663,7 @@ class APP(QtWidgets.QMainWindow, Ui_MainWindow):
             if debug is True: print(clrmsg.DEBUG, 'In/out:', img_path, customSaveDir)
             self.progressBar_Normalize.setMaximum(100)
             QtWidgets.QApplication.processEvents()
-            stackProcessing.normalize(img_path, qtprocessbar=self.progressBar_Normalize, flip=self.checkBox_NormalizeFlip.isChecked(), customSaveDir=customSaveDir)
+            stackProcessing.normalizeFiles([img_path], qtprocessbar=self.progressBar_Normalize, flip=self.checkBox_NormalizeFlip.isChecked(), customSaveDir=customSaveDir)
             self.progressBar_Normalize.reset()
             self.progressBar_Normalize.setVisible(False)
         else:
@@ -643,8 +682,8 @@ class APP(QtWidgets.QMainWindow, Ui_MainWindow):
             if debug is True: print(clrmsg.DEBUG, 'In/out/normalize:', img_path, customSaveDir, self.checkBox_MipNormalize.isChecked())
             self.progressBar_Mip.setMaximum(100)
             QtWidgets.QApplication.processEvents()
-            stackProcessing.mip(
-                img_path, qtprocessbar=self.progressBar_Mip,
+            stackProcessing.mipFiles(
+                [img_path], qtprocessbar=self.progressBar_Mip,
                 customSaveDir=customSaveDir, flip=self.checkBox_MipFlip.isChecked(), normalize=self.checkBox_MipNormalize.isChecked())
             self.progressBar_Mip.reset()
             self.progressBar_Mip.setVisible(False)
@@ -666,11 +705,49 @@ class APP(QtWidgets.QMainWindow, Ui_MainWindow):
             #deconvolution.doRLDeconvolution3(self.lineEdit_DeconvRL_DataImPath.text() , \
             #deconvolution.doRLDeconvolution4(self.lineEdit_DeconvRL_DataImPath.text() , \
             #deconvolution.doRLDeconvolution5(self.lineEdit_DeconvRL_DataImPath.text() , \
-            deconvolution.doRLDeconvolution7(self.lineEdit_DeconvRL_DataImPath.text() , \
-                self.lineEdit_DeconvRL_PSFImPath.text(),\
-                self.spinBox_DeconvRL_iterations.value(),
-                self.progressBar_DeconvRL)
-            
+            #All selected data files are deconvolved with the same psf
+            datapaths = self.filePaths(self.lineEdit_DeconvRL_DataImPath)
+            if self.checkBox_DeconvRL_tiled.isChecked():
+                #Block-wise for large volumes, one tile per process, queued in the background one file after the other
+                self.progressBar_DeconvRL.setFormat(
+                    "%p%  (tiled, all {0} iterations run)".format(self.spinBox_DeconvRL_iterations.value()))
+                for datapath in datapaths:
+                    self.deconvolutionQueue.add(datapath , \
+                        self.lineEdit_DeconvRL_PSFImPath.text(),\
+                        self.spinBox_DeconvRL_iterations.value(),
+                        tiled=True,
+                        processes=self.spinBox_DeconvRL_processes.value(),
+                        workers=self.spinBox_DeconvRL_workers.value(),
+                        accelerate=self.checkBox_DeconvRL_accelerate.isChecked(),
+                        tv=self.doubleSpinBox_DeconvRL_tv.value(),
+                        outputdtype=self.comboBox_DeconvRL_output.currentText())
+            else:
+                #Queued, the selected number of files in parallel with the selected number of threads each
+                self.deconvolutionQueue.processes = self.spinBox_DeconvRL_processes.value()
+                for datapath in datapaths:
+                    self.deconvolutionQueue.add(datapath , \
+                        self.lineEdit_DeconvRL_PSFImPath.text(),\
+                        self.spinBox_DeconvRL_iterations.value(),
+                        workers=self.spinBox_DeconvRL_workers.value(),
+                        accelerate=self.checkBox_DeconvRL_accelerate.isChecked(),
+                        tv=self.doubleSpinBox_DeconvRL_tv.value(),
+                        #0 = no early stopping, run all iterations
+                        tol=self.doubleSpinBox_DeconvRL_tol.value() or None,
+                        outputdtype=self.comboBox_DeconvRL_output.currentText())
+            self.pushButton_DeconvRLCancel.setEnabled(True)
+
+    def setDeconvolutionTiled(self, tiled):
+        #Tiled runs cannot stop early (all tiles need the same number of iterations), "Stop at change" does not apply
+        self.label_41.setEnabled(not tiled)
+        self.doubleSpinBox_DeconvRL_tol.setEnabled(not tiled)
+        if self.deconvolutionQueue.pending() == 0:
+            self.progressBar_DeconvRL.setFormat("%p%  (tiled, all iterations run)" if tiled else "%p%")
+
+    def showDeconvolutionChange(self, datapath, iteration, change):
+        #Relative change of the estimate in the last reported iteration, compare with the "Stop at change" value
+        self.progressBar_DeconvRL.setFormat("%p%  (it. {0}, change {1:.2g})".format(iteration, change))
+        if debug is True: print(clrmsg.DEBUG, "Deconvolution of", datapath, "iteration", iteration, "change", change)
+
 
 class MovieSplashScreen(QtWidgets.QSplashScreen):
 
@@ -152,7 +152,23 @@ class QTableViewCustom(QtWidgets.QTableView):
     ## Context menu
     def contextMenuEvent(self, event):
         indices = self.selectedIndexes()
-        if indices:
+        ## Bead detection does not need selected rows
+        cmDetectL1 = QtWidgets.QAction('Detect beads layer 1', self)
+        cmDetectL1.triggered.connect(lambda: self.detectBeads(self.img1))
+        cmDetectL2 = QtWidgets.QAction('Detect beads layer 2', self)
+        cmDetectL2.triggered.connect(lambda: self.detectBeads(self.img2))
+        cmDetectL3 = QtWidgets.QAction('Detect beads layer 3', self)
+        cmDetectL3.triggered.connect(lambda: self.detectBeads(self.img3))
+        cmDetectL1.setEnabled(self.img1 is not None)
+        cmDetectL2.setEnabled(self.img2 is not None)
+        cmDetectL3.setEnabled(self.img3 is not None)
+        if not indices and self.img1 is not None:
+            self.contextMenu = QtWidgets.QMenu(self)
+            self.contextMenu.addAction(cmDetectL1)
+            self.contextMenu.addAction(cmDetectL2)
+            self.contextMenu.addAction(cmDetectL3)
+            self.contextMenu.popup(QtGui.QCursor.pos())
+        elif indices:
             cmDelete = QtWidgets.QAction('Delete', self)
             cmDelete.triggered.connect(self.deleteItem)
 
@@ -161,16 +177,28 @@ class QTableViewCustom(QtWidgets.QTableView):
             cmGetZgaussL1.triggered.connect(lambda: self.getz(self.img1, gauss=True))
             cmGetZgaussOptL1 = QtWidgets.QAction('Get x,y,z gauss layer 1', self)
             cmGetZgaussOptL1.triggered.connect(lambda: self.getz(self.img1, gauss=True,optimize=True))
+            cmGetZgauss3DL1 = QtWidgets.QAction('Get x,y,z 3D gauss layer 1', self)
+            cmGetZgauss3DL1.triggered.connect(lambda: self.getz(self.img1, gauss=True,optimize=True,method='gauss3D'))
+            cmGetZradialL1 = QtWidgets.QAction('Get x,y,z radial symmetry layer 1', self)
+            cmGetZradialL1.triggered.connect(lambda: self.getz(self.img1, gauss=True,optimize=True,method='radial'))
             # Layer 2
             cmGetZgaussL2 = QtWidgets.QAction('Get z gauss layer 2', self)
             cmGetZgaussL2.triggered.connect(lambda: self.getz(self.img2, gauss=True))
             cmGetZgaussOptL2 = QtWidgets.QAction('Get x,y,z gauss layer 2', self)
             cmGetZgaussOptL2.triggered.connect(lambda: self.getz(self.img2, gauss=True,optimize=True))
+            cmGetZgauss3DL2 = QtWidgets.QAction('Get x,y,z 3D gauss layer 2', self)
+            cmGetZgauss3DL2.triggered.connect(lambda: self.getz(self.img2, gauss=True,optimize=True,method='gauss3D'))
+            cmGetZradialL2 = QtWidgets.QAction('Get x,y,z radial symmetry layer 2', self)
+            cmGetZradialL2.triggered.connect(lambda: self.getz(self.img2, gauss=True,optimize=True,method='radial'))
             # Layer 3
             cmGetZgaussL3 = QtWidgets.QAction('Get z gauss layer 3', self)
             cmGetZgaussL3.triggered.connect(lambda: self.getz(self.img3, gauss=True))
             cmGetZgaussOptL3 = QtWidgets.QAction('Get x,y,z gauss layer 3', self)
             cmGetZgaussOptL3.triggered.connect(lambda: self.getz(self.img3, gauss=True,optimize=True))
+            cmGetZgauss3DL3 = QtWidgets.QAction('Get x,y,z 3D gauss layer 3', self)
+            cmGetZgauss3DL3.triggered.connect(lambda: self.getz(self.img3, gauss=True,optimize=True,method='gauss3D'))
+            cmGetZradialL3 = QtWidgets.QAction('Get x,y,z radial symmetry layer 3', self)
+            cmGetZradialL3.triggered.connect(lambda: self.getz(self.img3, gauss=True,optimize=True,method='radial'))
 
             # broken and not used atm
             # cmGetZpoly = QtWidgets.QAction('Get z poly (deprecated)', self)
@@ -180,12 +208,18 @@ class QTableViewCustom(QtWidgets.QTableView):
             if self.img1 is None:
                 cmGetZgaussL1.setEnabled(False)
                 cmGetZgaussOptL1.setEnabled(False)
+                cmGetZgauss3DL1.setEnabled(False)
+                cmGetZradialL1.setEnabled(False)
             if self.img2 is None:
                 cmGetZgaussL2.setEnabled(False)
                 cmGetZgaussOptL2.setEnabled(False)
+                cmGetZgauss3DL2.setEnabled(False)
+                cmGetZradialL2.setEnabled(False)
             if self.img3 is None:
                 cmGetZgaussL3.setEnabled(False)
                 cmGetZgaussOptL3.setEnabled(False)
+                cmGetZgauss3DL3.setEnabled(False)
+                cmGetZradialL3.setEnabled(False)
                 # cmGetZpoly.setEnabled(False)  # broken atm
                 # cmGetZpolyOpt.setEnabled(False)  # broken atm
             self.contextMenu = QtWidgets.QMenu(self)
@@ -198,15 +232,27 @@ class QTableViewCustom(QtWidgets.QTableView):
             self.contextMenu.addAction(cmGetZgaussOptL1)
             self.contextMenu.addAction(cmGetZgaussOptL2)
             self.contextMenu.addAction(cmGetZgaussOptL3)
+            self.contextMenu.addSeparator()
+            self.contextMenu.addAction(cmGetZgauss3DL1)
+            self.contextMenu.addAction(cmGetZgauss3DL2)
+            self.contextMenu.addAction(cmGetZgauss3DL3)
+            self.contextMenu.addSeparator()
+            self.contextMenu.addAction(cmGetZradialL1)
+            self.contextMenu.addAction(cmGetZradialL2)
+            self.contextMenu.addAction(cmGetZradialL3)
+            self.contextMenu.addSeparator()
+            self.contextMenu.addAction(cmDetectL1)
+            self.contextMenu.addAction(cmDetectL2)
+            self.contextMenu.addAction(cmDetectL3)
             # self.contextMenu.addAction(cmGetZpoly)  # broken atm
             # self.contextMenu.addAction(cmGetZpolyOpt)  # broken atm
             self.contextMenu.popup(QtGui.QCursor.pos())
 
-    def getz(self,img,optimize=False,gauss=False):
+    def getz(self,img,optimize=False,gauss=False,method='gauss'):
         #Called when user right clicks on the table with beads coordinates
         #and selects either "Get z gauss layer ..." (optimize=False)
-        # or "Get x,y,z gauss layer" (optimize=True).
-        #In both these two cases gauss=True
+        # or "Get x,y,z gauss/3D gauss/radial symmetry layer" (optimize=True, method see beadPos.localize).
+        #In all these cases gauss=True
 
         #LMAP: I could not find any instances that this function is called with gauss=False.
         #Consider removing
@@ -220,8 +266,10 @@ class QTableViewCustom(QtWidgets.QTableView):
                 if isinstance(item, QtWidgets.QGraphicsEllipseItem):
                     activeitems.append(item)
             ## Filter selected rows
-            rows = set(index.row() for index in indices)
-            ## Delete selected rows in scene.
+            rows = sorted(set(index.row() for index in indices))
+            if gauss is True:
+                self.getzBatch(img, rows, activeitems, optimize, method)
+                return
             for row in rows:
                 if debug is True:
                     print(clrmsg.DEBUG + 'Row:', row, '|', \
@@ -230,39 +278,7 @@ class QTableViewCustom(QtWidgets.QTableView):
                         self._model.data(self._model.index(row, 2)))
                 x = float(self._model.data(self._model.index(row, 0)))
                 y = float(self._model.data(self._model.index(row, 1)))
-                if gauss is True:
-                    if optimize is False:
-                        # "Get z gauss..."
-                        zopt = beadPos.getzGauss(x,y,img,parent=self.mainParent)
-                        if debug is True: print(clrmsg.DEBUG + str(img.shape), zopt)
-                        if 0 <= zopt <= img.shape[-3]:
-                            self._scene.zValuesDict[activeitems[row]][1] = (0,0,0)
-                            self._model.itemFromIndex(self._model.index(row, 2)).setForeground(QtCore.Qt.black)
-                        else:
-                            self._scene.zValuesDict[activeitems[row]][1] = (255,0,0)
-                            self._model.itemFromIndex(self._model.index(row, 2)).setForeground(QtCore.Qt.red)
-                        self._model.itemFromIndex(self._model.index(row, 2)).setText(str(zopt))
-                    else:
-                        # "Get x,y,z gauss..."
-                        xopt,yopt,zopt = beadPos.getzGauss(
-                            x,y,img,parent=self.mainParent,optimize=True,threshold=True,
-                            threshVal=self.mainParent.doubleSpinBox_treshVal.value(),cutout=self._scene.markerSize)
-                        if debug is True: print(clrmsg.DEBUG + str(img.shape), xopt,yopt,zopt)
-                        if (
-                            abs(x - xopt) <= 2 * self._scene.markerSize and
-                            abs(y - yopt) <= 2 * self._scene.markerSize and
-                            0 <= zopt <= img.shape[-3]):
-                            self._scene.zValuesDict[activeitems[row]][1] = (255,0,0)
-                            self._model.itemFromIndex(self._model.index(row, 2)).setForeground(QtCore.Qt.black)
-                        else:
-                            self._scene.zValuesDict[activeitems[row]][1] = (0,0,0)
-                            self._model.itemFromIndex(self._model.index(row, 2)).setForeground(QtCore.Qt.red)
-                            xopt, yopt = x, y
-                        self._model.itemFromIndex(self._model.index(row, 0)).setText(str(xopt))
-                        self._model.itemFromIndex(self._model.index(row, 1)).setText(str(yopt))
-                        self._model.itemFromIndex(self._model.index(row, 2)).setText(str(zopt))
-
-                elif optimize is False: #Probably never runs because gauss is never False
+                if optimize is False: #Probably never runs because gauss is never False
                     zopt = beadPos.getzPoly(x,y,img,n=None)
                     if debug is True: print(clrmsg.DEBUG + str(img.shape), zopt)
                     if 0 <= zopt <= img.shape[-3]:
@@ -272,7 +288,7 @@ class QTableViewCustom(QtWidgets.QTableView):
                         self._scene.zValuesDict[activeitems[row]][1] = (255,0,0)
                         self._model.itemFromIndex(self._model.index(row, 2)).setForeground(QtCore.Qt.red)
                     self._model.itemFromIndex(self._model.index(row, 2)).setText(str(zopt))
-                elif optimize is True: #Probably never runs because gauss is never False
+                else: #Probably never runs because gauss is never False
                     xopt,yopt,zopt = beadPos.getzPoly(x,y,img,n=None,optimize=True)
                     if debug is True: print(clrmsg.DEBUG + str(img.shape), xopt,yopt,zopt)
                     if 0 <= xopt <= img.shape[-1] and 0 <= yopt <= img.shape[-2] and 0 <= zopt <= img.shape[-3]:
@@ -285,6 +301,61 @@ class QTableViewCustom(QtWidgets.QTableView):
                     self._model.itemFromIndex(self._model.index(row, 1)).setText(str(yopt))
                     self._model.itemFromIndex(self._model.index(row, 2)).setText(str(zopt))
 
+    def getzBatch(self,img,rows,activeitems,optimize=False,method='gauss'):
+        #Gaussian fits of all selected rows in one beadPos.localize call, the GUI is only updated afterwards
+        xy = np.array([[float(self._model.data(self._model.index(row, column))) for column in (0, 1)] for row in rows])
+        if optimize is False:
+            positions, quality = beadPos.localize(xy,img,optimize=False)
+        elif method != 'gauss':
+            ## One step 3D localization in the sub-volume of +-marker size around the bead
+            positions, quality = beadPos.localize(xy,img,optimize=True,cutout=self._scene.markerSize,method=method)
+        else:
+            positions, quality = beadPos.localize(
+                xy,img,optimize=True,threshold=True,
+                threshVal=self.mainParent.doubleSpinBox_treshVal.value(),cutout=self._scene.markerSize)
+        for row, (x, y), (xopt, yopt, zopt), r2 in zip(rows, xy, positions, quality):
+            if debug is True: print(clrmsg.DEBUG + 'Row:', row, '|', x, y, '->', xopt, yopt, zopt, 'R^2:', r2)
+            if optimize is False:
+                # "Get z gauss..."
+                if 0 <= zopt <= img.shape[-3]:
+                    self._scene.zValuesDict[activeitems[row]][1] = (0,0,0)
+                    self._model.itemFromIndex(self._model.index(row, 2)).setForeground(QtCore.Qt.black)
+                else:
+                    self._scene.zValuesDict[activeitems[row]][1] = (255,0,0)
+                    self._model.itemFromIndex(self._model.index(row, 2)).setForeground(QtCore.Qt.red)
+            else:
+                # "Get x,y,z gauss..."
+                if (
+                    abs(x - xopt) <= 2 * self._scene.markerSize and
+                    abs(y - yopt) <= 2 * self._scene.markerSize and
+                    0 <= zopt <= img.shape[-3]):
+                    self._scene.zValuesDict[activeitems[row]][1] = (255,0,0)
+                    self._model.itemFromIndex(self._model.index(row, 2)).setForeground(QtCore.Qt.black)
+                else:
+                    self._scene.zValuesDict[activeitems[row]][1] = (0,0,0)
+                    self._model.itemFromIndex(self._model.index(row, 2)).setForeground(QtCore.Qt.red)
+                    xopt, yopt = x, y
+                self._model.itemFromIndex(self._model.index(row, 0)).setText(str(xopt))
+                self._model.itemFromIndex(self._model.index(row, 1)).setText(str(yopt))
+            self._model.itemFromIndex(self._model.index(row, 2)).setText(str(zopt))
+        ## Plot the z profile of the last bead once, instead of redrawing for every fit
+        xlast, ylast, zlast = positions[-1]
+        if not np.isnan(zlast):
+            data_z = img[:,int(round(ylast)),int(round(xlast))]
+            beadPos.plotProfile(beadPos.fitProfile(np.array([np.arange(len(data_z)), data_z])),self.mainParent)
+
+    def detectBeads(self,img):
+        #Called when user right clicks on the table and selects "Detect beads layer ...".
+        #Adds a marker for every bead found in the stack, markers already in the table are kept.
+        #The marker size is taken as the bead radius in pixels.
+        sigma = max(1., self._scene.markerSize/math.sqrt(3))
+        positions, response = beadPos.detect(img,sigma=sigma)
+        if debug is True: print(clrmsg.DEBUG + 'Detected beads:', len(positions))
+        for x, y, z in positions:
+            self._scene.addCircle(x,y,z,renumber=False)
+        self._scene.enumeratePoints()
+        self._scene.itemsToModel()
+
                                                 ##################### END #####################
                                                 #######          Update items           #######
                                                 ###############################################
@@ -393,7 +464,7 @@ class QGraphicsSceneCustom(QtWidgets.QGraphicsScene):
         elif event.key() == QtCore.Qt.Key_Minus:
             self.parent().scale(1 / 1.15, 1 / 1.15)
 
-    def addCircle(self,x,y,z=None):
+    def addCircle(self,x,y,z=None,renumber=True):
         ## First add at 0,0 then move to get position from item.scenePos() or .x() and y.()
         circle = self.addEllipse(-self.markerSize, -self.markerSize, self.markerSize * 2, self.markerSize * 2, self.pen)
         circle.setPos(x,y)
@@ -409,7 +480,9 @@ class QGraphicsSceneCustom(QtWidgets.QGraphicsScene):
             self.zValuesDict[circle] = [0.0,(0, 0, 0)]  # black
         ## Reorder to have them in ascending order in the tableview
         QtWidgets.QGraphicsItem.stackBefore(circle, list(self.items())[-2])
-        self.enumeratePoints()
+        ## renumber=False when adding many markers at once, call enumeratePoints() afterwards
+        if renumber is True:
+            self.enumeratePoints()
 
         ## Arrow test code
         # import time
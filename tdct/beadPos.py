@@ -26,10 +26,14 @@ to get an optimized bead position (optimization of x, y and z)
 """
 # ======================================================================================================================
 
+import os
 import time
 import math
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from scipy.optimize import curve_fit, leastsq
+from scipy.optimize import leastsq
+import scipy.ndimage
 import matplotlib.pyplot as plt
 import tifffile as tf
 from . import parabolic
@@ -109,63 +113,336 @@ def getzGauss(x,y,img,parent=None,optimize=False,threshold=None,threshVal=0.6,cu
     #List of x and y coordinates of beads/POI are converted to integer type so that they can be used as indexes
     ix = np.round(x).astype(int)
     iy = np.round(y).astype(int)
+    #The fits do not touch the GUI, the last z and xy fit are drawn to parent once at the end
+    fitZ = fitXY = None
     if 0 <= ix < img.shape[-1] and 0 <= iy < img.shape[-2]: #Checks the approximate x and y coordinates of the bead are inside the volume
-        data_z = img[:,iy,ix] #Gets data vs z (1D plot) at the approximate x,y locations
-        data = np.array([np.arange(len(data_z)), data_z])
-
-        #Fits a gaussian in the z axis direction
-        poptZ, pcov = gaussfit(data,parent)
+        #Fits a gaussian in the z axis direction to the data vs z (1D plot) at the approximate x,y locations
+        fitZ = _fitZProfile(img[:,iy,ix])
+        zopt = fitZ.params[1]
     else:
         #approximate (x,y) coordinates of the bead are outside image boundaries
-        #set the gaussian parameters to following
-        poptZ = [None, -1.0, None]
+        zopt = -1.0
 
-    #popt - gaussian optimized parameters in format A, mu, sigma
-    if optimize is False:
-        return poptZ[1] #Optimization along z at (x,y) completed. Do not try to fit gaussian on x-y plane.
-    else:
+    if optimize is True:
         repeats = 5 #Repeats optimization 5 times
-        if clrmsg and debug is True: print(clrmsg.DEBUG + '2D Gaussian xy optimization running %.f at z = %.f' % (repeats,round(poptZ[1])))
+        if clrmsg and debug is True: print(clrmsg.DEBUG + '2D Gaussian xy optimization running %.f at z = %.f' % (repeats,round(zopt)))
         for repeat in range(repeats):
-            if (cutout <= ix < img.shape[-1]-cutout and
+            if not (cutout <= ix < img.shape[-1]-cutout and
                     cutout <= iy < img.shape[-2]-cutout and
-                    0 <= poptZ[1] < img.shape[-3]-0.5):
-                
-                #Gets 2D XY plane data from image, only around the region of interest
-                #at z=zmean (determined from the previous gaussian fit)
-                data = np.copy(img[
-                            int(round(poptZ[1])),
-                            int(iy-cutout):int(iy+cutout),
-                            int(ix-cutout):int(ix+cutout)])
-            else:
+                    0 <= zopt < img.shape[-3]-0.5):
                 print("Point(s) too close to edge or out of bounds.")
-                return ix, iy, poptZ[1]
+                break
+            #Gets 2D XY plane data from image, only around the region of interest
+            #at z=zopt (determined from the previous gaussian fit)
+            data = np.copy(img[
+                        int(round(zopt)),
+                        int(iy-cutout):int(iy+cutout),
+                        int(ix-cutout):int(ix+cutout)])
             if threshold is not None:
                 threshold = data < data.max()-(data.max()-data.min())*threshVal
                 data[threshold] = 0
-            
-            #TODO: Testing new function
-            #poptXY = fitgaussian(data,parent)
-            poptXY = fit2Dgaussian(data,parent)
 
-            if poptXY is None:
+            fitXY = fitImage(data)
+            if not fitXY.success:
                 #Failed to fit in the 2D plane, exit
-                return ix, iy, poptZ[1]
+                break
 
             #gets the optimized gaussian2D parameters
-            (height, xopt, yopt, width_x, width_y) = poptXY
+            (height, xopt, yopt, width_x, width_y, offset) = fitXY.params
             ## x and y are switched when applying the offset
             ix = ix-cutout+yopt
             iy = iy-cutout+xopt
-            if 0 <= ix < img.shape[-1] and 0 <= iy < img.shape[-2]:
-                data_z = img[:,int(iy),int(ix)]
+            if not (0 <= ix < img.shape[-1] and 0 <= iy < img.shape[-2]):
+                break
+            fitZ = _fitZProfile(img[:,int(iy),int(ix)])
+            zopt = fitZ.params[1]
+
+    if parent is not None:
+        if fitZ is not None:
+            plotProfile(fitZ,parent)
+        if fitXY is not None:
+            plotImage(fitXY,parent)
+    if optimize is False:
+        return zopt #Optimization along z at (x,y) completed. Do not try to fit gaussian on x-y plane.
+    return ix, iy, zopt
+
+
+def _fitZProfile(data_z):
+    ## fitProfile of the z profile, raises RuntimeError as gaussfit if the fit failed
+    result = fitProfile(np.array([np.arange(len(data_z)), data_z]))
+    if not result.success:
+        raise RuntimeError('Gaussian fit failed: Probably due to low SNR')
+    return result
+
+
+## Localization methods of localize
+methods = ('gauss', 'gauss3D', 'radial')
+
+
+def localize(xy,img,optimize=True,threshold=None,threshVal=0.6,cutout=15,rounds=5,tol=0.01,method='gauss',cutoutZ=None):
+    """Batch version of getzGauss for many beads at once, without any GUI updates
+    xy is an (N,2) array of approximate x,y pixel coordinates
+    img is the path to the z-stack tiff file or a numpy.ndarray from tifffile.py imread function
+    optimize == False only fits z at the given x,y. With optimize == True method selects the xyz refinement:
+        'gauss': alternates the z and the 2D Gaussian xy fit (threshold, threshVal and cutout as in getzGauss) for
+                 up to rounds rounds, stopping when xy moves less than tol
+        'gauss3D': one 3D Gaussian fit (fitGauss3D) of the sub-volume of +-cutoutZ (default cutout) slices and
+                   +-cutout pixels around the z fit at x,y
+        'radial': radial symmetry centre (radialCenter3D) of the same sub-volume, non-iterative
+    All beads are fitted together in each step (batched Levenberg-Marquardt, see fitGauss1D/fitGauss2D).
+    Unlike getzGauss, which truncates its fractional x,y to index the image, 'gauss' rounds x,y to the nearest
+    pixel for the z profile and the xy cutout of every round. The results can therefore differ from getzGauss by a
+    fraction of a pixel (e.g. x = 70.05 instead of 70.89 for a bead at x = 70).
+    Returns positions, quality: positions is an (N,3) array of refined x,y,z (z is nan if the fit failed),
+    quality the coefficient of determination R^2 of the final z fit ('gauss3D': of the 3D fit, 'radial': see
+    radialCenter3D), nan if the fit failed"""
+    if method not in methods:
+        raise ValueError("Unknown localization method {0}, use one of {1}".format(method, methods))
+    if isinstance(img, str):
+        img = tf.imread(img)
+    elif not isinstance(img, np.ndarray):
+        raise TypeError('I can only handle an image path as string or an image volume as numpy.ndarray imported from tifffile.py')
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    ## Beads outside of the image
+    outside = np.array([not (0 <= round(x) < img.shape[-1] and 0 <= round(y) < img.shape[-2]) for x, y in xy], dtype=bool)
+    ## z only (start values of the refinement): one vectorized fit of all z profiles
+    positions = np.column_stack([xy, np.full(len(xy), np.nan)])
+    quality = np.full(len(xy), np.nan)
+    if not outside.all():
+        ix, iy = np.round(xy[~outside]).astype(int).T
+        positions[~outside, 2], quality[~outside] = _fitzBatch(img[:, iy, ix].T)
+    if optimize is False:
+        return positions, quality
+    if method != 'gauss':
+        return _localize3D(img, positions, method, cutout, cutout if cutoutZ is None else cutoutZ)
+    ## Beads drop out when they reach the border, a fit fails or they move less than tol
+    active = ~np.isnan(positions[:, 2])
+    for repeat in range(rounds):
+        ix, iy = np.round(positions[:, :2]).astype(int).T
+        with np.errstate(invalid='ignore'):
+            active &= ((cutout <= ix) & (ix < img.shape[-1]-cutout) & (cutout <= iy) & (iy < img.shape[-2]-cutout) &
+                       (0 <= positions[:, 2]) & (positions[:, 2] < img.shape[-3]-0.5))
+        if not active.any():
+            break
+        idx = np.nonzero(active)[0]
+        data = np.stack([img[int(round(positions[i, 2])), iy[i]-cutout:iy[i]+cutout, ix[i]-cutout:ix[i]+cutout] for i in idx]).astype(float)
+        if threshold is not None:
+            high, low = data.max(axis=(1, 2), keepdims=True), data.min(axis=(1, 2), keepdims=True)
+            data[data < high-(high-low)*threshVal] = 0
+        popt, pcov, success = fitGauss2D(data)
+        ## x and y are switched when applying the offset
+        with np.errstate(invalid='ignore'):
+            xnew, ynew = ix[idx]-cutout+popt[:, 2], iy[idx]-cutout+popt[:, 1]
+            moved = (success & (0 <= np.round(xnew)) & (np.round(xnew) < img.shape[-1]) &
+                     (0 <= np.round(ynew)) & (np.round(ynew) < img.shape[-2]))
+        active[idx[~moved]] = False
+        idx, xnew, ynew = idx[moved], xnew[moved], ynew[moved]
+        if len(idx) == 0:
+            break
+        shift = np.hypot(xnew-positions[idx, 0], ynew-positions[idx, 1])
+        positions[idx, 0], positions[idx, 1] = xnew, ynew
+        positions[idx, 2], quality[idx] = _fitzBatch(img[:, np.round(ynew).astype(int), np.round(xnew).astype(int)].T)
+        active[idx[shift < tol]] = False
+    return positions, quality
+
+
+def _localize3D(img,positions,method,cutout,cutoutZ,chunk=16):
+    ## One step 3D localization of the beads at positions (x,y,z start values) in sub-volumes around them.
+    ## Sub-volumes of the same shape (clipped at the image border) are processed together, chunk at a time.
+    positions = positions.copy()
+    quality = np.full(len(positions), np.nan)
+    boxes = {}
+    for i, (x, y, z) in enumerate(positions):
+        if np.isnan(z):
+            continue
+        center = [int(round(c)) for c in (z, y, x)]
+        start = [max(c - h, 0) for c, h in zip(center, (cutoutZ, cutout, cutout))]
+        stop = [min(c + h + 1, n) for c, h, n in zip(center, (cutoutZ, cutout, cutout), img.shape[-3:])]
+        boxes.setdefault(tuple(b - a for a, b in zip(start, stop)), []).append((i, start, stop))
+    for shape, members in boxes.items():
+        for n in range(0, len(members), chunk):
+            group = members[n:n+chunk]
+            volumes = np.stack([img[a[0]:b[0], a[1]:b[1], a[2]:b[2]] for i, a, b in group]).astype(float)
+            if method == 'gauss3D':
+                popt, pcov, success = fitGauss3D(volumes)
+                centers = popt[:, 1:4]
+                r2 = _rsquared(volumes, _gaussModel(popt, shape))
             else:
-                return ix, iy, poptZ[1]
-            data = np.array([np.arange(len(data_z)), data_z])
-            poptZ, pcov = gaussfit(data,parent,hold=True)
-            if parent: parent.refreshUI()
-            time.sleep(0.01)
-        return ix, iy, poptZ[1]
+                centers, r2 = radialCenter3D(volumes)
+            for (i, start, stop), center, r in zip(group, centers, r2):
+                if np.isnan(center).any():
+                    positions[i, 2] = np.nan
+                    continue
+                z, y, x = np.array(start) + center
+                positions[i] = x, y, z
+                quality[i] = r
+    return positions, quality
+
+
+def _gaussModel(popt, shape):
+    ## Values of the axis aligned Gaussians with offset (rows of popt as fitGauss2D/3D) on the grid of shape
+    ndim = len(shape)
+    coords = np.indices(shape).reshape(ndim, -1).astype(float)
+    center, width = popt[:, 1:ndim+1, None], popt[:, ndim+1:2*ndim+1, None]
+    g = np.exp(-(((coords[None]-center)/width)**2).sum(axis=1)/2)
+    return (popt[:, -1:] + popt[:, :1]*g).reshape((len(popt),)+tuple(shape))
+
+
+def _rsquared(data, model):
+    ## Coefficient of determination per item of the first axis
+    data, model = data.reshape(len(data), -1), model.reshape(len(model), -1)
+    total = ((data - data.mean(axis=-1, keepdims=True))**2).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, 1 - ((data - model)**2).sum(axis=-1)/total, np.nan)
+
+
+def radialCenter3D(volumes):
+    """Radial symmetry centre of the bead in each of volumes (N,Z,Y,X) or one volume (Z,Y,X), non-iterative
+    (Parthasarathy 2012, Nat. Methods 9, 724, extended to 3D): the point closest (least squares) to all lines
+    along the intensity gradients, weighted by the squared gradient magnitude over the distance to the gradient
+    centroid. The gradients are taken at the centres of 2x2x2 voxel cubes and box smoothed (3 voxels).
+    Only needs the bead to be point symmetric, also in stacks with a different z spacing.
+    Returns centres (N,3) in z,y,x voxel coordinates and the quality 1 - (weighted mean squared distance of the
+    lines from the centre)/(weighted mean squared distance of the gradient positions from the centre), 1 for a
+    perfectly radially symmetric bead. Flat volumes give nan."""
+    volumes = np.asarray(volumes, dtype=float)
+    if volumes.ndim == 3:
+        volumes = volumes[None]
+    ## Gradients at the cube centres, averaged over the four edges of the cube along each axis
+    gradients = []
+    for axis in (1, 2, 3):
+        d = np.diff(volumes, axis=axis)
+        for other in (1, 2, 3):
+            if other != axis:
+                d = 0.5*(np.take(d, range(d.shape[other]-1), axis=other) + np.take(d, range(1, d.shape[other]), axis=other))
+        gradients.append(scipy.ndimage.uniform_filter(d, size=(1, 3, 3, 3), mode='nearest'))
+    n = len(volumes)
+    g = np.stack(gradients, axis=-1).reshape(n, -1, 3)
+    points = np.stack([c.ravel() + 0.5 for c in np.indices(volumes.shape[1:])[:, :-1, :-1, :-1]], axis=-1)
+    g2 = (g**2).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        unit = g/np.sqrt(g2)[..., None]
+        unit[g2 == 0] = 0
+        centroid = np.einsum('nm,mi->ni', g2, points)/g2.sum(axis=-1, keepdims=True)
+        distance = np.linalg.norm(points[None]-centroid[:, None], axis=-1)
+        weights = g2/np.maximum(distance, 0.5)
+    ## sum over w*(I - u u^T) c = sum over w*(I - u u^T) p
+    projector = np.eye(3)[None, None] - unit[..., :, None]*unit[..., None, :]
+    lhs = np.einsum('nm,nmij->nij', weights, projector)
+    rhs = np.einsum('nm,nmij,mj->ni', weights, projector, points)
+    centers = _solve(lhs, rhs)
+    offset = points[None]-centers[:, None]
+    lines = np.einsum('nmi,nmij,nmj->nm', offset, projector, offset)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        quality = 1 - (weights*lines).sum(axis=-1)/(weights*(offset**2).sum(axis=-1)).sum(axis=-1)
+    inside = ((0 <= centers) & (centers <= np.array(volumes.shape[1:])-1)).all(axis=-1)
+    centers[~inside] = np.nan
+    return centers, np.where(inside, quality, np.nan)
+
+
+def detect(img,sigma=(1.5,2.,2.),threshold=None,minDistance=None,chunk=32,workers=None):
+    """Find the beads in the image stack img (z,y,x) without start positions, e.g. to seed the marker table
+    img is the path to the z-stack tiff file or a numpy.ndarray from tifffile.py imread function
+    sigma (z,y,x) in voxels is the scale of the difference of Gaussians (dogFilter), about the bead radius/sqrt(3)
+    threshold is the minimum DoG response of a bead, None: median + 5 robust standard deviations (MAD) of the response
+    minDistance (z,y,x) in voxels: of two maxima closer than this only the stronger one is kept (non-maximum
+    suppression), None: 2*sigma
+    The filters run on chunks of chunk z slices in workers threads (None: one per core). Maxima on the stack border
+    are ignored.
+    Returns positions, response: positions is an (N,3) array of x,y,z with sub-voxel precision (parabola through
+    the maximum and its neighbours along each axis), sorted by decreasing DoG response"""
+    if isinstance(img, str):
+        img = tf.imread(img)
+    elif not isinstance(img, np.ndarray):
+        raise TypeError('I can only handle an image path as string or an image volume as numpy.ndarray imported from tifffile.py')
+    if img.ndim != 3:
+        raise ValueError("Bead detection needs an image stack (z,y,x), got shape {0}".format(img.shape))
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (3,))
+    if minDistance is None:
+        minDistance = 2*sigma
+    size = 2*np.ceil(np.broadcast_to(np.asarray(minDistance, dtype=float), (3,))).astype(int) + 1
+    ping = time.time()
+    dog = dogFilter(img, sigma, chunk=chunk, workers=workers)
+    if threshold is None:
+        median = np.median(dog)
+        threshold = median + 5*1.4826*np.median(np.abs(dog - median))
+    ## Maxima of the neighbourhood, plateaus (equal neighbours) count as one maximum
+    peaks = _chunked(lambda sub: scipy.ndimage.maximum_filter(sub, size=size, mode='nearest') == sub, dog, size[0]//2, chunk, workers, bool)
+    peaks &= dog > threshold
+    ## Beads cut by the stack border cannot be localized (and the filters are least reliable there)
+    for axis in range(3):
+        peaks[(slice(None),)*axis + (0,)] = False
+        peaks[(slice(None),)*axis + (-1,)] = False
+    labels, n = scipy.ndimage.label(peaks, structure=np.ones((3, 3, 3)))
+    if n == 0:
+        return np.empty((0, 3)), np.empty(0)
+    maxima = np.array(scipy.ndimage.maximum_position(dog, labels, range(1, n+1)), dtype=int).reshape(-1, 3)
+    response = dog[tuple(maxima.T)].astype(float)
+    ## Sub-voxel offset of the parabola vertex along each axis
+    offset = np.zeros(maxima.shape)
+    for axis in range(3):
+        step = np.eye(3, dtype=int)[axis]
+        a, b = dog[tuple((maxima - step).T)].astype(float), dog[tuple((maxima + step).T)].astype(float)
+        curvature = a - 2*response + b
+        with np.errstate(divide='ignore', invalid='ignore'):
+            offset[:, axis] = np.clip(np.where(curvature < 0, 0.5*(a - b)/curvature, 0), -0.5, 0.5)
+    order = np.argsort(-response, kind='stable')
+    positions = (maxima + offset)[order][:, ::-1]
+    if debug is True: print(clrmsg.DEBUG + "Detected {0} beads in {1:.2f} s".format(len(positions), time.time() - ping))
+    return positions, response[order]
+
+
+def dogFilter(img,sigma,ratio=1.6,chunk=32,workers=None):
+    """Difference of Gaussians G(sigma) - G(ratio*sigma) of the image stack img (z,y,x) as float32, an approximation
+    of the negative Laplacian of Gaussian that responds to blobs of radius ~sqrt(3)*sigma. The Gaussians are
+    separable (one 1D filter per axis) and computed on chunks of chunk z slices (plus the filter reach above and
+    below) in workers threads (None: one per core), so only a few chunks are held in float at the same time."""
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (3,))
+    ## gaussian_filter reaches 4 standard deviations (truncate=4.0), results equal the whole stack filter
+    reach = int(np.ceil(4*ratio*sigma[0]))
+
+    def dog(sub):
+        sub = sub.astype('float32')
+        return scipy.ndimage.gaussian_filter(sub, sigma, mode='nearest') - scipy.ndimage.gaussian_filter(sub, ratio*sigma, mode='nearest')
+    return _chunked(dog, img, reach, chunk, workers, 'float32')
+
+
+def _chunked(func, img, reach, chunk, workers, dtype):
+    ## Apply func to chunks of chunk z slices of img with reach slices of overlap and collect the inner parts
+    out = np.empty(img.shape, dtype=dtype)
+    chunks = [(k, min(k+chunk, img.shape[0])) for k in range(0, img.shape[0], chunk)]
+
+    def work(k0, k1):
+        a, b = max(k0-reach, 0), min(k1+reach, img.shape[0])
+        out[k0:k1] = func(img[a:b])[k0-a:k1-a]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(int(workers), len(chunks)))
+    if workers == 1:
+        for k0, k1 in chunks:
+            work(k0, k1)
+    else:
+        ## scipy.ndimage releases the GIL, the chunks are filtered in parallel
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(work, k0, k1) for k0, k1 in chunks]:
+                future.result()
+    return out
+
+
+def _fitzBatch(profiles):
+    ## Gaussian fits of the z profiles (N,L) after subtracting their minimum (as gaussfit),
+    ## returns the positions and R^2 of the fits (nan for failed fits and flat profiles)
+    profiles = np.asarray(profiles, dtype=float)
+    profiles = profiles - profiles.min(axis=-1, keepdims=True)
+    total = ((profiles - profiles.mean(axis=-1, keepdims=True))**2).sum(axis=-1)
+    popt, pcov, success = fitGauss1D(profiles)
+    A, mu, sigma = [v[:, None] for v in popt.T]
+    x = np.arange(profiles.shape[-1])
+    residual = ((profiles - A*np.exp(-(x-mu)**2/(2*sigma**2)))**2).sum(axis=-1)
+    success &= total > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = 1 - residual/total
+    return np.where(success, popt[:, 1], np.nan), np.where(success, r2, np.nan)
 
 
 def optimize_z(x,y,z,image,n=None):
@@ -323,32 +600,16 @@ def gauss(x, *p):
 
 
 def gaussfit(data,parent=None,hold=False):
-    ## Fitting 1D gaussian to data
+    ## Fitting 1D gaussian to data (see fitProfile)
     # and plots to parent.widget_matplotlib the result
-    data[1] = data[1]-data[1].min()
-    p0 = [data[1].max(), data[1].argmax(), 1]
-
-    #uses curve_fit() from scipy
-    popt, pcov = curve_fit(gauss, data[0], data[1], p0=p0)
+    result = fitProfile(data)
+    if not result.success:
+        raise RuntimeError('Gaussian fit failed: Probably due to low SNR')
+    popt, pcov = result.params, result.covariance
 
     if parent is not None:
         ## Draw graphs in GUI
-        x = []
-        y = []
-        for i in np.arange(len(data[0])):
-            x.append(i)
-            y.append(gauss(i,*popt))
-        if hold is False:
-            parent.widget_matplotlib.setupScatterCanvas(width=4,height=4,dpi=52,toolbar=False)
-        parent.widget_matplotlib.xyPlot(data[0], data[1], label='z data',clear=True)
-        #parent.widget_matplotlib.xyPlot(x, y, label='gaussian fit',clear=False)
-
-        #Try adding wiidth to plot label
-        parent.widget_matplotlib.xyPlot(x, y,
-            label=('gauss fit w=%.1f' % (popt[2])),
-            clear=False )
-
-            
+        plotProfile(result,parent,hold)
 
     ## DEBUG
     if clrmsg and debug is True:
@@ -363,11 +624,263 @@ def gaussfit(data,parent=None,hold=False):
         print(clrmsg.DEBUG + 'Std. Amplitude	:', std_height)
         print(clrmsg.DEBUG + 'Std. Location	:', std_mean)
         print(clrmsg.DEBUG + 'Std. FWHM		:', std_sigma * 2 * math.sqrt(2 * math.log(2,math.e)))
-        print(clrmsg.DEBUG + 'Mean dy		:', np.absolute(y-data[1]).mean())
-        print(clrmsg.DEBUG + str(ks_2samp(y, data[1])))
+        print(clrmsg.DEBUG + 'Mean dy		:', np.absolute(result.fit-result.data[1]).mean())
+        print(clrmsg.DEBUG + str(ks_2samp(result.fit, result.data[1])))
     return popt, pcov
 
 
+## Result of the GUI-free fits fitProfile and fitImage: parameters and their covariance, residual sum of squares,
+## success flag, the fitted data and the model values at the data points. Plotting is left to the caller
+## (plotProfile, plotImage), so the fits can run in worker threads and batches are only drawn once.
+FitResult = namedtuple('FitResult', ['params', 'covariance', 'residual', 'success', 'data', 'fit'])
+
+
+def fitProfile(data):
+    """Gaussian fit (gauss) of the profile data = [x, values] after subtracting its minimum. data is not modified.
+    Returns a FitResult with params (A, mu, sigma) and data [x, values - min], params are nan if the fit failed"""
+    x = np.asarray(data[0], dtype=float)
+    y = np.asarray(data[1], dtype=float)
+    y = y - y.min()
+    popt, pcov, success = fitGauss1D(y, x)
+    fit = gauss(x, *popt[0])
+    return FitResult(popt[0], pcov[0], float(((y - fit)**2).sum()), bool(success[0]), np.array([x, y]), fit)
+
+
+def fitImage(data2D):
+    """2D Gaussian fit (fitGauss2D) of data2D, x along the first (row) axis and y along the second (column) axis.
+    Returns a FitResult with params (height, center_x, center_y, width_x, width_y, offset), nan if the fit failed"""
+    data2D = np.asarray(data2D, dtype=float)
+    popt, pcov, success = fitGauss2D(data2D)
+    fit = _gaussModel(popt, data2D.shape)[0]
+    return FitResult(popt[0], pcov[0], float(((data2D - fit)**2).sum()), bool(success[0]), data2D, fit)
+
+
+def plotProfile(result,parent,hold=False):
+    """Draw the profile and the Gaussian of a fitProfile result to parent.widget_matplotlib
+    hold == False sets up a new canvas"""
+    x, y = result.data
+    if hold is False:
+        parent.widget_matplotlib.setupScatterCanvas(width=4,height=4,dpi=52,toolbar=False)
+    parent.widget_matplotlib.xyPlot(x, y, label='z data',clear=True)
+    if result.success:
+        parent.widget_matplotlib.xyPlot(x, result.fit, label=('gauss fit w=%.1f' % (result.params[2])), clear=False)
+
+
+def plotImage(result,parent):
+    """Draw the image and the contour of the Gaussian of a fitImage result to parent.widget_matplotlib"""
+    if not result.success:
+        parent.widget_matplotlib.matshowPlot(
+            mat=result.data,contour=np.ones(result.data.shape),labelContour="XY optimization failed\n" +
+            "Try reducing the\nmarker size (equates to\nFOV for gaussian fit)")
+        return
+    (height, x, y, width_x, width_y, offset) = result.params
+    contour = gaussian(height, x, y, width_x, width_y)(*np.indices(result.data.shape))
+    labelContour = (
+                    "      x : %.1f\n"
+                    "      y : %.1f\n"
+                    "width_x : %.1f\n"
+                    "width_y : %.1f") % (x, y, width_x, width_y)
+    parent.widget_matplotlib.matshowPlot(mat=result.data,contour=contour,labelContour=labelContour)
+
+
+## Vectorized Gaussian fits: closed-form start values (Caruana's log-parabola, weighted by the squared data as
+## proposed by Guo 2011) refined by Levenberg-Marquardt with analytic Jacobians, for many profiles/images at once
+def gaussInit1D(profiles, x=None):
+    """Closed-form start values (A, mu, sigma) of gauss for the rows of profiles (N,L) at the points x (default
+    0..L-1). Profiles without a usable log-parabola (no peak, peak outside of x or wider than x, e.g. flat tops)
+    get A = max, mu = centroid and sigma = FWHM/2.355 of the points above half of the maximum"""
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=float))
+    x = np.arange(profiles.shape[-1], dtype=float) if x is None else np.asarray(x, dtype=float)
+    ## Centred points keep the normal equations well conditioned
+    xc = x - x.mean()
+    ## Only values above a tenth of the peak, weights y^2 suppress the noisy tails
+    w = np.where(profiles > 0.1*profiles.max(axis=-1, keepdims=True), profiles, 0)**2
+    logy = np.log(np.where(profiles > 0, profiles, 1))
+    basis = np.stack([np.ones_like(xc), xc, xc**2], axis=-1)
+    lhs = np.einsum('nm,mi,mj->nij', w, basis, basis)
+    rhs = np.einsum('nm,mi,nm->ni', w, basis, logy)
+    a, b, c = _solve(lhs, rhs).T
+    top = np.where(profiles > 0.5*profiles.max(axis=-1, keepdims=True), np.maximum(profiles, 0), 0)
+    spacing = (x.max()-x.min())/max(len(x)-1, 1)
+    p0 = np.stack([
+        profiles.max(axis=-1), (top*x).sum(axis=-1)/np.maximum(top.sum(axis=-1), 1e-300),
+        np.maximum((top > 0).sum(axis=-1)*spacing/2.355, spacing/2)], axis=-1)
+    peak = (c < 0) & np.isfinite(c)
+    c = np.where(peak, c, -1)
+    mu, sigma = -b/(2*c) + x.mean(), np.sqrt(-1/(2*c))
+    peak &= (x.min() <= mu) & (mu <= x.max()) & (sigma <= x.max()-x.min())
+    fit = np.stack([np.exp(np.clip(a - b**2/(4*c), -700, 700)), mu, sigma], axis=-1)
+    return np.where(peak[:, None], fit, p0)
+
+
+def gaussInit2D(images):
+    """Closed-form start values (height, center_x, center_y, width_x, width_y, offset) of the 2D Gaussian of
+    fit2Dgaussian for images (N,H,W), center_x along the first (row) axis, see _gaussInit"""
+    return _gaussInit(images, 2)
+
+
+def gaussInit3D(volumes):
+    """Closed-form start values (height, center_z, center_y, center_x, width_z, width_y, width_x, offset) of the 3D
+    Gaussian of fitGauss3D for volumes (N,Z,Y,X), see _gaussInit"""
+    return _gaussInit(volumes, 3)
+
+
+def _gaussInit(images, ndim):
+    ## Start values (height, centres, widths, offset) of an axis aligned Gaussian for images (N, ndim axes).
+    ## offset is the image median (the bead covers less than half of the image), only pixels above half of the peak
+    ## are used for the log-parabola.
+    images = np.asarray(images, dtype=float)
+    if images.ndim == ndim:
+        images = images[None]
+    n, shape = len(images), images.shape[1:]
+    offset = np.median(images.reshape(n, -1), axis=-1)
+    ## 3 pixel box smoothing against noise, adds a variance of 2/3 to the squared widths (corrected below)
+    data = scipy.ndimage.uniform_filter(images - offset.reshape((n,)+(1,)*ndim), size=(1,)+(3,)*ndim, mode='nearest').reshape(n, -1)
+    coords = [i.ravel().astype(float) for i in np.indices(shape)]
+    top = data > 0.5*data.max(axis=-1, keepdims=True)
+    w = np.where(top, data, 0)**2
+    logz = np.log(np.where(data > 0, data, 1))
+    basis = np.stack([np.ones_like(coords[0])] + coords + [c**2 for c in coords], axis=-1)
+    lhs = np.einsum('nm,mi,mj->nij', w, basis, basis)
+    rhs = np.einsum('nm,mi,nm->ni', w, basis, logz)
+    solution = _solve(lhs, rhs)
+    a, b, c = solution[:, 0], solution[:, 1:ndim+1], solution[:, ndim+1:]
+    ## Fallback (no peak, peak outside of the image or much wider than the area above half maximum, e.g. flat tops):
+    ## centroid and extent of the pixels above half of the maximum. An ellipsoid with half axes 1.177*width has the
+    ## variance (1.177*width)^2/(ndim+2) along each axis.
+    count = np.maximum(top.sum(axis=-1), 1)
+    centroid = np.stack([(top*coord).sum(axis=-1)/count for coord in coords], axis=-1)
+    spread = np.stack([(top*(coord-centroid[:, [i]])**2).sum(axis=-1)/count for i, coord in enumerate(coords)], axis=-1)
+    width = np.maximum(np.sqrt((ndim+2)*spread)/1.177, 0.5)
+    p0 = np.column_stack([data.max(axis=-1), centroid, width, offset])
+    peak = (c < 0).all(axis=-1) & np.isfinite(c).all(axis=-1)
+    c = np.where(peak[:, None], c, -1)
+    center = -b/(2*c)
+    var = np.maximum(-1/(2*c) - 2/3., 0.25)
+    peak &= ((0 <= center) & (center <= np.array(shape)-1)).all(axis=-1)
+    peak &= (var <= (1.5*width)**2).all(axis=-1)
+    height = np.exp(np.clip(a - (b**2/(4*c)).sum(axis=-1), -700, 700))*np.sqrt(((var + 2/3.)/var).prod(axis=-1))
+    fit = np.column_stack([height, center, np.sqrt(var), offset])
+    return np.where(peak[:, None], fit, p0)
+
+
+def fitGauss1D(profiles, x=None, p0=None, maxiter=50):
+    """Fit gauss (A, mu, sigma) to each row of profiles (N,L) at the points x (default 0..L-1)
+    Returns popt (N,3), pcov (N,3,3) like curve_fit and success (N,), failed fits are nan"""
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=float))
+    x = np.arange(profiles.shape[-1], dtype=float) if x is None else np.asarray(x, dtype=float)
+    if p0 is None:
+        p0 = gaussInit1D(profiles, x)
+
+    def model(p):
+        A, mu, sigma = [v[:, None] for v in p.T]
+        g = np.exp(-(x-mu)**2/(2*sigma**2))
+        f = A*g
+        jac = np.stack([g, f*(x-mu)/sigma**2, f*(x-mu)**2/sigma**3], axis=-1)
+        return f, jac
+    popt, pcov, success = _levenbergMarquardt(model, np.atleast_2d(np.array(p0, dtype=float)), profiles, maxiter)
+    ## No peak, peaks outside of the profile or wider than the profile are failures too
+    return _plausible(popt, pcov, success, [(0, 1e-300, np.inf), (1, x.min(), x.max()), (2, 0, x.max()-x.min()+1)], [2])
+
+
+def fitGauss2D(images, p0=None, maxiter=50):
+    """Fit the 2D Gaussian with offset of fit2Dgaussian (height, center_x, center_y, width_x, width_y, offset) to
+    images (N,H,W), center_x along the first (row) axis
+    Returns popt (N,6), pcov (N,6,6) and success (N,), failed fits are nan"""
+    return _fitGauss(images, 2, gaussInit2D if p0 is None else p0, maxiter)
+
+
+def fitGauss3D(volumes, p0=None, maxiter=50):
+    """Fit offset + height*exp(-(((z-center_z)/width_z)**2+((y-center_y)/width_y)**2+((x-center_x)/width_x)**2)/2)
+    to volumes (N,Z,Y,X) in one go
+    Returns popt (N,8) (height, center_z, center_y, center_x, width_z, width_y, width_x, offset), pcov (N,8,8)
+    and success (N,), failed fits are nan"""
+    return _fitGauss(volumes, 3, gaussInit3D if p0 is None else p0, maxiter)
+
+
+def _fitGauss(images, ndim, p0, maxiter):
+    ## Axis aligned Gaussian with offset (height, centres, widths, offset) for images (N, ndim axes)
+    images = np.asarray(images, dtype=float)
+    if images.ndim == ndim:
+        images = images[None]
+    shape = images.shape[1:]
+    coords = np.stack([i.ravel().astype(float) for i in np.indices(shape)])
+    if callable(p0):
+        p0 = p0(images)
+
+    def model(p):
+        height, center, width, offset = p[:, :1], p[:, 1:ndim+1, None], p[:, ndim+1:2*ndim+1, None], p[:, -1:]
+        d = coords[None]-center
+        g = np.exp(-((d/width)**2).sum(axis=1)/2)
+        hg = height*g
+        jac = np.concatenate([
+            g[..., None], (hg[:, None]*d/width**2).transpose(0, 2, 1), (hg[:, None]*d**2/width**3).transpose(0, 2, 1),
+            np.ones_like(g)[..., None]], axis=-1)
+        return offset + hg, jac
+    popt, pcov, success = _levenbergMarquardt(
+        model, np.atleast_2d(np.array(p0, dtype=float)), images.reshape(len(images), -1), maxiter)
+    ## No peak, centres outside of the image or widths larger than the image are failures too
+    limits = [(0, 1e-300, np.inf)] + [(1+i, 0, n-1) for i, n in enumerate(shape)] + [(1+ndim+i, 0, n) for i, n in enumerate(shape)]
+    return _plausible(popt, pcov, success, limits, list(range(ndim+1, 2*ndim+1)))
+
+
+def _plausible(popt, pcov, success, limits, widths):
+    ## The models only depend on the squared widths, they are made positive. Fits with parameters outside of the
+    ## limits (index, min, max) are failed (nan).
+    popt[:, widths] = np.abs(popt[:, widths])
+    for i, lower, upper in limits:
+        success &= (lower <= popt[:, i]) & (popt[:, i] <= upper)
+    popt[~success] = np.nan
+    return popt, pcov, success
+
+
+def _solve(lhs, rhs):
+    ## Batched linear solve, singular systems give nan
+    out = np.full(rhs.shape, np.nan)
+    with np.errstate(invalid='ignore'):
+        ok = np.abs(np.linalg.det(lhs)) > 1e-300
+    if ok.any():
+        out[ok] = np.linalg.solve(lhs[ok], rhs[ok][..., None])[..., 0]
+    return out
+
+
+def _levenbergMarquardt(model, p, data, maxiter=50, tol=1e-8):
+    ## Batched Levenberg-Marquardt: model(p) returns the model values (N,M) and Jacobian (N,M,k) for parameters (N,k)
+    n, k = p.shape
+    f, jac = model(p)
+    cost = ((data-f)**2).sum(axis=-1)
+    lam = np.full(n, 1e-3)
+    active = np.isfinite(cost)
+    for iteration in range(maxiter):
+        if not active.any():
+            break
+        idx = np.nonzero(active)[0]
+        J, r = jac[idx], (data-f)[idx]
+        JTJ = np.matmul(J.transpose(0, 2, 1), J)
+        JTr = np.matmul(J.transpose(0, 2, 1), r[..., None])[..., 0]
+        diag = np.einsum('nii->ni', JTJ)
+        step = _solve(JTJ + lam[idx, None, None]*np.einsum('ni,ij->nij', diag, np.eye(k)), JTr)
+        ptry = p[idx] + step
+        ftry, jactry = model(ptry)
+        costtry = ((data[idx]-ftry)**2).sum(axis=-1)
+        better = np.isfinite(costtry) & (costtry <= cost[idx])
+        ## Converged when the cost does not change anymore (relative) or the step failed
+        converged = (np.abs(cost[idx]-costtry) <= tol*np.maximum(cost[idx], 1e-300)) | ~np.isfinite(step).all(axis=-1)
+        good = idx[better]
+        p[good], f[good], jac[good], cost[good] = ptry[better], ftry[better], jactry[better], costtry[better]
+        lam[idx] = np.where(better, lam[idx]/10, lam[idx]*10)
+        active[idx[converged | (lam[idx] > 1e10)]] = False
+    ## Covariance as curve_fit: inv(J^T J) * residual variance
+    JTJ = np.matmul(jac.transpose(0, 2, 1), jac)
+    pcov = np.full((n, k, k), np.inf)
+    ok = np.abs(np.linalg.det(JTJ)) > 1e-300
+    if ok.any():
+        pcov[ok] = np.linalg.inv(JTJ[ok])*(cost[ok]/max(data.shape[-1]-k, 1))[:, None, None]
+    success = np.isfinite(p).all(axis=-1) & np.isfinite(cost)
+    p[~success] = np.nan
+    return p, pcov, success
+
+
 ## Gaussian 2D fit from http://scipy.github.io/old-wiki/pages/Cookbook/FittingData
 def gaussian(height, center_x, center_y, width_x, width_y):
     """Returns a Gaussian function with the given parameters"""
@@ -440,22 +953,12 @@ def fitgaussian(data,parent=None):
     #Finds the gaussian parameters p that fit best to the data.
     p, success = leastsq(errorfunction, gaussparams_initvalues)
     
+    if parent is not None:
+        ## Draw graphs in GUI (no offset in this model)
+        success = not np.isnan(p).any()
+        plotImage(FitResult(np.append(p, 0.), None, None, success, data, None), parent)
     if np.isnan(p).any():
-        parent.widget_matplotlib.matshowPlot(
-            mat=data,contour=np.ones(data.shape),labelContour="XY optimization failed\n" +
-            "Try reducing the\nmarker size (equates to\nFOV for gaussian fit)")
         return None
-    if parent is not None:
-        ## Draw graphs in GUI
-        fit = gaussian(*p)
-        contour = fit(*np.indices(data.shape))
-        (height, x, y, width_x, width_y) = p
-        labelContour = (
-                        "      x : %.1f\n"
-                        "      y : %.1f\n"
-                        "width_x : %.1f\n"
-                        "width_y : %.1f") % (x, y, width_x, width_y)
-        parent.widget_matplotlib.matshowPlot(mat=data,contour=contour,labelContour=labelContour)
     return p
 
 
@@ -527,80 +1030,21 @@ def fitgaussian(data,parent=None):
 
 def fit2Dgaussian(data2D, parent=None, hold=False):
     #To replace fitgaussian()
-    #Also, it uses scipy.optimize.curve_fit
-    #https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.curve_fit.html#scipy.optimize.curve_fit
-
-    #And idea is based on
-    #https://stackoverflow.com/questions/21566379/fitting-a-2d-gaussian-function-using-scipy-optimize-curve-fit-valueerror-and-m
+    #Fits offset + height*exp(-(((center_x-x)/width_x)**2+((center_y-y)/width_y)**2)/2)
+    #with x along the first (row) axis and y along the second (column) axis of data2D
 
-    #For curve_fit() to work
-    #function to optimize must accept the independent variable(s) as first argument
-    def gauss2D (yxpos , height, center_x, center_y, width_x, width_y, offset):
-        '''
-            Assume y = yxpos[0] and x = yxpos[1]
-        '''
-        y=yxpos[0] #Note that y can be a n-dim array
-        x=yxpos[1]
-
-        gaussres = offset + height*np.exp(
-                -(((center_x-x)/width_x)**2+((center_y-y)/width_y)**2)/2)
+    #Closed-form start values and Levenberg-Marquardt with analytic Jacobian, see fitImage/fitGauss2D
+    #(replaces curve_fit with the start values height=max, center in the middle, widths of half the image)
+    result = fitImage(data2D)
+    if parent is not None:
+        ## Draw graphs in GUI, see plotImage (matshowPlot() in QtCustom.py, MatplotlibWidgetCustom)
+        plotImage(result,parent)
 
-        return gaussres
-
-    #Need to convert data to a flat array and we need also the corresponding yspos values
-    ind0 = np.indices(data2D.shape, dtype=np.float32)
-    X_mg = ind0[0]
-    Y_mg = ind0[1]
-    X_mg_flat = np.ravel(X_mg)
-    Y_mg_flat = np.ravel(Y_mg)
-
-    #YXPos = np.empty( (2,X_mg_flat.size) )
-    #YXPos[0,:] = Y_mg_flat[:]
-    #YXPos[1,:] = X_mg_flat[:]
-
-    data2D_flat = np.ravel(data2D)
-
-    #get initial guess values
-    #height, center_x, center_y, width_x, width_y, offset
-    height_guess = np.max(data2D)
-    center_x_guess = data2D.shape[1]/2
-    center_y_guess = data2D.shape[0]/2
-    width_x_guess = center_x_guess
-    width_y_guess = center_y_guess
-    offset_guess=0.0
-
-    #curve_fit() only seems to work with flattened data
-    params_opt, params_cov = curve_fit(
-        gauss2D,
-        [Y_mg_flat, X_mg_flat],
-        data2D_flat,
-        p0=( height_guess, center_x_guess, center_y_guess, width_x_guess, width_y_guess, offset_guess)
-    )
-
-    p=params_opt[:-1]
-
-    #Copied from fitgaussian(), changing data to data2D
     #Returns all parameters except last one called offset
-    #optimized parameters should be in format (height, center_x, center_y, width_x, width_y)
-    
-    if np.isnan(p).any():
-        parent.widget_matplotlib.matshowPlot(
-            mat=data2D,contour=np.ones(data2D.shape),labelContour="XY optimization failed\n" +
-            "Try reducing the\nmarker size (equates to\nFOV for gaussian fit)")
+    #optimized parameters are in format (height, center_x, center_y, width_x, width_y)
+    if not result.success:
         return None
-    if parent is not None:
-        ## Draw graphs in GUI
-        gaussfit_function = gaussian(*p) #Gets a gaussian function with the parameters given
-        gaussfit_data= gaussfit_function(*np.indices(data2D.shape))
-        (height, x, y, width_x, width_y) = p
-        labelContour = (
-                        "      x : %.1f\n"
-                        "      y : %.1f\n"
-                        "width_x : %.1f\n"
-                        "width_y : %.1f") % (x, y, width_x, width_y)
-        parent.widget_matplotlib.matshowPlot(mat=data2D, contour=gaussfit_data, labelContour=labelContour)
-        #matshowplot() in QTCustom.py , MatplotlibWidgetCustom
-    return p
+    return result.params[:-1]
 
 
 
@@ -9,10 +9,19 @@ else:
     execdir = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(execdir)
 
+import time
+import tempfile
+import hashlib
+import multiprocessing
+from queue import Empty
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
-from PyQt5 import QtWidgets
+from PyQt5 import QtCore, QtWidgets
 from . import clrmsg
 from . import TDCT_debug
+from . import csvHandler
 
 try:
     import tifffile as tf
@@ -63,6 +72,15 @@ def _convertAndNormalise(d0, doNormalise=True):
         ret=d2
     return ret
 
+def workerCount(workers=-1):
+    '''Number of threads for workers, negative values count back from the number of cores (-1 = all cores)'''
+    ncores = os.cpu_count() or 1
+    if workers is None or workers == 0:
+        return 1
+    if workers < 0:
+        return max(1, ncores + 1 + workers)
+    return workers
+
 def _centered(arr, newshape):
     # Return the center newshape portion of the array.
     newshape = np.asarray(newshape)
@@ -72,6 +90,301 @@ def _centered(arr, newshape):
     myslice = [slice(startind[k], endind[k]) for k in range(len(endind))]
     return arr[tuple(myslice)]
 
+def _updatePlain(x, factor):
+    #x *= factor, returns the squared norms of the change and of the old x (slab of RLEngine.run)
+    #Slice by slice, so that the extra passes for the norms stay in the cache
+    change, old = 0., 0.
+    for xk, fk in zip(x, factor):
+        old += float(np.vdot(xk, xk))
+        dk = xk*fk
+        xk -= dk
+        change += float(np.vdot(xk, xk))
+        xk[...] = dk
+    return change, old
+
+def _updateAccelerated(x, factor, y, xprev, g):
+    #x_new = y*factor, g = x_new - y, xprev = old x, returns the squared norms of the change and of the old x
+    change, old = 0., 0.
+    for xk, fk, yk, xpk, gk in zip(x, factor, y, xprev, g):
+        xpk[...] = xk
+        np.multiply(yk, fk, out=xk)
+        np.subtract(xk, yk, out=gk)
+        np.subtract(xk, xpk, out=fk)
+        change += float(np.vdot(fk, fk))
+        old += float(np.vdot(xpk, xpk))
+    return change, old
+
+def _tvDivergence(x, eps=1e-4):
+    #div(grad x/|grad x|) of the total variation regularisation, with eps against division by 0
+    grad = np.gradient(x)
+    if x.ndim == 1:
+        grad = [grad]
+    norm = np.sqrt(sum(g**2 for g in grad) + eps**2)
+    return sum(np.gradient(g/norm, axis=a) for a, g in enumerate(grad))
+
+class PSFCache():
+    '''LRU cache of the psf spectra RLEngine needs, keyed by psf content (sha1), padded shape and dtype.
+
+    Entries are evicted least recently used first once they take more than maxbytes. With cachedir set the
+    spectra are also stored there as .npy files and reloaded from there in later sessions (or other processes).
+    The least recently written files are removed once the files in cachedir take more than maxdiskbytes.
+    The returned spectra are read-only and shared between engines.
+    '''
+    def __init__(self, maxbytes=2**30, cachedir=None, maxdiskbytes=2**32):
+        self.maxbytes = maxbytes
+        self.cachedir = cachedir
+        self.maxdiskbytes = maxdiskbytes
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def spectra(self, psf, fshape, dtype='float32', workers=-1):
+        '''Return (psf_fft, psf_reverse_conj_fft) of psf zero padded to fshape'''
+        psf = np.ascontiguousarray(psf, dtype=dtype)
+        digest = hashlib.sha1(psf.tobytes() + str(psf.shape).encode()).hexdigest()
+        key = (digest, tuple(fshape), psf.dtype.str)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        spectra = self._load(key)
+        if spectra is None:
+            if debug is True: print(clrmsg.DEBUG, "Calculating psf spectra for padded shape", fshape)
+            axes = tuple(range(psf.ndim))
+            psf_reverse_i = (slice(None, None, -1),) * psf.ndim
+            spectra = (
+                scipy.fft.rfftn(psf, fshape, axes, workers=workerCount(workers)),
+                scipy.fft.rfftn(psf[psf_reverse_i].conj(), fshape, axes, workers=workerCount(workers)))
+            self._save(key, spectra)
+        for spectrum in spectra:
+            spectrum.flags.writeable = False
+        self._entries[key] = spectra
+        while len(self._entries) > 1 and sum(a.nbytes + b.nbytes for a, b in self._entries.values()) > self.maxbytes:
+            self._entries.popitem(last=False)
+        return spectra
+
+    def _files(self, key):
+        name = "psf_{0}_{1}_{2}".format(key[0][:16], 'x'.join(str(n) for n in key[1]), np.dtype(key[2]).name)
+        return [os.path.join(self.cachedir, name + suffix + '.npy') for suffix in ('', '_reverse')]
+
+    def _load(self, key):
+        if self.cachedir is None:
+            return None
+        files = self._files(key)
+        if not all(os.path.isfile(fn) for fn in files):
+            return None
+        if debug is True: print(clrmsg.DEBUG, "Loading psf spectra:", files[0])
+        return tuple(np.load(fn) for fn in files)
+
+    def _save(self, key, spectra):
+        if self.cachedir is None:
+            return
+        os.makedirs(self.cachedir, exist_ok=True)
+        for fn, spectrum in zip(self._files(key), spectra):
+            #Write to a temporary file first, other processes might load the same spectrum concurrently
+            tmp = fn + '.{0}.tmp'.format(os.getpid())
+            with open(tmp, 'wb') as f:
+                np.save(f, spectrum)
+            os.replace(tmp, fn)
+        self._prune(keep=self._files(key))
+
+    def _prune(self, keep=()):
+        #Remove the oldest spectra files until the cache directory is below maxdiskbytes
+        files = []
+        for name in os.listdir(self.cachedir):
+            fn = os.path.join(self.cachedir, name)
+            if name.startswith('psf_') and name.endswith('.npy') and fn not in keep:
+                try:
+                    stat = os.stat(fn)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, fn))
+        total = sum(size for mtime, size, fn in files) + sum(os.path.getsize(fn) for fn in keep if os.path.isfile(fn))
+        for mtime, size, fn in sorted(files):
+            if total <= self.maxdiskbytes:
+                break
+            try:
+                os.remove(fn)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        self._entries.clear()
+        _readPSF.cache_clear()
+
+#Module wide cache used by doRLDeconvolution7 and the tiled deconvolution, set psfCache.cachedir to keep the
+#spectra on disk (DeconvolutionQueue jobs use defaultCacheDir())
+psfCache = PSFCache()
+
+def defaultCacheDir():
+    '''Per user directory for the psf spectra on disk (LOCALAPPDATA on Windows, ~/Library/Caches on macOS,
+    XDG_CACHE_HOME or ~/.cache otherwise)'''
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser(os.path.join('~', 'Library', 'Caches'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache')))
+    return os.path.join(base, '3DCT', 'psfspectra')
+
+def readPSF(psfdatapath):
+    '''psf image as float32, the file is only read again when it changed. Arrays (e.g. from psfModel) are passed on.'''
+    if isinstance(psfdatapath, np.ndarray):
+        return np.asarray(psfdatapath, dtype='float32')
+    stat = os.stat(psfdatapath)
+    return _readPSF(os.path.abspath(psfdatapath), stat.st_mtime_ns, stat.st_size)
+
+@lru_cache(maxsize=16)
+def _readPSF(psfdatapath, mtime, size):
+    psf = _convertAndNormalise(tf.imread(psfdatapath), False)
+    psf.flags.writeable = False
+    return psf
+
+class RLEngine():
+    '''Richardson-Lucy deconvolution engine, same algorithm as doRLDeconvolution7 (based on DeconvolutionLab2)
+
+    The psf spectra and the zero padded work buffer are computed/allocated once per data shape and psf, so the
+    engine can be reused for several stacks of the same shape. Every iteration then only needs the spectrum
+    returned by rfftn and the padded result of irfftn (scipy.fft has no output arrays) on top of the estimate,
+    the data and the padded buffer, i.e. a fixed multiple of the padded volume.
+
+    dtype: 'float32' (default, half the memory and faster FFTs) or 'float64'
+    workers: number of threads for the FFTs and the element-wise updates, -1 = all cores (see workerCount)
+    cache: PSFCache to take the psf spectra from (e.g. the module wide psfCache), None = always calculate them
+    Use close() or a with statement to release the threads.
+    '''
+    def __init__(self, datashape, psf, dtype='float32', workers=-1, cache=None):
+        self.dtype = np.dtype(dtype)
+        self.workers = workerCount(workers)
+        self.datashape = tuple(datashape)
+        psf = np.asarray(psf, dtype=self.dtype)
+
+        s1 = self.datashape
+        s2 = psf.shape
+        shape = [(s1[i] + s2[i] - 1) for i in range(len(s1))]
+        self.fshape = tuple(scipy.fft.next_fast_len(shape[a], True) for a in range(len(shape)))
+        self.axes = tuple(range(len(s1)))
+
+        #Precalculated psf_fft and fft of the reversed (conjugated) psf for the correlation
+        if cache is not None:
+            self.psf_fft, self.psf_reverse_conj_fft = cache.spectra(psf, self.fshape, self.dtype, self.workers)
+        else:
+            psf_reverse_i = (slice(None, None, -1),) * psf.ndim
+            self.psf_fft = scipy.fft.rfftn(psf, self.fshape, self.axes, workers=self.workers)
+            self.psf_reverse_conj_fft = scipy.fft.rfftn(psf[psf_reverse_i].conj(), self.fshape, self.axes, workers=self.workers)
+
+        #Data sits at the start of the zero padded buffer, the result of mode='same' in the centre of the full convolution
+        self._dataslice = tuple(slice(0, n) for n in s1)
+        start = [(shape[i] - s1[i]) // 2 for i in range(len(s1))]
+        self._sameslice = tuple(slice(start[i], start[i] + s1[i]) for i in range(len(s1)))
+
+        self._padded = np.zeros(self.fshape, dtype=self.dtype)
+
+        #numpy ufuncs release the GIL, so the element-wise updates are split into slabs along the first axis
+        self._pool = ThreadPoolExecutor(self.workers) if self.workers > 1 else None
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _slabs(self, func, *arrays):
+        #func(*slabs of arrays) over slabs of the first axis, threaded, returns the list of results
+        n = arrays[0].shape[0]
+        if self._pool is None or n < 2:
+            return [func(*arrays)]
+        bounds = np.linspace(0, n, min(self.workers, n) + 1).astype(int)
+        slabs = [slice(bounds[k], bounds[k+1]) for k in range(len(bounds) - 1)]
+        return [future.result() for future in [self._pool.submit(func, *[a[sl] for a in arrays]) for sl in slabs]]
+
+    def _ufunc(self, ufunc, a, b, out):
+        #ufunc(a, b, out=out), threaded over slabs of the first axis
+        self._slabs(lambda a, b, out: ufunc(a, b, out=out), a, b, out)
+
+    def _convolve(self, kernel_fft):
+        #Convolution of the padded buffer with the kernel, returns the full result (mode='same' part at self._sameslice)
+        x_fft = scipy.fft.rfftn(self._padded, axes=self.axes, workers=self.workers)
+        self._ufunc(np.multiply, x_fft, kernel_fft, x_fft)
+        return scipy.fft.irfftn(x_fft, self.fshape, self.axes, workers=self.workers, overwrite_x=True)
+
+    def _factor(self, data, x, tv):
+        #RL correction factor of the estimate x, a view into the irfftn result (x_new = x*factor)
+        padded = self._padded[self._dataslice]
+        #Hx = scipy.signal.convolve(xn, psf_np,mode='same', method='fft')
+        padded[...] = x
+        Hx = self._convolve(self.psf_fft)[self._sameslice]
+        #yhx goes straight into the padded buffer for the correlation
+        self._ufunc(np.divide, data, Hx, padded)
+        del Hx
+
+        #correlation of the result with psf (note that is not a convolution)
+        #htyhx = scipy.signal.correlate(yhx, psf_np, mode='same', method='fft')
+        htyhx = self._convolve(self.psf_reverse_conj_fft)[self._sameslice]
+        if tv:
+            #RL-TV (Dey et al. 2006), the denominator is kept positive for too large tv weights
+            htyhx /= np.maximum(1 - tv*_tvDivergence(x), 1e-3)
+        return htyhx
+
+    def run(self, data, niter, callback=None, estimate=None, accelerate=False, tv=0., tol=None):
+        '''Deconvolve data (shape datashape) with up to niter iterations and return the estimate.
+
+        estimate: optional start estimate (default: the data), it is updated in place if it has the engine dtype.
+        accelerate: Biggs-Andrews vector extrapolation, each RL step starts from the estimate extrapolated along
+            the last step. Needs 4 more buffers of the data size and typically reaches the same result as plain RL in
+            a fraction of the iterations.
+        tv: weight of the total variation regularisation (RL-TV, Dey et al. 2006), e.g. 0.002, 0 = plain RL
+        tol: stop once the relative change |x(i)-x(i-1)|/|x(i-1)| of the estimate falls below tol
+        callback(i, change) is called after every iteration i (1 based) with the relative change, returning False
+        stops the iterations. The relative changes are also kept in self.changes.
+        '''
+        data = np.asarray(data, dtype=self.dtype)
+        if data.shape != self.datashape:
+            raise ValueError("Data shape {0} does not match the engine shape {1}".format(data.shape, self.datashape))
+        xn = np.array(data) if estimate is None else np.asarray(estimate, dtype=self.dtype)
+        self.changes = []
+        if accelerate:
+            y = np.empty_like(xn)
+            xprev = np.empty_like(xn)
+            g1, g2 = np.empty_like(xn), np.empty_like(xn) #last and previous RL step (x(i+1) - y(i))
+        for i in range(niter):
+            if not accelerate:
+                htyhx = self._factor(data, xn, tv)
+                sums = self._slabs(_updatePlain, xn, htyhx)
+                del htyhx
+            else:
+                alpha = 0.
+                if i >= 2:
+                    alpha = float(np.clip(np.vdot(g1, g2)/max(np.vdot(g2, g2), np.finfo(self.dtype).tiny), 0, 1))
+                #y = xn + alpha*(xn - xprev), kept non-negative
+                if alpha > 0:
+                    self._slabs(lambda y, x, xp: np.maximum(x + alpha*(x - xp), 0, out=y), y, xn, xprev)
+                else:
+                    y[...] = xn
+                htyhx = self._factor(data, y, tv)
+                g1, g2 = g2, g1
+                sums = self._slabs(_updateAccelerated, xn, htyhx, y, xprev, g1)
+                del htyhx
+            change = np.sqrt(sum(num for num, den in sums)/max(sum(den for num, den in sums), np.finfo(float).tiny))
+            self.changes.append(change)
+            if debug is True: print(clrmsg.DEBUG, "RL iteration {0}: relative change {1:.3g}".format(i + 1, change))
+
+            if callback is not None and callback(i + 1, change) is False:
+                if debug is True: print(clrmsg.DEBUG, "Deconvolution stopped after iteration", i + 1)
+                break
+            if tol is not None and change < tol:
+                if debug is True: print(clrmsg.DEBUG, "Deconvolution converged after iteration", i + 1)
+                break
+        return xn
+
+
 def doRLDeconvolution(datapath , psfdatapath , niter=0, qtprocessbar=None):
     #Internal class to handle progress bar
 
@@ -519,16 +832,41 @@ def doRLDeconvolution5(datapath , psfdatapath , niter=0, qtprocessbar=None):
         if debug is True: print(clrmsg.DEBUG, "Completed deconvolution, file saved: ", fname0)
 
 
-def doRLDeconvolution7(datapath , psfdatapath , niter=0, qtprocessbar=None):
+#Data types of the saved deconvolution results
+outputTypes = ('uint8', 'uint16', 'float32')
+
+def _writeResult(fname, data, outputdtype='uint8'):
+    '''Write the deconvolution result page by page. uint8 and uint16 are scaled from min..max of data to the full
+    integer range, float32 keeps the values (e.g. for beadPos.getzGauss).'''
+    outputdtype = np.dtype(outputdtype)
+    pages = data if data.ndim == 3 else [data]
+    if outputdtype.kind == 'u':
+        vmin = min(float(page.min()) for page in pages)
+        vmax = max(float(page.max()) for page in pages)
+        imax = np.iinfo(outputdtype).max
+        scale = imax/(vmax - vmin) if vmax > vmin else 0.
+        convert = lambda page: np.clip(np.rint((page - vmin)*scale), 0, imax).astype(outputdtype)
+    else:
+        convert = lambda page: np.asarray(page, dtype=outputdtype)
+    tf.imwrite(fname, (convert(page) for page in pages), shape=data.shape, dtype=outputdtype)
+
+def doRLDeconvolution7(datapath , psfdatapath , niter=0, qtprocessbar=None, dtype='float32', workers=-1,
+        accelerate=False, tv=0., tol=None, callback=None, outputdtype='uint8'):
     '''RL deconvolution based in DeconvolutionLab2 with optional parameter for normalising inputs
     Reversed engineered convolution and correlation for faster processing
     https://github.com/scipy/scipy/blob/v1.7.1/scipy/signal/signaltools.py#L1293-L1413
     for mode='same', method='fft', fftconvolution()
     normaliseinputs set to false
+    The iterations run in RLEngine, in float32 unless dtype='float64', with workers threads (-1 = all cores)
+    accelerate, tv, tol: accelerated RL, RL-TV weight and early stopping, see RLEngine.run (niter is then the maximum)
+    callback(i, change) is called after every iteration, returning False cancels the deconvolution (nothing is saved)
+    outputdtype: 'uint8' (default), 'uint16' (both scaled to the full range) or 'float32' (unscaled result)
+    Returns the path of the saved file, None if nothing was saved.
     '''
+    if str(outputdtype) not in outputTypes:
+        print(clrmsg.ERROR, "Output data type must be one of", outputTypes)
+        return None
 
-    #no need to swap inputs in mode='same'
-    
     #Estimate progress iterations
     nProgrIter = 2*niter + 5 #Check if ok
     progr0 = _progrBarHandle(qtprocessbar, nProgrIter) #Sets up
@@ -536,82 +874,512 @@ def doRLDeconvolution7(datapath , psfdatapath , niter=0, qtprocessbar=None):
     normaliseinputs=False
 
     #Read data
-    if os.path.isfile(datapath) is True and os.path.isfile(psfdatapath) is True and niter>0:
-        if debug is True: print(clrmsg.DEBUG, "Loading images: ", datapath," , ",psfdatapath)
+    #psfdatapath can also be the psf itself, e.g. generated with psfModel
+    psfIsArray = isinstance(psfdatapath, np.ndarray)
+    if os.path.isfile(datapath) is True and (psfIsArray or os.path.isfile(psfdatapath) is True) and niter>0:
+        if debug is True: print(clrmsg.DEBUG, "Loading images: ", datapath," , ","psf array" if psfIsArray else psfdatapath)
 
         data_np = tf.imread(datapath)
-        psf_np = tf.imread(psfdatapath)
 
         progr0.increment() #1
 
-        #Convert and normalise
+        #Convert and normalise, the psf (float32) and its spectra come from the cache for repeated runs
         data_np_norm = _convertAndNormalise(data_np,normaliseinputs)
-        psf_np_norm = _convertAndNormalise(psf_np, normaliseinputs)
-
-        s1 = data_np_norm.shape
-        s2 = psf_np_norm.shape
-
-        shape = [(s1[i] + s2[i] - 1) for i in range(data_np_norm.ndim)]
-        fshape = [scipy.fft.next_fast_len(shape[a], True) for a in range(len(shape))]
-
-        #scipy.fft routines need to axes to be provided otherwise they only do FFT in last axes
-        #https://docs.scipy.org/doc/scipy/reference/generated/scipy.fft.rfftn.html
-        axes = [i for i in range(data_np_norm.ndim)]
+        psf_np_norm = readPSF(psfdatapath)
 
         progr0.increment() #2
 
-        #Precalculated psf_fft
-        psf_fft= scipy.fft.rfftn(psf_np_norm,fshape, axes)
+        with RLEngine(data_np_norm.shape, psf_np_norm, dtype, workers, psfCache) as engine:
 
-        #and precalculate psfconjugate
-        psf_reverse_i = (slice(None, None, -1),) * psf_np_norm.ndim
-        psf_reverse_conj= psf_np_norm[psf_reverse_i].conj()
-        psf_reverse_conj_fft = scipy.fft.rfftn( psf_reverse_conj,fshape, axes)
+            progr0.increment() #3
 
-        #Precalculate fslice (used to fix image sizes after using fast_len method)
-        fslice = tuple([slice(sz) for sz in shape])
-
-        progr0.increment() #3
+            cancelled = []
+            def iterationDone(i, change):
+                #Two progress steps per iteration as before (convolution and correlation)
+                progr0.increment()
+                progr0.increment()
+                if callback is not None and callback(i, change) is False:
+                    cancelled.append(i)
+                    return False
 
-        xn1 = np.array(data_np_norm) #initialize copy
-        for i in range(niter):
-            xn=xn1
+            xn1 = engine.run(data_np_norm, niter, iterationDone, accelerate=accelerate, tv=tv, tol=tol)
 
-            #Hx = scipy.signal.convolve(xn, psf_np,mode='same', method='fft')
-            xn_fft = scipy.fft.rfftn(xn,fshape, axes)
-            ret = scipy.fft.irfftn(xn_fft * psf_fft, fshape, axes)
-            #using fast_len, so fix sizes
-            #fslice = tuple([slice(sz) for sz in shape])
-            Hx0 = ret[fslice]
-            Hx = _centered(Hx0, s1).copy() #Fix shape as in mode='same'
-
-            yhx = np.divide(data_np_norm,Hx)
-
-            progr0.increment()
-
-            #correlation of the result with psf (note that is not a convolution)
-            #htyhx = scipy.signal.correlate(yhx, psf_np, mode='same', method='fft')
-            yhx_fft = scipy.fft.rfftn(yhx,fshape, axes)
-            ret = scipy.fft.irfftn(yhx_fft * psf_reverse_conj_fft, fshape, axes)
-            #using fast_len, so fix sizes
-            #fslice = tuple([slice(sz) for sz in shape])
-            htyhx0 = ret[fslice]
-            htyhx = _centered(htyhx0, s1).copy() #Fix shape as in mode='same'
+        if cancelled:
+            if debug is True: print(clrmsg.DEBUG, "Deconvolution cancelled after iteration", cancelled[0])
+            progr0.setmax()
+            return None
 
-            xn1 = np.multiply(xn, htyhx)
-
-            progr0.increment()
-
-        data_deconv_norm_256 = _convertAndNormalise(xn1,True)*256
-        data_deconv_uint8 = data_deconv_norm_256.astype('uint8')
-        
         progr0.increment() #4
 
-        #Save data
+        #Save data, converted page by page
         fpath,fname = os.path.split(datapath)
         fname0 = os.path.join(fpath, "DeconvRL"+str(niter)+"it_"+fname)
-        tf.imsave(fname0 ,data_deconv_uint8)
+        _writeResult(fname0, xn1, outputdtype)
 
         progr0.setmax()
  
         if debug is True: print(clrmsg.DEBUG, "Completed deconvolution, file saved: ", fname0)
+        return fname0
+
+
+def _queueJob(jobid, datapath, psfdatapath, niter, options, progress, cancel, cachedir):
+    #Runs in the process pool of DeconvolutionQueue, reports (jobid, iteration, relative change) through progress.
+    #The worker processes only live as long as the batch, the psf spectra are shared through the disk cache.
+    if cachedir:
+        psfCache.cachedir = cachedir
+    def callback(i, change):
+        progress.put((jobid, i, float(change)))
+        return not cancel.is_set()
+    fname = doRLDeconvolution7(datapath, psfdatapath, niter, callback=callback, **options)
+    if fname is None and not cancel.is_set():
+        raise ValueError("Deconvolution failed, check the data and psf files")
+    return fname
+
+def _queueTiledJob(jobid, datapath, psfdatapath, niter, options, progress, cancel):
+    #Runs in the thread of DeconvolutionQueue, the tiles are deconvolved in the process pool of deconvolveTiled.
+    #Reports the finished tiles as iterations, there is no relative change (nan).
+    def callback(n, ntiles):
+        progress.put((jobid, niter*n//ntiles, float('nan')))
+        return not cancel.is_set()
+    fname = doRLDeconvolutionTiled(datapath, psfdatapath, niter, callback=callback, **options)
+    if fname is None and not cancel.is_set():
+        raise ValueError("Deconvolution failed, check the data and psf files")
+    return fname
+
+class DeconvolutionQueue(QtCore.QObject):
+    '''Runs doRLDeconvolution7 jobs (one data file each) in a background process pool.
+    Tiled jobs (doRLDeconvolutionTiled) run one after the other in a background thread, each of them deconvolves
+    its tiles in its own process pool.
+
+    Progress is collected from the worker processes by a QTimer in the thread of the queue (the GUI thread) and
+    emitted as signals, so the GUI stays responsive. Every output is written by its job as soon as it is done.
+    processes: number of jobs running at the same time, takes effect when the queue is idle.
+    cachedir: directory of the psf spectra cache (see PSFCache) shared by all jobs and sessions, so a psf/shape
+        combination is only transformed once. Default defaultCacheDir(), False disables the disk cache.
+
+    Signals:
+        progress(int): overall progress in % of all iterations of the current batch
+        change(str, int, float): data path, iteration and relative change of the estimate (see RLEngine.run) of the
+            last reported iteration, jobs with early stopping (tol) end when it drops below tol. Not emitted for
+            tiled jobs, they always run all iterations
+        fileFinished(str, str): data path and path of the saved result
+        fileFailed(str, str): data path and error message ('Cancelled' for cancelled jobs)
+        finished(): all jobs are done
+    '''
+    progress = QtCore.pyqtSignal(int)
+    change = QtCore.pyqtSignal(str, int, float)
+    fileFinished = QtCore.pyqtSignal(str, str)
+    fileFailed = QtCore.pyqtSignal(str, str)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, processes=1, parent=None, cachedir=None):
+        super().__init__(parent)
+        self.processes = processes
+        self.cachedir = defaultCacheDir() if cachedir is None else cachedir
+        self._executor = None
+        self._threads = None
+        self._manager = None
+        self._jobs = {}
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(100)
+        self._timer.timeout.connect(self._poll)
+
+    def add(self, datapath, psfdatapath, niter, tiled=False, **options):
+        '''Queue the deconvolution of datapath, options are passed on to doRLDeconvolution7 (dtype, workers, ...)
+        or with tiled=True to doRLDeconvolutionTiled (tile, processes, workers, ...)'''
+        if self._executor is None:
+            #New batch
+            self._manager = multiprocessing.Manager()
+            self._progress = self._manager.Queue()
+            self._cancel = self._manager.Event()
+            self._executor = ProcessPoolExecutor(self.processes)
+            self._threads = ThreadPoolExecutor(1)
+            self._iterations = {}
+            self._niter = {}
+            self._datapaths = {}
+            self._lastpercent = -1
+        jobid = len(self._niter)
+        if tiled:
+            future = self._threads.submit(
+                _queueTiledJob, jobid, datapath, psfdatapath, niter, options, self._progress, self._cancel)
+        else:
+            future = self._executor.submit(
+                _queueJob, jobid, datapath, psfdatapath, niter, options, self._progress, self._cancel, self.cachedir)
+        self._jobs[future] = (jobid, datapath)
+        self._datapaths[jobid] = datapath
+        self._niter[jobid] = niter
+        self._iterations[jobid] = 0
+        if debug is True: print(clrmsg.DEBUG, "Queued deconvolution of", datapath)
+        self._timer.start()
+
+    def pending(self):
+        '''Number of queued and running jobs'''
+        return len(self._jobs)
+
+    def cancel(self):
+        '''Cancel all queued jobs, running jobs stop after their current iteration. Jobs added afterwards run.'''
+        if self._executor is None:
+            return
+        self._cancel.set()
+        for future in self._jobs:
+            future.cancel()
+        #The cancelled jobs keep the set event, jobs added while they finish get a new one
+        self._cancel = self._manager.Event()
+
+    def wait(self):
+        '''Block until all jobs are done (for use without a Qt event loop)'''
+        while self._executor is not None:
+            self._poll()
+            time.sleep(0.05)
+
+    def _poll(self):
+        #Jobs that are done have put all their progress, so it is read after collecting them
+        done = [future for future in self._jobs if future.done()]
+        changes = {}
+        while True:
+            try:
+                jobid, i, change = self._progress.get_nowait()
+            except Empty:
+                break
+            self._iterations[jobid] = i
+            #Tiled jobs report no change (nan)
+            if not np.isnan(change):
+                changes[jobid] = (i, change)
+        for jobid, (i, change) in sorted(changes.items()):
+            self.change.emit(self._datapaths[jobid], i, change)
+        for future in done:
+            jobid, datapath = self._jobs.pop(future)
+            self._iterations[jobid] = self._niter[jobid]
+            if future.cancelled() or (future.exception() is None and future.result() is None):
+                self.fileFailed.emit(datapath, 'Cancelled')
+            elif future.exception() is not None:
+                print(clrmsg.ERROR, "Deconvolution of", datapath, "failed:", future.exception())
+                self.fileFailed.emit(datapath, str(future.exception()))
+            else:
+                self.fileFinished.emit(datapath, future.result())
+        percent = int(100*sum(self._iterations.values())/max(1, sum(self._niter.values())))
+        if percent != self._lastpercent:
+            self._lastpercent = percent
+            self.progress.emit(percent)
+        if not self._jobs:
+            self._timer.stop()
+            self._executor.shutdown()
+            self._threads.shutdown()
+            self._manager.shutdown()
+            self._executor = None
+            self._threads = None
+            self._manager = None
+            self.finished.emit()
+
+
+def tileGrid(shape, tile, overlap):
+    '''Split the last two axes (y,x) of shape into tiles.
+
+    Returns a list of (outer, weights) per tile: outer are the slices of the tile including the overlap
+    on the sides facing other tiles, weights the 2D blending weights of the tile. Neighbouring tiles share a band
+    of 2*overlap around their boundary. The outer overlap/2 of each tile, where the zero padding of the tile edge
+    disturbs RL most, is dropped (weight 0), the remaining central band of width overlap is crossfaded linearly
+    (the weights of both tiles add up to 1). Tiles must be larger than 2*overlap.
+    '''
+    grid = []
+    for ny, ty, oy in zip(shape[-2:], tile, overlap):
+        if ty <= 2*oy:
+            raise ValueError("Tile size {0} must be larger than twice the overlap {1}".format(ty, oy))
+        ramp = np.clip((np.arange(2*oy, dtype='float32') + 0.5 - oy/2.)/max(oy, 1), 0, 1)
+        axis = []
+        for a0 in range(0, ny, ty):
+            a1 = min(a0 + ty, ny)
+            b0, b1 = max(a0 - oy, 0), min(a1 + oy, ny)
+            w = np.ones(b1 - b0, dtype='float32')
+            if b0 > 0:
+                n = min(2*oy, len(w))
+                w[:n] = np.minimum(w[:n], ramp[:n])
+            if b1 < ny:
+                n = min(2*oy, len(w))
+                w[len(w)-n:] = np.minimum(w[len(w)-n:], ramp[::-1][2*oy-n:])
+            axis.append((slice(b0, b1), w))
+        grid.append(axis)
+    return [((Ellipsis, sy, sx), wy[:, None]*wx[None, :]) for sy, wy in grid[0] for sx, wx in grid[1]]
+
+def _deconvolveTile(tile, psf, niter, dtype, workers, accelerate, tv):
+    #Runs in the process pool, tile is the tile data or (path, outer) of a memory mappable file
+    if isinstance(tile, tuple):
+        path, outer = tile
+        tile = tf.memmap(path, mode='r')[outer]
+    #Tiles of the same shape share the spectra in the psfCache of the worker process
+    with RLEngine(tile.shape, psf, dtype, workers, psfCache) as engine:
+        return engine.run(tile, niter, accelerate=accelerate, tv=tv)
+
+def deconvolveTiled(data, psf, niter, tile=(512, 512), overlap=None, processes=None, workers=1, dtype='float32',
+        out=None, callback=None, datapath=None, accelerate=False, tv=0.):
+    '''Block-wise RL deconvolution of data ([y,x] or [z,y,x]) in overlapping xy tiles, one tile per process.
+
+    Each tile keeps the full z range and is deconvolved on its own with RLEngine, the results are blended with the
+    linear weights of tileGrid. overlap defaults to twice the psf extent in y,x. Away from the tile seams (further
+    than the overlap) the result is the same as whole-volume RL (float32 rounding). In the seam bands it deviates
+    by less than 1e-3 of the output range for up to 50 iterations (gaussian psf, default overlap); increase overlap
+    for more iterations or psfs with long tails.
+
+    Memory of every process is bounded by the tile size, the main process holds out (float32, data.shape) and the
+    tiles in flight. With datapath set to the (uncompressed) tiff file of data, the processes map their tiles from
+    the file themselves instead of receiving copies.
+    processes: number of processes (None = one per core), workers: threads per process
+    accelerate, tv: see RLEngine.run. There is no early stopping, all tiles need the same number of iterations.
+    callback(n, ntiles) is called after every finished tile, returning False cancels the remaining tiles and
+    deconvolveTiled returns None.
+    '''
+    psf = np.asarray(psf, dtype=dtype)
+    if overlap is None:
+        overlap = tuple(2*n for n in psf.shape[-2:])
+    tiles = tileGrid(data.shape, tile, overlap)
+    if out is None:
+        out = np.zeros(data.shape, dtype='float32')
+    else:
+        out[...] = 0
+    weightsum = np.zeros(data.shape[-2:], dtype='float32')
+    if processes is None:
+        processes = min(len(tiles), workerCount(-1))
+    if debug is True: print(clrmsg.DEBUG, "Deconvolving", len(tiles), "tiles in", processes, "processes")
+
+    def source(outer):
+        if datapath is not None:
+            return (datapath, outer)
+        return np.asarray(data[outer], dtype=dtype)
+
+    cancelled = False
+    with ProcessPoolExecutor(processes) as executor:
+        pending = {}
+        todo = list(tiles)
+        done = 0
+        while (todo or pending) and not cancelled:
+            #Only 2 tiles per process in flight, so that the tile copies do not pile up
+            while todo and len(pending) < 2*processes:
+                outer, weights = todo.pop(0)
+                pending[executor.submit(_deconvolveTile, source(outer), psf, niter, dtype, workers, accelerate, tv)] = (outer, weights)
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                outer, weights = pending.pop(future)
+                out[outer] += future.result()*weights
+                weightsum[outer[1:]] += weights
+                done += 1
+                if callback is not None and callback(done, len(tiles)) is False:
+                    cancelled = True
+        #Tiles in flight are finished by the executor, the others are dropped
+        for future in pending:
+            future.cancel()
+    if cancelled:
+        if debug is True: print(clrmsg.DEBUG, "Tiled deconvolution cancelled after", done, "tiles")
+        return None
+    out /= weightsum
+    return out
+
+def doRLDeconvolutionTiled(datapath , psfdatapath , niter=0, qtprocessbar=None, tile=(512, 512), overlap=None,
+        processes=None, workers=1, dtype='float32', accelerate=False, tv=0., outputdtype='uint8', callback=None):
+    '''Tiled version of doRLDeconvolution7 for volumes that do not fit into memory (see deconvolveTiled)
+
+    The blended result is accumulated in a temporary float32 file next to the output, uncompressed input files
+    are memory mapped.
+    callback(n, ntiles) is called after every finished tile, returning False cancels the deconvolution (nothing is
+    saved, returns None).
+    '''
+    if str(outputdtype) not in outputTypes:
+        print(clrmsg.ERROR, "Output data type must be one of", outputTypes)
+        return None
+    psfIsArray = isinstance(psfdatapath, np.ndarray)
+    if os.path.isfile(datapath) is True and (psfIsArray or os.path.isfile(psfdatapath) is True) and niter>0:
+        if debug is True: print(clrmsg.DEBUG, "Loading images: ", datapath," , ","psf array" if psfIsArray else psfdatapath)
+        psf_np_norm = readPSF(psfdatapath)
+        try:
+            data_np = tf.memmap(datapath, mode='r')
+            mappedpath = datapath
+        except ValueError:
+            if debug is True: print(clrmsg.DEBUG, "Image data not memory-mappable, loading it")
+            data_np = tf.imread(datapath)
+            mappedpath = None
+
+        fpath,fname = os.path.split(datapath)
+        fname0 = os.path.join(fpath, "DeconvRL"+str(niter)+"it_"+fname)
+        ntiles = len(tileGrid(data_np.shape, tile, [2*n for n in psf_np_norm.shape[-2:]] if overlap is None else overlap))
+        progr0 = _progrBarHandle(qtprocessbar, ntiles + 2)
+
+        def tileDone(n, ntiles):
+            progr0.increment()
+            if callback is not None:
+                return callback(n, ntiles)
+
+        with tempfile.TemporaryDirectory(dir=fpath) as tmpdir:
+            out = np.memmap(os.path.join(tmpdir, 'accumulator.raw'), dtype='float32', mode='w+', shape=data_np.shape)
+            result = deconvolveTiled(
+                data_np, psf_np_norm, niter, tile, overlap, processes, workers, dtype,
+                out=out, callback=tileDone, datapath=mappedpath, accelerate=accelerate, tv=tv)
+            cancelled = result is None
+            if not cancelled:
+                progr0.increment()
+                _writeResult(fname0, out, outputdtype)
+            del out, result
+
+        progr0.setmax()
+        if cancelled:
+            return None
+        if debug is True: print(clrmsg.DEBUG, "Completed tiled deconvolution, file saved: ", fname0)
+        return fname0
+
+
+#Deconvolved crop around one marker/POI: point is the (x, y[, z]) stack coordinate it was cut around, offset the
+#(y0, x0) position of data[:, 0, 0] in the stack, data the deconvolved crop [z,y,x] (full z range)
+ROICrop = namedtuple('ROICrop', ['point', 'offset', 'data'])
+
+def pointsFromCSV(csv_file, delimiter="\t", sniff=False):
+    '''Read the (x, y, z) coordinates of the first three columns of a csv file exported by csvHandler.model2csv.
+    Rows that do not start with a number (header) are skipped, z is None if the column is missing or empty.'''
+    return _points(csvHandler.csv2list(csv_file, delimiter, sniff))
+
+def pointsFromModel(model):
+    '''(x, y, z) coordinates of the rows of a correlation table model (QStandardItemModel, columns x, y, z)'''
+    return _points([
+        [str(model.data(model.index(row, column))) for column in range(min(3, model.columnCount()))]
+        for row in range(model.rowCount())])
+
+def _points(rows):
+    points = []
+    for row in rows:
+        try:
+            x, y = float(row[0]), float(row[1])
+        except (IndexError, ValueError):
+            continue
+        try:
+            z = float(row[2])
+        except (IndexError, ValueError):
+            z = None
+        points.append((x, y, z))
+    return points
+
+def roiBoxes(points, shape, radius=(16, 16), pad=(8, 8)):
+    '''Crop boxes around points (x, y, ...) in a stack of shape ([z,]y,x).
+
+    Returns (outer, inner) per point: outer are the slices of the padded crop in the stack (clipped to the stack),
+    inner the slices of the wanted crop (radius around the point) inside the padded crop. None for points outside
+    the stack.'''
+    boxes = []
+    for point in points:
+        center = (int(round(point[1])), int(round(point[0])))
+        if not all(0 <= c < n for c, n in zip(center, shape[-2:])):
+            boxes.append(None)
+            continue
+        outer, inner = [Ellipsis], [Ellipsis]
+        for c, n, r, p in zip(center, shape[-2:], radius, pad):
+            a0, a1 = max(c - r, 0), min(c + r + 1, n)
+            b0, b1 = max(a0 - p, 0), min(a1 + p, n)
+            outer.append(slice(b0, b1))
+            inner.append(slice(a0 - b0, a1 - b0))
+        boxes.append((tuple(outer), tuple(inner)))
+    return boxes
+
+def deconvolveROI(data, psf, points, niter, radius=(16, 16), pad=None, processes=None, workers=1, dtype='float32',
+        callback=None, datapath=None, accelerate=False, tv=0.):
+    '''RL deconvolution of sub-volumes around the markers/POIs only, instead of the whole field of view.
+
+    Each crop of radius (y, x) around a point (x, y[, z], e.g. from pointsFromCSV or pointsFromModel) is padded by
+    pad (default twice the psf extent in y,x, see deconvolveTiled), deconvolved on its own in the process pool and
+    cut back to the radius box. Returns a list of ROICrop (None for points outside the stack) in the order of points.
+    beadPos works on the crops with the point shifted by the offset, e.g.
+        z = beadPos.getzGauss(x - crop.offset[1], y - crop.offset[0], crop.data)
+    processes, workers, datapath, accelerate, tv: see deconvolveTiled. callback(n, ncrops) after every crop.
+    '''
+    psf = np.asarray(psf, dtype=dtype)
+    if pad is None:
+        pad = tuple(2*n for n in psf.shape[-2:])
+    boxes = roiBoxes(points, data.shape, radius, pad)
+    todo = [(i, box) for i, box in enumerate(boxes) if box is not None]
+    if len(todo) < len(boxes):
+        print(clrmsg.WARNING, len(boxes) - len(todo), "point(s) outside the image stack skipped")
+    crops = [None]*len(boxes)
+    if not todo:
+        return crops
+    if processes is None:
+        processes = min(len(todo), workerCount(-1))
+    if debug is True: print(clrmsg.DEBUG, "Deconvolving", len(todo), "ROIs in", processes, "processes")
+
+    def source(outer):
+        if datapath is not None:
+            return (datapath, outer)
+        return np.asarray(data[outer], dtype=dtype)
+
+    with ProcessPoolExecutor(processes) as executor:
+        pending = {}
+        done = 0
+        while todo or pending:
+            while todo and len(pending) < 2*processes:
+                i, (outer, inner) = todo.pop(0)
+                pending[executor.submit(_deconvolveTile, source(outer), psf, niter, dtype, workers, accelerate, tv)] = (i, outer, inner)
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i, outer, inner = pending.pop(future)
+                offset = tuple(o.start + n.start for o, n in zip(outer[1:], inner[1:]))
+                crops[i] = ROICrop(tuple(points[i]), offset, np.ascontiguousarray(future.result()[inner], dtype='float32'))
+                done += 1
+                if callback is not None:
+                    callback(done, len(crops))
+    return crops
+
+def doRLDeconvolutionROI(datapath, psfdatapath, points, niter=0, qtprocessbar=None, radius=(16, 16), pad=None,
+        processes=None, workers=1, dtype='float32', accelerate=False, tv=0.):
+    '''deconvolveROI for the image stack datapath and a psf file or array. points is a list of (x, y[, z]), a
+    correlation table model or the path of a csv file exported by csvHandler.model2csv. Returns the list of ROICrop
+    (nothing is written to disk), None on error.'''
+    psfIsArray = isinstance(psfdatapath, np.ndarray)
+    if not (os.path.isfile(datapath) is True and (psfIsArray or os.path.isfile(psfdatapath) is True) and niter>0):
+        print(clrmsg.ERROR, "Image stack or psf not found, or no iterations given")
+        return None
+    if isinstance(points, str):
+        points = pointsFromCSV(points, sniff=True)
+    elif isinstance(points, QtCore.QAbstractItemModel):
+        points = pointsFromModel(points)
+    if debug is True: print(clrmsg.DEBUG, "Loading images: ", datapath," , ","psf array" if psfIsArray else psfdatapath)
+    psf_np_norm = readPSF(psfdatapath)
+    try:
+        data_np = tf.memmap(datapath, mode='r')
+        mappedpath = datapath
+    except ValueError:
+        if debug is True: print(clrmsg.DEBUG, "Image data not memory-mappable, loading it")
+        data_np = tf.imread(datapath)
+        mappedpath = None
+    progr0 = _progrBarHandle(qtprocessbar, max(1, len(points)))
+    crops = deconvolveROI(
+        data_np, psf_np_norm, points, niter, radius, pad, processes, workers, dtype,
+        callback=lambda n, ncrops: progr0.increment(), datapath=mappedpath, accelerate=accelerate, tv=tv)
+    progr0.setmax()
+    return crops
+
+
+def benchmarkWorkers(shape=(64, 256, 256), niter=5, workers=None, dtype='float32'):
+    '''Time RLEngine.run on random data for each thread count in workers (default 1, 2, 4, ... up to all cores).
+
+    Returns a list of (workers, seconds, speedup relative to the first entry).
+    '''
+    if workers is None:
+        ncores = workerCount(-1)
+        workers = [2**k for k in range(ncores.bit_length()) if 2**k < ncores] + [ncores]
+    rng = np.random.default_rng(0)
+    data = rng.random(shape, dtype='float32') + 0.1
+    psf = np.ones((5, 7, 7), dtype='float32')/245.
+    results = []
+    for n in workers:
+        with RLEngine(shape, psf, dtype, n) as engine:
+            engine.run(data, 1) #warm up (fft plans)
+            t0 = time.perf_counter()
+            engine.run(data, niter)
+            seconds = time.perf_counter() - t0
+        results.append((n, seconds, results[0][1]/seconds if results else 1.))
+        print("workers: {0:3d}  {1:8.2f} s  speedup {2:5.2f}".format(*results[-1]))
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Richardson-Lucy deconvolution thread scaling benchmark')
+    parser.add_argument('--shape', type=int, nargs=3, default=[64, 256, 256], help='z y x size of the test volume')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--workers', type=int, nargs='+', help='thread counts to test (default 1, 2, 4, ... all cores)')
+    args = parser.parse_args()
+    benchmarkWorkers(tuple(args.shape), args.iterations, args.workers)
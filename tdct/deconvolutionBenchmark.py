@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the Richardson-Lucy deconvolution (deconvolution.RLEngine / deconvolveTiled).
+
+Synthetic reference volumes (sub-resolution beads on a weak background, convolved with a known Gaussian psf from
+psfModel, Poisson noise) are generated once per size and seed and kept as .npy files in the data directory. Every
+combination of size, thread count, precision, tiling and acceleration runs in a fresh process, so that the peak RSS
+of the case can be measured. Wall time, peak RSS and the reconstruction error (relative L2 norm against the ground
+truth, away from the volume border) are written to a JSON report. Two reports can be compared with --compare.
+
+Usage:
+    python -m tdct.deconvolutionBenchmark --sizes 32x256x256 64x512x512 --workers 1 8 --dtypes float32 float64 \\
+        --tiles 0 256 --iterations 10 --report report.json
+    python -m tdct.deconvolutionBenchmark --compare report_v3.0.0.json report.json
+
+The peak RSS needs the resource module, it is not available on Windows and reported as null there.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy
+import scipy.signal
+from . import clrmsg
+from . import TDCT_debug
+from . import psfModel
+from . import deconvolution
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+debug = TDCT_debug.debug
+
+## Optics of the reference psf (nm)
+voxelsize = (200., 100., 100.)
+optics = dict(na=1.2, wavelength=520.)
+
+
+def referenceVolume(shape, seed=0, datadir=None, beads=None):
+    """Return (data, truth, psf) of the synthetic bead volume of shape (z, y, x).
+
+    beads: number of beads (default: one per 16^3 voxels). With datadir the volumes are stored as .npy files and
+    loaded from there (memory-mapped) next time."""
+    shape = tuple(int(n) for n in shape)
+    psf = psfModel.generate('gaussian', voxelsize, **optics)
+    name = "beads_{0}_s{1}".format('x'.join(str(n) for n in shape), seed)
+    if datadir is not None:
+        files = [os.path.join(datadir, name+suffix) for suffix in ('_data.npy', '_truth.npy')]
+        if all(os.path.isfile(fn) for fn in files):
+            return np.load(files[0], mmap_mode='r'), np.load(files[1], mmap_mode='r'), psf
+    if debug is True: print(clrmsg.DEBUG, "Generating reference volume", name)
+    rng = np.random.default_rng(seed)
+    if beads is None:
+        beads = max(1, int(np.prod(shape)/16**3))
+    truth = np.ones(shape, dtype='float32')
+    position = rng.integers(0, shape, (beads, len(shape)))
+    np.add.at(truth, tuple(position.T), rng.uniform(500, 1000, beads).astype('float32'))
+    blurred = scipy.signal.fftconvolve(truth, psf, mode='same')
+    data = rng.poisson(np.maximum(blurred, 0)).astype('float32') + 0.1
+    if datadir is not None:
+        os.makedirs(datadir, exist_ok=True)
+        for fn, volume in zip(files, (data, truth)):
+            np.save(fn, volume)
+    return data, truth, psf
+
+
+def reconstructionError(estimate, truth, border):
+    """Relative L2 error of estimate against truth, without border voxels on every side"""
+    inner = tuple(slice(b, n - b) for b, n in zip(border, truth.shape))
+    difference = np.asarray(estimate[inner], dtype='float64') - truth[inner]
+    return float(np.linalg.norm(difference)/np.linalg.norm(np.asarray(truth[inner], dtype='float64')))
+
+
+def _peakRSS(who):
+    ## Peak resident set size in MB, ru_maxrss is in kB on Linux and in bytes on macOS
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    return peak/2**20 if sys.platform == 'darwin' else peak/2**10
+
+
+def runCase(case, datadir):
+    """Run one benchmark case (dict with shape, seed, workers, dtype, tile, iterations, accelerate) and return the
+    case with the measured seconds, peak RSS (MB) and errors. Meant to run in its own (fresh) process."""
+    data, truth, psf = referenceVolume(case['shape'], case['seed'], datadir)
+    data = np.array(data)
+    result = dict(case)
+    result['baselineRSS'] = _peakRSS(resource.RUSAGE_SELF) if resource else None
+    ping = time.perf_counter()
+    if case['tile']:
+        estimate = deconvolution.deconvolveTiled(
+            data, psf, case['iterations'], tile=(case['tile'], case['tile']), processes=case['workers'], workers=1,
+            dtype=case['dtype'], accelerate=case['accelerate'])
+    else:
+        with deconvolution.RLEngine(data.shape, psf, case['dtype'], case['workers']) as engine:
+            estimate = engine.run(data, case['iterations'], accelerate=case['accelerate'])
+    result['seconds'] = time.perf_counter() - ping
+    result['peakRSS'] = _peakRSS(resource.RUSAGE_SELF) if resource else None
+    result['peakRSSChildren'] = _peakRSS(resource.RUSAGE_CHILDREN) if resource else None
+    border = [n//2 for n in psf.shape]
+    ## The error of the blurred, noisy data itself is the reference the deconvolution has to beat
+    result['error'] = reconstructionError(estimate, truth, border)
+    result['dataError'] = reconstructionError(data, truth, border)
+    return result
+
+
+def cases(sizes, workers=(1,), dtypes=('float32',), tiles=(0,), iterations=10, accelerate=(False,), seed=0):
+    """All combinations of the settings as list of case dicts, tile 0 = whole volume"""
+    return [
+        dict(shape=tuple(shape), seed=seed, workers=n, dtype=dtype, tile=tile, iterations=iterations, accelerate=acc)
+        for shape, n, dtype, tile, acc in itertools.product(sizes, workers, dtypes, tiles, accelerate)]
+
+
+def run(caselist, datadir=None, report=None):
+    """Run the cases one after the other, each in a fresh process. Returns the report dict and writes it to report
+    (JSON) if given."""
+    if datadir is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        datadir = tmpdir.name
+    ## Reference volumes are generated up front, so their generation does not count towards the peak RSS
+    for shape, seed in sorted(set((case['shape'], case['seed']) for case in caselist)):
+        referenceVolume(shape, seed, datadir)
+    results = []
+    for case in caselist:
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            try:
+                result = executor.submit(runCase, case, datadir).result()
+            except Exception as e:
+                print(clrmsg.ERROR, "Case {0} failed: {1}".format(case, e))
+                result = dict(case, error=None, failed=str(e))
+        _report(result)
+        results.append(result)
+    summary = dict(
+        created=time.strftime('%Y-%m-%d %H:%M:%S'), platform=platform.platform(), python=platform.python_version(),
+        cpus=os.cpu_count(), numpy=np.__version__, scipy=scipy.__version__, voxelsize=voxelsize, optics=optics,
+        cases=results)
+    if report is not None:
+        with open(report, 'w') as f:
+            json.dump(summary, f, indent=1)
+        print(clrmsg.INFO, "Report written to", report)
+    return summary
+
+
+def _key(case):
+    return tuple(json.dumps(case[k]) for k in ('shape', 'seed', 'workers', 'dtype', 'tile', 'iterations', 'accelerate'))
+
+
+def compare(old, new):
+    """Pair the cases of two reports (dicts or JSON files) and return (case, old, new) for the ones in both"""
+    reports = []
+    for report in (old, new):
+        if isinstance(report, str):
+            with open(report) as f:
+                report = json.load(f)
+        reports.append({_key(case): case for case in report['cases']})
+    return [(key, reports[0][key], reports[1][key]) for key in reports[1] if key in reports[0]]
+
+
+def _label(case):
+    return "{0:>14} {1:>3} threads {2} tile {3:>4} {4:>3} it{5}".format(
+        'x'.join(str(n) for n in case['shape']), case['workers'], case['dtype'], case['tile'], case['iterations'],
+        ' acc' if case['accelerate'] else '')
+
+
+def _report(result):
+    if result.get('failed'):
+        return
+    rss = "{0:8.0f} MB".format(result['peakRSS']) if result['peakRSS'] is not None else "       - MB"
+    print(clrmsg.OK, "{0}: {1:7.2f} s {2}  error {3:.3f} (data {4:.3f})".format(
+        _label(result), result['seconds'], rss, result['error'], result['dataError']))
+
+
+def _shape(text):
+    try:
+        return tuple(int(n) for n in text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("size must be given as ZxYxX, e.g. 32x256x256")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the Richardson-Lucy deconvolution on synthetic bead volumes')
+    parser.add_argument('--sizes', type=_shape, nargs='+', default=[(32, 128, 128), (64, 256, 256)], metavar='ZxYxX', help='volume sizes')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1], metavar='NUMBER', help='threads (tiled: processes)')
+    parser.add_argument('--dtypes', nargs='+', default=['float32'], choices=['float32', 'float64'], help='precision')
+    parser.add_argument('--tiles', type=int, nargs='+', default=[0], metavar='NUMBER', help='xy tile size, 0 = whole volume')
+    parser.add_argument('--iterations', type=int, default=10, metavar='NUMBER')
+    parser.add_argument('--accelerate', action='store_true', help='also run the accelerated RL')
+    parser.add_argument('--seed', type=int, default=0, metavar='NUMBER', help='seed of the reference volumes')
+    parser.add_argument('--datadir', metavar='DIR', help='directory for the reference volumes (default: temporary)')
+    parser.add_argument('--report', metavar='FILE', help='JSON report file')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two reports instead of running')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        for key, old, new in compare(*args.compare):
+            if old.get('failed') or new.get('failed'):
+                continue
+            print(clrmsg.INFO, "{0}: time {1:.2f}x  peak RSS {2}  error {3:.3f} -> {4:.3f}".format(
+                _label(new), new['seconds']/old['seconds'],
+                "{0:.2f}x".format(new['peakRSS']/old['peakRSS']) if old.get('peakRSS') and new.get('peakRSS') else '-',
+                old['error'], new['error']))
+        return 0
+    accelerate = (False, True) if args.accelerate else (False,)
+    summary = run(
+        cases(args.sizes, args.workers, args.dtypes, args.tiles, args.iterations, accelerate, args.seed),
+        args.datadir, args.report)
+    return 1 if any(case.get('failed') for case in summary['cases']) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
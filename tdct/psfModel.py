@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Synthetic point spread functions for the deconvolution, instead of a measured PSF tiff.
+
+Two models are available:
+    gaussian:    Gaussian approximation of the widefield/confocal PSF (Zhang et al. 2007, Appl. Opt. 46, 1819)
+    gibsonLanni: scalar Gibson-Lanni model with refractive index mismatch between immersion and sample
+                 (Gibson & Lanni 1991, JOSA A 8, 1601), coverslip as designed
+
+All lengths are in nm, voxel sizes are given as (z, y, x) like the image stacks. The PSF is generated on the
+voxel grid of the data, cropped to the smallest box holding all values above threshold*max (odd sizes, centred on
+the peak) and normalised to sum 1. Results are cached per parameter set.
+
+Usage:
+    from tdct import psfModel, deconvolution
+    >>> psf = psfModel.fromStack('image_stack.tif', 'gibsonLanni', na=1.4, wavelength=520, ni=1.515, ns=1.33)
+    >>> deconvolution.doRLDeconvolution7('image_stack.tif', psf, 10)
+
+The returned arrays are read-only, they are shared through the cache.
+"""
+
+from functools import lru_cache
+import numpy as np
+import scipy.special
+from . import clrmsg
+from . import TDCT_debug
+from . import tiffMeta
+
+debug = TDCT_debug.debug
+
+models = ('gaussian', 'gibsonLanni')
+
+
+def gaussianSigmas(na, wavelength, n=1.515, confocal=False):
+    """Standard deviations (z, xy) in nm of the paraxial Gaussian approximation (Zhang et al. 2007).
+    The confocal PSF (small pinhole, excitation ~ emission wavelength) is the squared widefield PSF."""
+    sigmaXY = 0.21*wavelength/na
+    sigmaZ = 0.66*wavelength*n/na**2
+    if confocal:
+        return sigmaZ/np.sqrt(2), sigmaXY/np.sqrt(2)
+    return sigmaZ, sigmaXY
+
+
+def generate(model, voxelsize, na, wavelength, confocal=False, threshold=1e-3, **params):
+    """Return the PSF (float32, read-only) of model for the voxel size (z, y, x) or (y, x) in nm.
+
+    model: 'gaussian' (params: n, extent) or 'gibsonLanni' (params: ni, ns, depth, extent), see the functions
+    threshold: the PSF is cropped to values above threshold*max
+    """
+    if model not in models:
+        raise ValueError("Unknown PSF model {0}, use one of {1}".format(model, models))
+    if any(size is None or size <= 0 for size in voxelsize):
+        raise ValueError("Voxel size must be known and positive: "+str(voxelsize))
+    return _generate(
+        model, tuple(float(size) for size in voxelsize), float(na), float(wavelength), bool(confocal),
+        float(threshold), tuple(sorted(params.items())))
+
+
+def fromStack(img_path, model='gaussian', na=1.4, wavelength=520., voxelsize=None, **params):
+    """PSF for the image stack img_path with the voxel size from its header (see tiffMeta.voxelSizeNm).
+    voxelsize (z, y, x) in nm overrides the header, e.g. if the z step is missing."""
+    if voxelsize is None:
+        voxelsize = tiffMeta.voxelSizeNm(img_path)
+        if debug is True: print(clrmsg.DEBUG, "Voxel size from header (nm):", voxelsize)
+    return generate(model, voxelsize, na, wavelength, **params)
+
+
+def clearCache():
+    _generate.cache_clear()
+
+
+@lru_cache(maxsize=32)
+def _generate(model, voxelsize, na, wavelength, confocal, threshold, params):
+    if debug is True: print(clrmsg.DEBUG, "Generating {0} PSF for voxel size {1}".format(model, voxelsize))
+    func = gaussian if model == 'gaussian' else gibsonLanni
+    psf = func(voxelsize, na, wavelength, confocal=confocal, **dict(params))
+    if len(voxelsize) == 2:
+        psf = psf[0]
+    psf = _crop(psf, threshold)
+    psf = (psf/psf.sum()).astype('float32')
+    psf.flags.writeable = False
+    return psf
+
+
+def gaussian(voxelsize, na, wavelength, n=1.515, confocal=False, extent=3.):
+    """Gaussian PSF sampled on the voxel grid up to extent standard deviations"""
+    sigmaZ, sigmaXY = gaussianSigmas(na, wavelength, n, confocal)
+    z, y, x = _grid(voxelsize, extent*sigmaZ, extent*sigmaXY)
+    return np.exp(-z**2/(2*sigmaZ**2))*np.exp(-(y**2 + x**2)/(2*sigmaXY**2))
+
+
+def gibsonLanni(voxelsize, na, wavelength, ni=1.515, ns=1.33, depth=0., confocal=False, extent=4., samples=256):
+    """Scalar Gibson-Lanni PSF of a point at depth (nm) below the coverslip in a sample with refractive index ns,
+    imaged with an objective for immersion index ni. The phase over the pupil (radius rho) at defocus dz is
+        W = k*(depth*(sqrt(ns^2 - (na*rho)^2) - sqrt(ni^2 - (na*rho)^2)) + dz*sqrt(ni^2 - (na*rho)^2))
+    and the intensity |int_0^1 J0(k*na*r*rho)*exp(iW)*rho drho|^2 (confocal: squared). The box covers extent
+    Gaussian standard deviations (plus the focal shift in z) around the intensity maximum, which moves away from
+    dz=0 for ns != ni."""
+    if na >= min(ni, ns) and depth != 0:
+        print(clrmsg.WARNING, "NA {0} exceeds the sample refractive index {1}, evanescent part ignored".format(na, ns))
+    k = 2*np.pi/wavelength
+    rho = (np.arange(samples) + 0.5)/samples
+    sin = na*rho
+    phaseDepth = k*depth*(np.sqrt(np.maximum(ns**2 - sin**2, 0)) - np.sqrt(np.maximum(ni**2 - sin**2, 0)))
+    phaseDefocus = k*np.sqrt(np.maximum(ni**2 - sin**2, 0))
+    pupil = lambda dz: np.exp(1j*(phaseDepth[:, None] + phaseDefocus[:, None]*dz[None, :]))*(rho/samples)[:, None]
+
+    sigmaZ, sigmaXY = gaussianSigmas(na, wavelength, ni, confocal)
+    ## The focal shift of the mismatch is at most depth*|ns/ni - 1|, find the maximum on the optical axis (J0(0)=1)
+    reach = extent*sigmaZ + abs(depth*(ns/ni - 1))
+    dzAxis = np.linspace(-reach, reach, 801)
+    center = dzAxis[np.argmax(np.abs(pupil(dzAxis).sum(axis=0)))] if len(voxelsize) == 3 else 0.
+
+    ## The aberrated PSF is elongated, the box reaches as far as the focal shift (cropped afterwards)
+    z, y, x = _grid(voxelsize, reach, extent*sigmaXY)
+    dz = z[:, 0, 0] + center
+    ## Radial profile on a fine r grid, interpolated onto the voxel grid
+    r = np.hypot(y, x)[0]
+    radii = np.linspace(0, r.max(), max(2, int(np.ceil(4*r.max()/min(voxelsize[-2:])))+1))
+    amplitude = scipy.special.j0(k*na*radii[:, None]*rho[None, :]) @ pupil(dz)
+    profile = np.abs(amplitude)**2
+    psf = np.stack([np.interp(r, radii, profile[:, i]) for i in range(len(dz))])
+    if confocal:
+        psf = psf**2
+    return psf
+
+
+def _grid(voxelsize, reachZ, reachXY):
+    ## Voxel centre coordinates (z, y, x) in nm of the odd sized box reaching reachZ/reachXY from the centre,
+    ## a single plane for 2D voxel sizes
+    if len(voxelsize) == 2:
+        axes = [np.zeros(1)]
+    else:
+        axes = [np.arange(-int(reachZ/voxelsize[0]), int(reachZ/voxelsize[0])+1)*voxelsize[0]]
+    for size in voxelsize[-2:]:
+        axes.append(np.arange(-max(1, int(reachXY/size)), max(1, int(reachXY/size))+1)*size)
+    return np.meshgrid(*axes, indexing='ij', sparse=True)
+
+
+def _crop(psf, threshold):
+    ## Smallest box around the centre voxel holding all values above threshold*max, the centre stays in the middle
+    limit = threshold*psf.max()
+    box = []
+    for axis in range(psf.ndim):
+        profile = psf.max(axis=tuple(a for a in range(psf.ndim) if a != axis))
+        centre = psf.shape[axis]//2
+        above = np.nonzero(profile > limit)[0]
+        half = max(centre - above.min(), above.max() - centre)
+        box.append(slice(centre - half, centre + half + 1))
+    return psf[tuple(box)]
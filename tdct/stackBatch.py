@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Headless batch processing of image stacks (interpolate, pack image sequences, normalize, MIP) with stackProcessing.
+
+Jobs come from a manifest file and/or glob patterns and are run in a process pool sized to the available RAM.
+Jobs whose output files are newer than their input are skipped, so an interrupted run can simply be restarted.
+
+Manifest: tab or comma separated text file with a header line. Only the path column is required,
+empty fields use the command line defaults. Relative paths are relative to the manifest. Lines starting with # are ignored.
+
+    path	task	ss_in	ss_out	method	flip
+    stack_1.tif	interpolate	300	161.25	linear	0
+    MAPS_run_3	interpolate	500	161.25	spline	0
+    stack_1.tif	mip
+
+task is one of interpolate, pack (image sequence to single stack file), normalize and mip.
+path is a stack file or, for interpolate and pack, a directory with a FEI MAPS/LA image sequence.
+
+Usage:
+    python -m tdct.stackBatch --manifest session.tsv
+    python -m tdct.stackBatch --glob "data/*.tif" --task interpolate --ss-in 300 --ss-out 161.25 --out processed
+"""
+
+import os
+import sys
+import csv
+import glob
+import fnmatch
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import psutil
+from . import clrmsg
+from . import TDCT_debug
+from . import tiffMeta
+from . import stackProcessing
+
+debug = TDCT_debug.debug
+
+tasks = ['interpolate', 'pack', 'normalize', 'mip']
+## Fraction of the available RAM the jobs running in parallel may use
+ramfraction = 0.75
+## Slices held per spline window when streaming
+streamwindow = 4
+
+
+class Job():
+    """One stack processing task of a batch"""
+    def __init__(self, path, task='interpolate', ss_in=None, ss_out=None, method='linear', flip=False):
+        self.path = os.path.abspath(path)
+        self.task = task
+        self.ss_in = ss_in
+        self.ss_out = ss_out
+        self.method = method
+        self.flip = flip
+
+    def __repr__(self):
+        return "{0} {1}".format(self.task, self.path)
+
+    def check(self):
+        """Return an error message if the job cannot be run, otherwise None"""
+        if self.task not in tasks:
+            return "Unknown task '{0}', choose from {1}".format(self.task, ", ".join(tasks))
+        if not os.path.exists(self.path):
+            return "No such file or directory"
+        if os.path.isdir(self.path) and self.task not in ['interpolate', 'pack']:
+            return "Only image sequences can be interpolated or packed, not {0}ed".format(self.task)
+        if os.path.isdir(self.path) and not self.inputs():
+            return "I only know FEI MAPS image sequences looking like e.g. 'Tile_001-001-001_1-000.tif'"
+        if self.task == 'pack' and not os.path.isdir(self.path):
+            return "Only image sequence directories can be packed into a single stack file"
+        if self.task == 'interpolate':
+            if not self.ss_in or not self.ss_out:
+                return "Focus step sizes (ss_in, ss_out) needed for the interpolation"
+            if self.method not in ['linear', 'spline']:
+                return "Please specify the interpolation method ('linear', 'spline')."
+
+    def inputs(self):
+        if os.path.isdir(self.path):
+            return [os.path.join(self.path, f) for f in sorted(os.listdir(self.path)) if fnmatch.fnmatch(f, 'Tile_*.tif')]
+        return [self.path]
+
+    def channels(self):
+        """Number of channels of an image sequence"""
+        ## 'Tile_001-001-001_1-000.tif' 17th character is the channel
+        return int(max(os.path.basename(f)[17] for f in self.inputs()))+1 if self.inputs() else 0
+
+    def outputs(self, customSaveDir=None):
+        """File names stackProcessing writes for this job"""
+        if os.path.isdir(self.path):
+            basename = os.path.basename(os.path.normpath(self.path))
+            out = []
+            for i in range(self.channels()):
+                name = basename+"_"+str(i)+("_flip" if self.flip else "")
+                out.append(name+".tif")
+                if self.task == 'interpolate':
+                    out.append(name+"_resliced.tif")
+            outdir = self.path
+        else:
+            fname = os.path.basename(self.path)
+            flip = "flip_" if self.flip else ""
+            if self.task == 'interpolate':
+                out = [os.path.splitext(fname)[0]+("_flip" if self.flip else "")+"_resliced.tif"]
+            elif self.task == 'normalize':
+                out = [flip+"norm_"+fname]
+            else:
+                out = [flip+"MIP_"+fname]
+            outdir = os.path.dirname(self.path)
+        return [os.path.join(customSaveDir if customSaveDir else outdir, f) for f in out]
+
+    def upToDate(self, customSaveDir=None):
+        """True if all outputs exist and are newer than the newest input file"""
+        inputs, outputs = self.inputs(), self.outputs(customSaveDir)
+        if not inputs or not outputs or not all(os.path.isfile(f) for f in outputs):
+            return False
+        return min(os.path.getmtime(f) for f in outputs) >= max(os.path.getmtime(f) for f in inputs)
+
+    def memory(self, streaming=False):
+        """Rough estimate of the peak memory in bytes the job needs"""
+        if os.path.isdir(self.path):
+            ## Channels are processed one after the other
+            files = self.inputs()
+            stackbytes = sum(os.path.getsize(f) for f in files)/max(1, self.channels())
+            slicebytes = sum(os.path.getsize(f) for f in files)/max(1, len(files))
+        else:
+            meta = tiffMeta.read(self.path)
+            stackbytes = float(np.prod(meta.shape))*np.dtype(meta.dtype).itemsize
+            slicebytes = stackbytes/meta.shape[0] if len(meta.shape) > 2 else stackbytes
+        if self.task == 'mip':
+            ## one page plus running max
+            return 3*slicebytes
+        elif self.task == 'normalize':
+            return 1.5*stackbytes
+        elif streaming is True:
+            ## a window of slices plus the float scratch of the interpolation
+            return 8*(streamwindow+4)*slicebytes
+        elif self.task == 'pack':
+            return stackbytes
+        ## original and interpolated stack
+        return stackbytes*(1+self.ss_in/self.ss_out)+stackProcessing.chunkbytes
+
+
+def readManifest(manifest, defaults=None):
+    """Read jobs from a tab or comma separated manifest file (see module doc). defaults fill empty fields."""
+    defaults = dict(defaults or {})
+    jobs = []
+    root = os.path.dirname(os.path.abspath(manifest))
+    with open(manifest, newline='') as f:
+        lines = [line for line in f if line.strip() and not line.lstrip().startswith('#')]
+    delimiter = '\t' if '\t' in lines[0] else ','
+    for row in csv.DictReader(lines, delimiter=delimiter):
+        row = {k.strip().lower(): v.strip() for k, v in row.items() if k is not None and v is not None}
+        if not row.get('path'):
+            continue
+        path = row['path'] if os.path.isabs(row['path']) else os.path.join(root, row['path'])
+        jobs.append(Job(
+            path,
+            task=row.get('task') or defaults.get('task', 'interpolate'),
+            ss_in=float(row['ss_in']) if row.get('ss_in') else defaults.get('ss_in'),
+            ss_out=float(row['ss_out']) if row.get('ss_out') else defaults.get('ss_out'),
+            method=row.get('method') or defaults.get('method', 'linear'),
+            flip=row['flip'].lower() in ['1', 'true', 'yes'] if row.get('flip') else defaults.get('flip', False)))
+    return jobs
+
+
+def globJobs(patterns, **defaults):
+    """One job per file or directory matching the glob patterns"""
+    jobs = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            jobs.append(Job(path, **defaults))
+    return jobs
+
+
+def poolSize(jobs, workers=None, streaming=False):
+    """Number of worker processes: one per CPU core, limited by how many of the largest jobs fit into the RAM"""
+    if not jobs:
+        return 1
+    available = psutil.virtual_memory().available*ramfraction
+    largest = max(job.memory(streaming) for job in jobs)
+    if largest > available:
+        print(clrmsg.WARNING, "The largest job needs about {0:.1f} GB, {1:.1f} GB are available. Consider --streaming".format(
+            largest/1024**3, available/1024**3))
+    fit = max(1, int(available//max(1, largest)))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, fit, len(jobs)))
+
+
+def runJob(job, customSaveDir=None, streaming=False, saveformat=None):
+    """Run one job, returns (seconds, error message or None)"""
+    ping = time.time()
+    try:
+        if job.task == 'interpolate':
+            stackProcessing.main(
+                job.path, job.ss_in, job.ss_out, interpolationmethod=job.method, flip=job.flip,
+                saveorigstack=True, customSaveDir=customSaveDir, streaming=streaming, streamwindow=streamwindow, saveformat=saveformat)
+        elif job.task == 'pack':
+            stackProcessing.main(
+                job.path, 0, 0, interpolationmethod='none', flip=job.flip, saveorigstack=True,
+                customSaveDir=customSaveDir, streaming=streaming, saveformat=saveformat)
+        elif job.task == 'normalize':
+            stackProcessing.normalize(job.path, flip=job.flip, customSaveDir=customSaveDir, saveformat=saveformat)
+        elif job.task == 'mip':
+            stackProcessing.mip(job.path, flip=job.flip, customSaveDir=customSaveDir, saveformat=saveformat)
+    except Exception as e:
+        return time.time()-ping, "{0}: {1}".format(type(e).__name__, e)
+    ## stackProcessing reports errors on stdout only, missing outputs tell that it failed
+    missing = [f for f in job.outputs(customSaveDir) if not os.path.isfile(f)]
+    if missing:
+        return time.time()-ping, "Output not written: "+", ".join(missing)
+    return time.time()-ping, None
+
+
+def run(jobs, workers=None, customSaveDir=None, streaming=False, force=False, saveformat=None):
+    """Run all jobs in a process pool. Returns a list of (job, status, seconds, error message) in job order,
+    status is one of 'done', 'skipped', 'invalid' and 'failed'. saveformat see stackProcessing.saveArgs."""
+    results = {}
+    todo = []
+    for job in jobs:
+        errmsg = job.check()
+        if errmsg is not None:
+            results[id(job)] = (job, 'invalid', 0., errmsg)
+        elif force is False and job.upToDate(customSaveDir):
+            results[id(job)] = (job, 'skipped', 0., None)
+        else:
+            todo.append(job)
+    if customSaveDir and not os.path.isdir(customSaveDir):
+        os.makedirs(customSaveDir)
+    for result in results.values():
+        _report(result)
+    workers = poolSize(todo, workers, streaming)
+    print(clrmsg.INFO, "{0} jobs to run, {1} up to date, {2} invalid, using {3} worker process(es)".format(
+        len(todo), sum(r[1] == 'skipped' for r in results.values()), sum(r[1] == 'invalid' for r in results.values()), workers))
+    if workers == 1:
+        for job in todo:
+            seconds, errmsg = runJob(job, customSaveDir, streaming, saveformat)
+            results[id(job)] = (job, 'done' if errmsg is None else 'failed', seconds, errmsg)
+            _report(results[id(job)])
+    elif todo:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(runJob, job, customSaveDir, streaming, saveformat): job for job in todo}
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    seconds, errmsg = future.result()
+                except Exception as e:
+                    seconds, errmsg = 0., "{0}: {1}".format(type(e).__name__, e)
+                results[id(job)] = (job, 'done' if errmsg is None else 'failed', seconds, errmsg)
+                _report(results[id(job)])
+    return [results[id(job)] for job in jobs]
+
+
+def _report(result):
+    job, status, seconds, errmsg = result
+    if status == 'done':
+        print(clrmsg.OK, "{0:>9.1f} s  {1}".format(seconds, job))
+    elif status == 'skipped':
+        print(clrmsg.INFO, "up to date   {0}".format(job))
+    else:
+        print(clrmsg.ERROR, "{0:>9.1f} s  {1}: {2}".format(seconds, job, errmsg))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Batch interpolate, pack, normalize or project image stacks')
+    parser.add_argument('--manifest', dest='manifest', metavar='FILE', help='tab or comma separated job list (see module doc)')
+    parser.add_argument('--glob', dest='patterns', nargs='+', default=[], metavar='PATTERN', help='stack files/sequence directories to process')
+    parser.add_argument('--task', dest='task', default='interpolate', choices=tasks, help='task for globbed files and empty manifest fields')
+    parser.add_argument('--ss-in', dest='ss_in', type=float, metavar='NUMBER', help='original focus step size')
+    parser.add_argument('--ss-out', dest='ss_out', type=float, metavar='NUMBER', help='interpolated focus step size')
+    parser.add_argument('--method', dest='method', default='linear', choices=['linear', 'spline'], help='interpolation method')
+    parser.add_argument('--flip', dest='flip', action='store_true', help='flip images horizontally')
+    parser.add_argument('--out', dest='customSaveDir', metavar='DIR', help='output directory (default: next to the input)')
+    parser.add_argument('--workers', dest='workers', type=int, metavar='NUMBER', help='maximum number of worker processes (default: CPU cores)')
+    parser.add_argument('--streaming', dest='streaming', action='store_true', help='interpolate slice by slice to save memory')
+    parser.add_argument('--force', dest='force', action='store_true', help='also process files with up to date output')
+    parser.add_argument('--compression', dest='compression', choices=['zlib', 'zstd'], help='lossless compression of the output files')
+    parser.add_argument('--tile', dest='tile', type=int, metavar='NUMBER', help='write tiled tiff files with this tile size (multiple of 16)')
+    parser.add_argument('--bigtiff', dest='bigtiff', action='store_true', default=None, help='always write BigTIFF files')
+    args = parser.parse_args(argv)
+    saveformat = dict(compression=args.compression, tile=args.tile, bigtiff=args.bigtiff)
+    errmsg = stackProcessing.checkSaveformat(saveformat)
+    if errmsg is not None:
+        parser.error(errmsg)
+
+    defaults = dict(task=args.task, ss_in=args.ss_in, ss_out=args.ss_out, method=args.method, flip=args.flip)
+    jobs = readManifest(args.manifest, defaults) if args.manifest else []
+    jobs += globJobs(args.patterns, **defaults)
+    if not jobs:
+        parser.error("Nothing to do, please specify a --manifest and/or --glob pattern")
+    ping = time.time()
+    results = run(jobs, args.workers, args.customSaveDir, args.streaming, args.force, saveformat)
+    failed = [r for r in results if r[1] in ['failed', 'invalid']]
+    print(clrmsg.INFO, "Finished {0} jobs in {1:.1f} s, {2} failed".format(len(results), time.time()-ping, len(failed)))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,7 +6,7 @@ or import stackProcessing.py and use main function like:
     stackProcessing.main(imgpath, original_steppsize, interpolated_stepsize, interpolationmethod)
 
 e.g: stackProcessing("image_stack.tif", 300, 161.25, 'linear') => fast (~25x faster)
-or: stackProcessing("image_stack.tif", 300, 161.25, 'spline') => slow
+or: stackProcessing("image_stack.tif", 300, 161.25, 'spline') => slower
 
 where 300 is the focus step size the image stack was acquired with and 161.25 the step size
 of the interpolated stack.
@@ -45,7 +45,7 @@ kwargs:
 # 					: stackProcessing.main(imgpath, original_steppsize, interpolated_stepsize, interpolationmethod)
 # 					:
 # 					: e.g: stackProcessing("image_stack.tif", 300, 161.25, 'linear') => fast (~25x faster)
-# 					: or: stackProcessing("image_stack.tif", 300, 161.25, 'spline') => slow
+# 					: or: stackProcessing("image_stack.tif", 300, 161.25, 'spline') => slower
 # 					:
 # 					: where 300 is the focus step size the image stack was acquired with and 161.25 the step size
 # 					: of the interpolated stack.
@@ -71,9 +71,12 @@ kwargs:
 
 import sys
 import os
-import re
 import fnmatch
 import time
+import multiprocessing
+import threading
+from queue import Queue, Empty
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
 from scipy import interpolate
 import matplotlib
@@ -97,30 +100,62 @@ except:
 from PyQt5 import QtWidgets
 from . import clrmsg
 from . import TDCT_debug
+from . import tiffMeta
 
 debug = TDCT_debug.debug
 
+## Projections along z known to projectStack and the file name prefix mip saves them with
+projectionTypes = {'max': 'MIP', 'min': 'MIN', 'sum': 'SUM', 'mean': 'MEAN', 'argmax': 'DEPTH'}
+## Tile size used when compressed output is streamed without a tile size (see writePages)
+defaulttile = (256, 256)
+## Size in bytes of one scratch buffer when the chunk size of the interpolation is chosen automatically
+chunkbytes = 4*1024**2
+## Size in bytes of the spline coefficients and interpolated values of one y-strip in the spline interpolation
+splinebytes = 64*1024**2
 
-def main(img_path, ss_in, ss_out, qtprocessbar=None, interpolationmethod='linear', flip=False, saveorigstack=True, showgraph=False, customSaveDir=None):
-    """Main function handling the file type and parsing of filenames/directories"""
+
+def main(img_path, ss_in, ss_out, qtprocessbar=None, interpolationmethod='linear', flip=False, saveorigstack=True, showgraph=False, customSaveDir=None,
+        streaming=False, streamwindow=4, workers=1, saveformat=None):
+    """Main function handling the file type and parsing of filenames/directories
+
+    streaming == True reads the input slice by slice (see StackReader) and appends the interpolated slices
+    to the output file (see interpolStream) instead of holding both stacks in memory. streamwindow is the
+    number of input slices held for the spline interpolation. The graph (showgraph) is not available in
+    streaming mode.
+
+    workers > 1 processes the channels of an image sequence in parallel worker processes. Every worker holds
+    its own channel in memory (unless streaming), so choose the number of workers according to the available RAM.
+
+    saveformat sets compression, tiling and BigTIFF of the written files, see saveArgs."""
 
     ## Raise "error" when program has nothing to do due to all arguments set to none/false
     if interpolationmethod == 'none' and saveorigstack is False and showgraph is False:
         print(clrmsg.WARNING, "At least let me do something! Setting everything to False... very funny -.-")
         return
+    errmsg = checkSaveformat(saveformat)
+    if errmsg is not None:
+        print(clrmsg.ERROR, errmsg)
+        return
     ## For single image stack files
     if os.path.isfile(img_path) is True:
         if debug is True: print(clrmsg.DEBUG, "Loading image: ", img_path)
         if qtprocessbar:
             qtprocessbar.setValue(20)
             QtWidgets.QApplication.processEvents()
-        img = tf.imread(img_path)
-        if len(img.shape) < 3:
-            print(clrmsg.ERROR, "ERROR: This seems to be a 2D image with the shape {0}. Please select a stack image file.".format(img.shape))
-            return
-        if flip:
-            if debug is True: print(clrmsg.DEBUG, "Flipping...")
-            img = np.flip(img, axis=-1)
+        if streaming is True:
+            try:
+                img = StackReader(img_path, flip=flip)
+            except ValueError as e:
+                print(clrmsg.ERROR, "ERROR:", e)
+                return
+        else:
+            img = tf.imread(img_path)
+            if len(img.shape) < 3:
+                print(clrmsg.ERROR, "ERROR: This seems to be a 2D image with the shape {0}. Please select a stack image file.".format(img.shape))
+                return
+            if flip:
+                if debug is True: print(clrmsg.DEBUG, "Flipping...")
+                img = np.flip(img, axis=-1)
         if debug is True: print(clrmsg.DEBUG, "		...done.")
         ## Get pixel size
         if qtprocessbar:
@@ -145,7 +180,24 @@ def main(img_path, ss_in, ss_out, qtprocessbar=None, interpolationmethod='linear
         if customSaveDir:
             file_out_int = os.path.join(customSaveDir, file_out_int)
         else:
-            file_out_int = os.path.join(img_path, file_out_int)
+            file_out_int = os.path.join(os.path.split(img_path)[0], file_out_int)
+        if streaming is True:
+            if showgraph is True:
+                print(clrmsg.WARNING, "The interpolation graph is not available in streaming mode... skipping")
+            if interpolationmethod != 'none':
+                if debug is True: print(clrmsg.DEBUG, "Interpolating and saving interpolated stack as: ", file_out_int)
+                metadata = {'PixelSize': str(pixelsize),'FocusStepSize': str(ss_out/1000)} if px_info is True else {}
+                errmsg = interpolStream(
+                    img, file_out_int, ss_in, ss_out, interpolationmethod, window=streamwindow, metadata=metadata,
+                    qtprocessbar=qtprocessbar, progressrange=(60,100), saveformat=saveformat)
+                if errmsg is not None:
+                    print(clrmsg.ERROR, errmsg)
+                if debug is True: print(clrmsg.DEBUG, "		...done.")
+            img.close()
+            if qtprocessbar:
+                qtprocessbar.setValue(100)
+                QtWidgets.QApplication.processEvents()
+            return
         if debug is True: print(clrmsg.DEBUG, "Interpolating...")
         img_int = interpol(img, ss_in, ss_out, interpolationmethod, showgraph)
         if qtprocessbar:
@@ -157,9 +209,9 @@ def main(img_path, ss_in, ss_out, qtprocessbar=None, interpolationmethod='linear
         if img_int is not None:
             if debug is True: print(clrmsg.DEBUG, "Saving interpolated stack as: ", file_out_int)
             if px_info is True:
-                tf.imsave(file_out_int, img_int, metadata={'PixelSize': str(pixelsize),'FocusStepSize': str(ss_out/1000)})
+                imsave(file_out_int, img_int, metadata={'PixelSize': str(pixelsize),'FocusStepSize': str(ss_out/1000)}, saveformat=saveformat)
             else:
-                tf.imsave(file_out_int, img_int)
+                imsave(file_out_int, img_int, saveformat=saveformat)
             if debug is True: print(clrmsg.DEBUG, "		...done.")
         if qtprocessbar:
             qtprocessbar.setValue(100)
@@ -191,6 +243,7 @@ def main(img_path, ss_in, ss_out, qtprocessbar=None, interpolationmethod='linear
         if qtprocessbar:
             qtprocessbar.setValue(10)
             QtWidgets.QApplication.processEvents()
+        pixelsize, pixelsizeZ = None, None
         try:
             for filename in files:
                 if fnmatch.fnmatch(filename, 'Tile_*.tif'):
@@ -210,66 +263,50 @@ def main(img_path, ss_in, ss_out, qtprocessbar=None, interpolationmethod='linear
             qtprocessbar.setValue(20)
             QtWidgets.QApplication.processEvents()
         if debug is True: print(clrmsg.DEBUG, px_info)
-        for i in range(channels):
-            if qtprocessbar:
-                qtprocessbar.setValue(qtprocessbar.value()+int(20/channels))
-                QtWidgets.QApplication.processEvents()
-            if debug is True: print(clrmsg.DEBUG, "Processing channel {0} of {1}".format(i+1, channels))
-            filelist = []
-            ## Gather filenames from same channel
-            for filename in files:
-                if fnmatch.fnmatch(filename, 'Tile_*{0}-000.tif'.format(i)):
-                    filelist.append(os.path.join(img_path,filename))
-            ## Default pattern is not compatible with OME header from FEI MAPS/Live Acquisition Software
-            img = tf.imread(filelist, pattern='')
-            if flip:
-                if debug is True: print(clrmsg.DEBUG, "Flipping...")
-                img = np.flip(img, axis=-1)
-            if qtprocessbar:
-                qtprocessbar.setValue(qtprocessbar.value()+int(20/channels))
-                QtWidgets.QApplication.processEvents()
-            ## Generate file output name
-            file_out_int = os.path.basename(os.path.normpath(img_path))+"_"+str(i)+"_flip_resliced.tif" if flip else os.path.basename(os.path.normpath(img_path))+"_"+str(i)+"_resliced.tif"
-            if customSaveDir:
-                file_out_int = os.path.join(customSaveDir, file_out_int)
-            else:
-                file_out_int = os.path.join(img_path, file_out_int)
-            ## Possibility to save the image sequence files as one single stack file for easier handling and better overview
-            if saveorigstack is True:
-                file_out_orig = os.path.basename(os.path.normpath(img_path))+"_"+str(i)+"_flip.tif" if flip else os.path.basename(os.path.normpath(img_path))+"_"+str(i)+".tif"
-                if customSaveDir:
-                    file_out_orig = os.path.join(customSaveDir, file_out_orig)
-                else:
-                    file_out_orig = os.path.join(img_path, file_out_orig)
-                if debug is True: print(clrmsg.DEBUG, "Saving original image stack as single stack file: {0} |shape: {1}".format(file_out_orig,img.shape))
-                if px_info is True:
-                    tf.imsave(file_out_orig, img, metadata={'PixelSize': str(pixelsize),'FocusStepSize': str(pixelsizeZ)})
-                else:
-                    tf.imsave(file_out_orig, img)
-                if debug is True: print(clrmsg.DEBUG, "		...done.")
-                if qtprocessbar:
-                    qtprocessbar.setValue(qtprocessbar.value()+int(20/channels))
-                    QtWidgets.QApplication.processEvents()
-            ## In case only the original image sequence is saved as a single stack file the interpolation is skipped
-            if interpolationmethod == 'none' and showgraph is False:
-                pass
-            else:
-                if debug is True: print(clrmsg.DEBUG, "Interpolating...")
-                img_int = interpol(img, ss_in, ss_out, interpolationmethod, showgraph)
-                ## Error handling from 'interpol' function
-                if type(img_int) == str:
-                    print(clrmsg.ERROR, img_int)
+        ## Gather filenames from same channel
+        filelists = [
+            [os.path.join(img_path,filename) for filename in files if fnmatch.fnmatch(filename, 'Tile_*{0}-000.tif'.format(i))]
+            for i in range(channels)]
+        ## In case only the original image sequence is saved as a single stack file the interpolation is skipped
+        interpolate_ = not (interpolationmethod == 'none' and (showgraph is False or streaming is True))
+        ## One progress step per channel for reading, saving the original stack and interpolating
+        progress = _ProgressCounter(qtprocessbar, channels*(1+int(saveorigstack is True)+int(interpolate_)), start=20)
+        kwargs = dict(
+            img_path=img_path, ss_in=ss_in, ss_out=ss_out, interpolationmethod=interpolationmethod, flip=flip,
+            saveorigstack=saveorigstack, showgraph=showgraph, customSaveDir=customSaveDir, interpolate_=interpolate_,
+            px_info=px_info, pixelsize=pixelsize, pixelsizeZ=pixelsizeZ, streaming=streaming, streamwindow=streamwindow,
+            saveformat=saveformat)
+        if workers > 1 and showgraph is True:
+            print(clrmsg.WARNING, "The interpolation graph can only be shown when processing one channel at a time")
+            workers = 1
+        workers = max(1, min(int(workers), channels))
+        if workers == 1:
+            for i in range(channels):
+                errmsg = _processChannel(i, filelists[i], progress=progress, **kwargs)
+                if errmsg is not None:
+                    print(clrmsg.ERROR, errmsg)
                     return
-                elif img_int is not None:
-                    if debug is True: print(clrmsg.DEBUG, "Saving interpolated stack as: ", file_out_int)
-                    if px_info is True:
-                        tf.imsave(file_out_int, img_int, metadata={'PixelSize': str(pixelsize),'FocusStepSize': str(ss_out/1000)})
-                    else:
-                        tf.imsave(file_out_int, img_int)
-                    if debug is True: print(clrmsg.DEBUG, "		...done.")
-                if qtprocessbar:
-                    qtprocessbar.setValue(qtprocessbar.value()+int(20/channels))
-                    QtWidgets.QApplication.processEvents()
+        else:
+            if debug is True: print(clrmsg.DEBUG, "Processing {0} channels with {1} worker processes".format(channels, workers))
+            with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=workers) as executor:
+                ## Worker processes report finished steps through the queue, the progress bar is updated from here
+                queue = manager.Queue()
+                futures = [executor.submit(_processChannel, i, filelists[i], progress=queue, **kwargs) for i in range(channels)]
+                while not all(future.done() for future in futures):
+                    try:
+                        progress.put(queue.get(timeout=0.1))
+                    except Empty:
+                        pass
+                while not queue.empty():
+                    progress.put(queue.get())
+                ## A failing channel must not lose the results of the others
+                for i, future in enumerate(futures):
+                    try:
+                        errmsg = future.result()
+                    except Exception as e:
+                        errmsg = "ERROR: Channel {0} failed: {1}".format(i, e)
+                    if errmsg is not None:
+                        print(clrmsg.ERROR, errmsg)
         if qtprocessbar:
             qtprocessbar.setValue(100)
             QtWidgets.QApplication.processEvents()
@@ -277,40 +314,97 @@ def main(img_path, ss_in, ss_out, qtprocessbar=None, interpolationmethod='linear
         print(clrmsg.ERROR, 'ERROR: Path is neither a valid file nor a valid directory!')
 
 
+class _ProgressCounter():
+    """Count finished steps and show them on the Qt progress bar between start and stop. Has the put() method
+    of a queue so the same processing code can report to it directly or through a queue from a worker process."""
+    def __init__(self, qtprocessbar, steps, start=0, stop=100):
+        self.qtbar = qtprocessbar
+        self.steps = max(1, steps)
+        self.start = start
+        self.stop = stop
+        self.done = 0
+
+    def put(self, n=1):
+        self.done += n
+        if self.qtbar:
+            self.qtbar.setValue(int(self.start+(self.stop-self.start)*self.done/self.steps))
+            QtWidgets.QApplication.processEvents()
+
+
+def _processChannel(
+        i, filelist, img_path, ss_in, ss_out, interpolationmethod, flip, saveorigstack, showgraph, customSaveDir, interpolate_,
+        px_info, pixelsize, pixelsizeZ, streaming, streamwindow, saveformat, progress):
+    """Read, save and interpolate channel i of an image sequence (see main).
+
+    Saving the original stack runs in a background thread while the interpolation is computed.
+    progress.put(1) is called after every finished step. Returns None or an error message."""
+    if debug is True: print(clrmsg.DEBUG, "Processing channel {0}".format(i))
+    if streaming is True:
+        try:
+            img = StackReader(filelist, flip=flip)
+        except ValueError as e:
+            return "ERROR: "+str(e)
+    else:
+        ## Default pattern is not compatible with OME header from FEI MAPS/Live Acquisition Software
+        img = tf.imread(filelist, pattern='')
+        if flip:
+            if debug is True: print(clrmsg.DEBUG, "Flipping...")
+            img = np.flip(img, axis=-1)
+    progress.put(1)
+    ## Generate file output name
+    basename = os.path.basename(os.path.normpath(img_path))+"_"+str(i)
+    file_out_int = basename+"_flip_resliced.tif" if flip else basename+"_resliced.tif"
+    file_out_orig = basename+"_flip.tif" if flip else basename+".tif"
+    file_out_int = os.path.join(customSaveDir if customSaveDir else img_path, file_out_int)
+    file_out_orig = os.path.join(customSaveDir if customSaveDir else img_path, file_out_orig)
+    errmsg = None
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        ## Possibility to save the image sequence files as one single stack file for easier handling and better overview
+        if saveorigstack is True:
+            if debug is True: print(clrmsg.DEBUG, "Saving original image stack as single stack file: {0} |shape: {1}".format(file_out_orig,img.shape))
+            metadata = {'PixelSize': str(pixelsize),'FocusStepSize': str(pixelsizeZ)} if px_info is True else {}
+            if streaming is True:
+                ## Separate reader, the interpolation moves its own slice window through the stack
+                origreader = StackReader(filelist, flip=flip)
+                saving = writer.submit(
+                    writePages, file_out_orig, (origreader[z] for z in range(len(origreader))), origreader.shape, origreader.dtype,
+                    metadata=metadata, saveformat=saveformat)
+            else:
+                saving = writer.submit(imsave, file_out_orig, img, metadata=metadata, saveformat=saveformat)
+        if interpolate_ is True and streaming is True:
+            if debug is True: print(clrmsg.DEBUG, "Interpolating and saving interpolated stack as: ", file_out_int)
+            metadata = {'PixelSize': str(pixelsize),'FocusStepSize': str(ss_out/1000)} if px_info is True else {}
+            errmsg = interpolStream(
+                img, file_out_int, ss_in, ss_out, interpolationmethod, window=streamwindow, metadata=metadata, saveformat=saveformat)
+            progress.put(1)
+        elif interpolate_ is True:
+            if debug is True: print(clrmsg.DEBUG, "Interpolating...")
+            img_int = interpol(img, ss_in, ss_out, interpolationmethod, showgraph)
+            ## Error handling from 'interpol' function
+            if type(img_int) == str:
+                errmsg = img_int
+            elif img_int is not None:
+                if debug is True: print(clrmsg.DEBUG, "Saving interpolated stack as: ", file_out_int)
+                if px_info is True:
+                    imsave(file_out_int, img_int, metadata={'PixelSize': str(pixelsize),'FocusStepSize': str(ss_out/1000)}, saveformat=saveformat)
+                else:
+                    imsave(file_out_int, img_int, saveformat=saveformat)
+            progress.put(1)
+        if saveorigstack is True:
+            saving.result()
+            if streaming is True:
+                origreader.close()
+            progress.put(1)
+    if debug is True: print(clrmsg.DEBUG, "		...done.")
+    if streaming is True:
+        img.close()
+    return errmsg
+
 def pxSize(img_path,z=False):
     """Extract pixel size from meta/exif data. Tailored for image headers from FEI dual beam electron microscopes
-    and CorrSight light microscope"""
-    with tf.TiffFile(img_path) as tif:
-        for page in tif:
-            for tag in list(page.tags.values()):
-                if isinstance(tag.value, str):
-                    for keyword in ['PhysicalSizeX','PixelWidth','PixelSize'] if not z else ['PhysicalSizeZ','FocusStepSize']:
-                        tagposs = [m.start() for m in re.finditer(keyword, tag.value)]
-                        for tagpos in tagposs:
-                            if keyword == 'PhysicalSizeX' or keyword == 'PhysicalSizeZ':
-                                for piece in tag.value[tagpos:tagpos+30].split('"'):
-                                    try:
-                                        pixelsize = float(piece)
-                                        return pixelsize
-                                    except:
-                                        pass
-                            elif keyword == 'PixelWidth':
-                                for piece in tag.value[tagpos:tagpos+30].split('='):
-                                    try:
-                                        try:
-                                            pixelsize = float(piece.strip().split('\r\n')[0])
-                                        except:
-                                            pixelsize = float(piece.strip().split(r'\r\n')[0])
-                                        return pixelsize
-                                    except:
-                                        pass
-                            elif keyword == 'PixelSize' or 'FocusStepSize':
-                                for piece in tag.value[tagpos:tagpos+30].split('"'):
-                                    try:
-                                        pixelsize = float(piece)
-                                        return pixelsize
-                                    except:
-                                        pass
+    and CorrSight light microscope. The header is parsed once and cached, see tiffMeta"""
+    meta = tiffMeta.read(img_path)
+    return meta.pixelsizeZ if z else meta.pixelsize
 
 
 def interpol(img, ss_in, ss_out, interpolationmethod, showgraph):
@@ -378,67 +472,376 @@ def showgraph_(img, ss_in, ss_out, sl_in, sl_out, block=True):
     plt.show(block)
 
 
-def spline(img, img_int_shape, ss_in, ss_out, sl_in, sl_out):
+def spline(img, img_int_shape, ss_in, ss_out, sl_in, sl_out, striprows=None):
     """
     Spline interpolation
 
-    # possible depricated due to changes in code -> marked for futur code changes
+    Cubic (not-a-knot) spline along z, solved for all pixels of a y-strip at once. The strip height is
+    chosen so that spline coefficients and interpolated values of one strip fit into splinebytes unless
+    striprows is given.
+
     ss_in : step size input stack
     ss_out : step size output stack
     sl_in : slices input stack
     sl_out : slices output stack
+    striprows : number of image rows processed at once
     """
     ## Known x values in interpolated stack size.
-    zx = np.arange(0,sl_out,ss_in/ss_out)
-    zxnew = np.arange(0, (sl_in-1)*ss_in/ss_out, 1)  # First slice of original and interpolated are both 0. n-1 to discard last slice
-    if ss_in/ss_out < 1.0:
-        zx_mod = []
-        for i in range(img.shape[0]):
-            zx_mod.append(zx[i])
-        zx = zx_mod
+    zx = np.arange(0,sl_out,ss_in/ss_out)[:sl_in]
+    zxnew = np.arange(0, (sl_in-1)*ss_in/ss_out, 1)[:sl_out]  # First slice of original and interpolated are both 0. n-1 to discard last slice
+    n_int = len(zxnew)
 
     ## Create new numpy array for the interpolated image stack
     img_int = np.zeros(img_int_shape,img.dtype)
     if debug is True: print(clrmsg.DEBUG, "Interpolated stack shape: ", img_int.shape)
 
-    r_sl_out = list(range(sl_out))
-
     ping = time.time()
-    for px in range(img.shape[-1]):
-        for py in range(img.shape[-2]):
-            spl = interpolate.InterpolatedUnivariateSpline(zx, img[:,py,px])
-            np.put(img_int[:,py,px], r_sl_out, spl(zxnew))
-        sys.stdout.write("\r%d%%" % int(px*100/img.shape[-1]))
-        sys.stdout.flush()
+    splineStrips(zx, img, zxnew, img_int[:n_int], striprows=striprows, verbose=True)
     pong = time.time()
     if debug is True: print(clrmsg.DEBUG, "This interpolation took {0} seconds".format(pong - ping))
     return img_int
 
 
-def linear(img, img_int_shape, ss_in, ss_out, sl_in, sl_out):
-    """Linear interpolation"""
+def splineStrips(zx, img, zxnew, out, striprows=None, verbose=False):
+    """Evaluate the cubic spline through the slices of img (at positions zx) at zxnew and write the result into out.
+
+    The spline is solved for all pixels of a y-strip at once."""
+    if striprows is None:
+        ## float64 spline coefficients (4 per input interval) plus the interpolated values of one image row
+        rowbytes = (4*(len(zx)-1)+len(zxnew))*img.shape[-1]*8
+        striprows = splinebytes // rowbytes
+    striprows = max(1, min(int(striprows), img.shape[-2]))
+
+    for y0 in range(0, img.shape[-2], striprows):
+        y1 = min(y0+striprows, img.shape[-2])
+        spl = interpolate.CubicSpline(zx, img[:,y0:y1,:], axis=0)
+        out[:,y0:y1,:] = spl(zxnew)
+        if verbose:
+            sys.stdout.write("\r%d%%" % int(y1*100/img.shape[-2]))
+            sys.stdout.flush()
+    return out
+
+
+def linearWeights(ss_in, ss_out, sl_in, sl_out):
+    """Return the lower input slice index and the weights of the lower and upper input slice for every
+    interpolated output slice.
+
+    The weights are calculated for the whole output stack up front, so each output slice k is
+    img[idx[k]]*w_low[k] + img[idx[k]+1]*w_up[k]."""
     ##  Determine interpolated slice positions
-    sl_int = np.arange(0,sl_in-1,ss_out/ss_in)  # sl_in-1 because last slice is discarded (no extrapolation)
+    sl_int = np.arange(0,sl_in-1,ss_out/ss_in)[:sl_out]  # sl_in-1 because last slice is discarded (no extrapolation)
+    idx = sl_int.astype(np.intp)
+    ## Distance from every interpolated image to its next original image
+    w_up = sl_int-idx
+    w_low = 1-w_up
+    return idx, w_low, w_up
+
+
+def linear(img, img_int_shape, ss_in, ss_out, sl_in, sl_out, chunksize=None, workers=1, scratchtype=np.float64):
+    """Linear interpolation
+
+    The output stack is computed in z-chunks of at most chunksize slices. Every worker thread owns two
+    preallocated scratch buffers of shape (chunksize, y, x) and writes its results straight into the output
+    array, so peak memory is the output stack plus 2*workers*chunksize slices in scratchtype.
+
+    chunksize : number of output slices processed at once. None picks as many slices as fit into
+                chunkbytes, i.e. one slice at a time for full frame images and several for small images.
+    workers : number of threads working on separate chunks (numpy releases the GIL for the arithmetic)
+    scratchtype : dtype of the scratch buffers. The default float64 gives bit-identical results to the
+                  former slice by slice implementation, float32 halves the scratch memory at the cost of
+                  possible 1 LSB deviations where a value lies very close to an integer.
+
+    Returns the interpolated stack or, if a worker failed, an error message (see interpol).
+    """
+    idx, w_low, w_up = linearWeights(ss_in, ss_out, sl_in, sl_out)
+    n_int = len(idx)
 
     ## Create new numpy array for the interpolated image stack
     img_int = np.zeros(img_int_shape,img.dtype)
     if debug is True: print(clrmsg.DEBUG, "Interpolated stack shape: ", img_int.shape)
 
-    ## Calculate distances from every interpolated image to its next original image
-    sl_counter = 0
+    if chunksize is None:
+        chunksize = chunkbytes // (np.dtype(scratchtype).itemsize*img[0].size)
+    chunksize = max(1, min(int(chunksize), n_int))
+    chunks = [(k, min(k+chunksize, n_int)) for k in range(0, n_int, chunksize)]
+    workers = max(1, min(int(workers), len(chunks)))
+
+    def work(chunklist):
+        ## Scratch buffers are allocated once per worker and reused for every chunk
+        buf_low = np.empty((chunksize,)+img.shape[1:], dtype=scratchtype)
+        buf_up = np.empty((chunksize,)+img.shape[1:], dtype=scratchtype)
+        for k0, k1 in chunklist:
+            n = k1-k0
+            a, b = buf_low[:n], buf_up[:n]
+            np.multiply(img[idx[k0:k1]], w_low[k0:k1, None, None], out=a, casting='unsafe')
+            np.multiply(img[idx[k0:k1]+1], w_up[k0:k1, None, None], out=b, casting='unsafe')
+            np.add(a, b, out=a)
+            img_int[k0:k1] = a
+
     ping = time.time()
-    for i in sl_int:
-        int_i = int(i)
-        lower = i-int_i
-        upper = 1-(lower)
-        img_int[sl_counter,:,:] = img[int_i,:,:]*upper + img[int_i+1,:,:]*lower
-        sl_counter += 1
+    if workers == 1:
+        work(chunks)
+    else:
+        errors = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            ## Round robin distribution of the chunks, one chunk list (and one set of buffers) per worker
+            for future in [executor.submit(work, chunks[w::workers]) for w in range(workers)]:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(clrmsg.ERROR, "Interpolation worker failed:", e)
+                    errors.append(str(e))
+        if errors:
+            return "ERROR: Linear interpolation failed: " + "; ".join(errors)
     pong = time.time()
     if debug is True: print(clrmsg.DEBUG, "This interpolation took {0} seconds".format(pong - ping))
     return img_int
 
 
-def norm_img(img,copy=False,qtprocessbar=None):
+class StackReader():
+    """Read single z-slices of an image stack without loading the whole stack into memory.
+
+    img_path is either a tiff stack file ([z,y,x] or [1,z,y,x]) or a list of single slice image files, e.g.
+    the files of one channel of a FEI MAPS/LA image sequence. Slices are read page by page. With memmap=True
+    uncompressed, contiguous stack files are memory-mapped instead; note that the mapped pages then count
+    towards the resident memory of the process even though the OS can reclaim them.
+    window() only keeps the slices it was last asked for.
+    """
+    def __init__(self, img_path, flip=False, memmap=False):
+        self.flip = flip
+        self._tif = None
+        self._memmap = None
+        self._files = None
+        self._cache = {}
+        if isinstance(img_path, (list, tuple)):
+            self._files = list(img_path)
+            ## Only read the first page, FEI MAPS/LA OME headers would otherwise pull in the whole sequence
+            with tf.TiffFile(self._files[0]) as tif:
+                self.shape = (len(self._files),)+tuple(tif.pages[0].shape)
+                self.dtype = tif.pages[0].dtype
+        else:
+            self._tif = tf.TiffFile(img_path)
+            series = self._tif.series[0]
+            self.shape = tuple(series.shape)
+            self.dtype = series.dtype
+            ## Depending on tiff format the file can have different shapes; e.g. z,y,x or c,z,y,x
+            if len(self.shape) == 4 and self.shape[0] == 1:
+                self.shape = self.shape[1:]
+            if len(self.shape) == 3 and memmap is True:
+                try:
+                    self._memmap = tf.memmap(img_path).reshape(self.shape)
+                except ValueError:
+                    if debug is True: print(clrmsg.DEBUG, "Image data not memory-mappable, reading page by page")
+        if len(self.shape) != 3:
+            self.close()
+            raise ValueError("I only know tiff stack image formats in z,y,x or c,z,y,x with one channel: "+str(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        if self._memmap is not None:
+            data = self._memmap[i]
+        elif self._files is not None:
+            with tf.TiffFile(self._files[i]) as tif:
+                data = tif.pages[0].asarray()
+        else:
+            data = self._tif.asarray(key=i)
+        if self.flip:
+            data = np.flip(data, axis=-1)
+        return data
+
+    def window(self, i0, i1):
+        """Return slices i0 to i1-1 as [z,y,x] array and release all other slices"""
+        for i in [i for i in self._cache if not i0 <= i < i1]:
+            del self._cache[i]
+        for i in range(i0, i1):
+            if i not in self._cache:
+                self._cache[i] = self[i]
+        return np.stack([self._cache[i] for i in range(i0, i1)])
+
+    def close(self):
+        self._cache = {}
+        self._memmap = None
+        if self._tif is not None:
+            self._tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def interpolStream(
+        reader, file_out, ss_in, ss_out, interpolationmethod='linear', window=4, metadata=None, qtprocessbar=None, progressrange=(0,100),
+        saveformat=None):
+    """Interpolate an image stack slice by slice and append the interpolated slices to the tiff file file_out.
+
+    reader is a StackReader. Only the input slices needed for the current output slice are held in memory:
+    the two neighbouring slices for 'linear' (bit-identical to linear()) and 'window' neighbouring slices for
+    'spline', which uses a local cubic spline through these slices (identical to spline() for window >= number
+    of slices). Peak memory is therefore bounded by the window, independent of the stack depth.
+
+    Returns None or an error message like interpol().
+    """
+    sl_in = len(reader)
+    sl_out = int((sl_in-1)*(ss_in/ss_out)) + 1
+    if interpolationmethod == 'linear':
+        pages = _linearPages(reader, ss_in, ss_out, sl_in, sl_out)
+    elif interpolationmethod == 'spline':
+        pages = _splinePages(reader, ss_in, ss_out, sl_in, sl_out, window)
+    else:
+        return "Please specify the interpolation method ('linear', 'spline')."
+    if debug is True: print(clrmsg.DEBUG, "Nr. of slices (in/out): ", sl_in, sl_out)
+    ping = time.time()
+    writePages(file_out, pages, (sl_out,)+reader.shape[1:], reader.dtype, metadata, qtprocessbar, progressrange, saveformat)
+    pong = time.time()
+    if debug is True: print(clrmsg.DEBUG, "This interpolation took {0} seconds".format(pong - ping))
+
+
+def writePages(file_out, pages, shape, dtype, metadata=None, qtprocessbar=None, progressrange=(0,100), saveformat=None):
+    """Write an iterable of [y,x] pages as [z,y,x] tiff stack without holding the stack in memory.
+
+    The next pages are computed in a background thread while the current one is compressed and written.
+    Compressed output is always tiled (defaulttile if saveformat has no tile size)."""
+    if metadata is None:
+        metadata = {}
+    args = saveArgs(saveformat, shape, dtype)
+    if args.get('compression') and not args.get('tile'):
+        args['tile'] = defaulttile
+    ## tifffile tags but does not apply the predictor for iterated tiles
+    args.pop('predictor', None)
+    def progress(pages):
+        for i, page in enumerate(pages):
+            if qtprocessbar:
+                qtprocessbar.setValue(int(progressrange[0]+(progressrange[1]-progressrange[0])*i/shape[0]))
+                QtWidgets.QApplication.processEvents()
+            yield page
+    def tiles(pages):
+        ty, tx = args['tile']
+        for page in pages:
+            for y in range(0, shape[-2], ty):
+                for x in range(0, shape[-1], tx):
+                    yield page[y:y+ty, x:x+tx]
+    data = progress(_prefetch(pages))
+    tf.imsave(file_out, tiles(data) if args.get('tile') else data, shape=shape, dtype=dtype, metadata=metadata, **args)
+
+
+def _prefetch(items, size=2):
+    """Iterate over items while a background thread already computes the next size items"""
+    queue = Queue(maxsize=size)
+    done = object()
+    def produce():
+        try:
+            for item in items:
+                queue.put((item, None))
+        except Exception as e:
+            queue.put((None, e))
+        queue.put((done, None))
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = queue.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
+
+
+def saveArgs(saveformat, shape, dtype):
+    """Translate the output format options into tifffile keyword arguments. saveformat is None (uncompressed,
+    BigTIFF only if needed) or a dict with any of:
+
+    compression:    None, 'zlib' or 'zstd' (lossless, 'zstd' needs the imagecodecs package)
+    level:          compression level
+    tile:           tile size, e.g. 256 or (256, 512), multiples of 16
+    bigtiff:        True/False, None (default) writes BigTIFF if the uncompressed data exceed 4 GB
+    workers:        number of threads compressing tiles/strips (default: tifffile's choice)
+
+    Raises ValueError for unknown options."""
+    saveformat = dict(saveformat or {})
+    for key in saveformat:
+        if key not in ['compression', 'level', 'tile', 'bigtiff', 'workers']:
+            raise ValueError("Unknown output format option: {0}".format(key))
+    args = {}
+    compression = saveformat.get('compression')
+    if compression in [None, 'none']:
+        pass
+    elif compression in ['zlib', 'zstd']:
+        if compression == 'zstd':
+            try:
+                import imagecodecs  # noqa: F401
+            except ImportError:
+                raise ValueError("zstd compression needs the imagecodecs package, e.g.: pip install imagecodecs")
+        args['compression'] = compression
+        ## Horizontal differencing makes integer images compress considerably better
+        if np.dtype(dtype).kind in 'ui':
+            args['predictor'] = True
+        if saveformat.get('level') is not None:
+            args['compressionargs'] = {'level': int(saveformat['level'])}
+    else:
+        raise ValueError("Unknown compression '{0}', choose from 'zlib', 'zstd'".format(compression))
+    tile = saveformat.get('tile')
+    if tile:
+        tile = (int(tile), int(tile)) if np.isscalar(tile) else tuple(int(t) for t in tile)
+        if len(tile) != 2 or any(t <= 0 or t % 16 for t in tile):
+            raise ValueError("Tile size must be two multiples of 16: {0}".format(saveformat['tile']))
+        args['tile'] = tile
+    bigtiff = saveformat.get('bigtiff')
+    args['bigtiff'] = int(np.prod(shape))*np.dtype(dtype).itemsize > 2**32-2**25 if bigtiff is None else bool(bigtiff)
+    if saveformat.get('workers'):
+        args['maxworkers'] = int(saveformat['workers'])
+    return args
+
+
+def checkSaveformat(saveformat):
+    """Return None if saveformat is valid, otherwise an error message"""
+    try:
+        saveArgs(saveformat, (1,16,16), np.uint8)
+    except (ValueError, TypeError) as e:
+        return "ERROR: "+str(e)
+
+
+def imsave(file_out, data, metadata=None, imagej=False, saveformat=None):
+    """tf.imsave with the output format options of saveformat (see saveArgs)"""
+    args = saveArgs(saveformat, data.shape, data.dtype)
+    ## ImageJ hyperstacks cannot be BigTIFF
+    if imagej and args['bigtiff']:
+        imagej = False
+    tf.imsave(file_out, data, metadata=metadata if metadata else {}, imagej=imagej, **args)
+
+
+def _linearPages(reader, ss_in, ss_out, sl_in, sl_out):
+    idx, w_low, w_up = linearWeights(ss_in, ss_out, sl_in, sl_out)
+    for k in range(sl_out):
+        if k < len(idx):
+            lower, upper = reader.window(idx[k], idx[k]+2)
+            yield (lower*w_low[k] + upper*w_up[k]).astype(reader.dtype)
+        else:
+            ## Last slice is not extrapolated
+            yield np.zeros(reader.shape[1:], reader.dtype)
+
+
+def _splinePages(reader, ss_in, ss_out, sl_in, sl_out, window):
+    zx = np.arange(0,sl_out,ss_in/ss_out)[:sl_in]
+    zxnew = np.arange(0, (sl_in-1)*ss_in/ss_out, 1)[:sl_out]
+    window = max(2, min(int(window), sl_in))
+    ## Input interval of every output slice. The window is centred on this interval.
+    interval = np.clip(np.searchsorted(zx, zxnew, side='right')-1, 0, sl_in-2)
+    for j in np.unique(interval):
+        ks = np.nonzero(interval == j)[0]
+        start = min(max(j-(window//2-1), 0), sl_in-window)
+        stack = reader.window(start, start+window)
+        out = np.empty((len(ks),)+reader.shape[1:])
+        splineStrips(zx[start:start+window], stack, zxnew[ks], out)
+        for page in out:
+            yield page.astype(reader.dtype)
+    for k in range(len(zxnew), sl_out):
+        yield np.zeros(reader.shape[1:], reader.dtype)
+
+
+def norm_img(img,copy=False,qtprocessbar=None,dtype=None,percentile=None):
     """Normalizing image
 
     Supported data types are (u)int8, (u)int16, float32 and float64.
@@ -449,75 +852,90 @@ def norm_img(img,copy=False,qtprocessbar=None):
     [z,y,x]
     [z,c,y,x]
     [c,z,y,x]
+
+    Every 2D slice (or channel of a [y,x,c] image) is stretched so its maximum hits the top of the data type
+    range (1 for float). The maxima are computed in one reduction and the scaling is applied chunk wise.
+    With copy=False the input is normalized in place (unless it is read-only) and returned.
+
+    dtype:      Output data type, e.g. 'float32' returns a new float image normalized to 0..1.
+    percentile: Clip the intensities of each slice to the given percentile (e.g. 99.9) or (low, high)
+                percentiles before stretching; low is mapped to 0 and high to the maximum.
     """
-    if copy is True:
-        img = np.copy(img)
+    dtype = np.dtype(img.dtype if dtype is None else dtype)
+    if dtype.kind in 'ui':
+        typesize = np.iinfo(dtype).max
+    elif dtype.kind == 'f':
+        typesize = 1
     else:
-        # quick bug fix for immutable numpy array read-only error
-        img = np.copy(img)
-    dtype = str(img.dtype)
-    if dtype == "uint16" or dtype == "int16": typesize = 65535
-    elif dtype == "uint8" or dtype == "int8": typesize = 255
-    elif dtype == "float32" or dtype == "float64": typesize = 1
-    else: print(clrmsg.ERROR, "Sorry, I don't know this file type yet: ", dtype)
-    if debug is True: print(clrmsg.DEBUG, "Shape/type:", img.shape, dtype)
-    ## 2D image
+        print(clrmsg.ERROR, "Sorry, I don't know this file type yet: ", dtype)
+        return img
+    if debug is True: print(clrmsg.DEBUG, "Shape/type:", img.shape, img.dtype, "->", dtype)
+    ## tifffile reads z,y,x for stacks but y,x,c if it is multichannel image (or z,c,y,x if it is a multicolor image stack)
     if img.ndim == 2:
         if debug is True: print(clrmsg.DEBUG, "2D image")
-        img = np.multiply(img, typesize/img.max(), casting='unsafe')
-    ## 3D or multichannel image
+        axes = (0,1)
+    elif img.ndim == 3 and img.shape[-1] > 4:
+        if debug is True: print(clrmsg.DEBUG, "Image stack")
+        axes = (1,2)
     elif img.ndim == 3:
-        ## tiffimage reads z,y,x for stacks but y,x,c if it is multichannel image (or z,c,y,x if it is a multicolor image stack)
-        if img.shape[-1] > 4:
-            if debug is True: print(clrmsg.DEBUG, "Image stack")
-            if qtprocessbar:
-                maximum = int(int(img.shape[0])*1.25)
-                qtprocessbar.setMaximum(maximum)
-                qtprocessbar.setValue(maximum*0.1)
-                QtWidgets.QApplication.processEvents()
-            for i in range(int(img.shape[0])):
-                img[i,:,:] = np.multiply(img[i,:,:], typesize/img[i,:,:].max(), casting='unsafe')
-                if qtprocessbar:
-                    qtprocessbar.setValue(qtprocessbar.value()+1)
-                    QtWidgets.QApplication.processEvents()
-        else:
-            if debug is True: print(clrmsg.DEBUG, "Multichannel image")
-            if qtprocessbar:
-                maximum = int(int(img.shape[2])*1.25)
-                qtprocessbar.setMaximum(maximum)
-                qtprocessbar.setValue(maximum*0.1)
-                QtWidgets.QApplication.processEvents()
-            for i in range(int(img.shape[2])):
-                img[:,:,i] = np.multiply(img[:,:,i], typesize/img[:,:,i].max(), casting='unsafe')
-                if qtprocessbar:
-                    qtprocessbar.setValue(qtprocessbar.value()+1)
-                    QtWidgets.QApplication.processEvents()
-    ## 3D and multichannel image
-    elif len(img.shape) == 4:
+        if debug is True: print(clrmsg.DEBUG, "Multichannel image")
+        axes = (0,1)
+    elif img.ndim == 4:
         if debug is True: print(clrmsg.DEBUG, "3D and multichannel image")
+        axes = (2,3)
+    else:
+        print(clrmsg.ERROR, "Sorry, I cannot normalize an image with shape: ", img.shape)
+        return img
+    ## One reduction for all slices/channels, kept broadcastable against the image
+    if percentile is None:
+        low = None
+        high = img.max(axis=axes, keepdims=True).astype(np.float64)
+    else:
+        low, high = (0, percentile) if np.isscalar(percentile) else percentile
+        low, high = np.percentile(img, [low, high], axis=axes, keepdims=True)
+    span = high if low is None else high-low
+    scale = np.divide(typesize, span, out=np.zeros_like(span), where=span != 0)
+    if copy is False and dtype == img.dtype and img.flags.writeable:
+        out = img
+    else:
+        out = np.empty(img.shape, dtype=dtype)
+    ## Chunks along the first axis, the maxima either run along it (stacks) or are shared (2D/multichannel images)
+    rows = max(1, chunkbytes//(8*int(np.prod(img.shape[1:]))))
+    chunks = [(k0, min(k0+rows, img.shape[0])) for k0 in range(0, img.shape[0], rows)]
+    if qtprocessbar:
+        maximum = int(len(chunks)*1.25)
+        qtprocessbar.setMaximum(maximum)
+        qtprocessbar.setValue(int(maximum*0.1))
+        QtWidgets.QApplication.processEvents()
+    for k0, k1 in chunks:
+        s = scale if 0 in axes else scale[k0:k1]
+        if low is None:
+            np.multiply(img[k0:k1], s, out=out[k0:k1], casting='unsafe')
+        else:
+            l = low if 0 in axes else low[k0:k1]
+            chunk = np.subtract(img[k0:k1], l, dtype=np.float64)
+            chunk *= s
+            np.clip(chunk, 0, typesize, out=chunk)
+            np.copyto(out[k0:k1], chunk, casting='unsafe')
         if qtprocessbar:
-            maximum = int((int(img.shape[0])+int(img.shape[1]))*1.25)
-            qtprocessbar.setMaximum(maximum)
-            qtprocessbar.setValue(maximum*0.1)
+            qtprocessbar.setValue(qtprocessbar.value()+1)
             QtWidgets.QApplication.processEvents()
-        for i in range(int(img.shape[0])):
-            for ii in range(int(img.shape[1])):
-                img[i,ii,:,:] = np.multiply(img[i,ii,:,:], typesize/img[i,ii,:,:].max(), casting='unsafe')
-                if qtprocessbar:
-                    qtprocessbar.setValue(qtprocessbar.value()+1)
-                    QtWidgets.QApplication.processEvents()
-    return img.astype(dtype)
+    return out
 
 
-def normalize(path,qtprocessbar=None, flip=False, customSaveDir=None):
+def normalize(path,qtprocessbar=None, flip=False, customSaveDir=None, saveformat=None):
     if debug is True: print(clrmsg.DEBUG, "Normalizing:", path)
+    errmsg = checkSaveformat(saveformat)
+    if errmsg is not None:
+        print(clrmsg.ERROR, errmsg)
+        return
     img = tf.imread(path)
     if qtprocessbar:
         qtprocessbar.setValue(10)
         QtWidgets.QApplication.processEvents()
     img = norm_img(img,qtprocessbar=qtprocessbar)
     fpath,fname = os.path.split(path)
-    fname_norm = os.path.join(fpath,"flip_norm_"+fname) if flip else os.path.join(fpath,"norm_"+fname)
+    fname_norm = "flip_norm_"+fname if flip else "norm_"+fname
     if customSaveDir:
         fname_norm = os.path.join(customSaveDir, fname_norm)
     else:
@@ -526,52 +944,144 @@ def normalize(path,qtprocessbar=None, flip=False, customSaveDir=None):
     if flip:
         if debug is True: print(clrmsg.DEBUG, "Flipping...")
         img = np.flip(img, axis=-1)
-    if len(img.shape) == 4:
-        tf.imsave(fname_norm, img, imagej=True)
-    else:
-        tf.imsave(fname_norm, img)
+    imsave(fname_norm, img, imagej=len(img.shape) == 4, saveformat=saveformat)
     if debug is True: print(clrmsg.DEBUG, "		...done")
     if debug is True: print(clrmsg.DEBUG, "Finished normalizing.")
 
 
-def mip(path,qtprocessbar=None, customSaveDir=None, flip=False, normalize=False):
+def projectStack(path, projections=('max',), flip=False, qtprocessbar=None, progressrange=(0,100)):
+    """Project an image stack along z reading one tiff page at a time.
+
+    Supported layouts are [z,y,x] and multichannel stacks ([z,c,y,x] or [c,z,y,x], the z axis is taken from
+    the tiff header; without z information the second axis is used as before). All requested projections are
+    folded into running buffers in a single pass, so the peak memory is one page plus the projections.
+
+    projections: any of 'max', 'min', 'sum', 'mean' and 'argmax' (depth map: z index of the maximum).
+    Returns a dict of projection name and [y,x] or [c,y,x] array, or an error message like interpol().
+    """
+    for name in projections:
+        if name not in projectionTypes:
+            return "ERROR: Unknown projection '{0}', choose from {1}".format(name, ", ".join(projectionTypes))
+    with tf.TiffFile(path) as tif:
+        series = tif.series[0]
+        pages = series.pages
+        pageshape = tuple(pages[0].shape)
+        shape = tuple(series.shape)
+        stackshape = shape[:len(shape)-len(pageshape)]
+        if len(stackshape) == 1:
+            zaxis = 0
+        elif len(stackshape) == 2:
+            zaxis = series.axes.index('Z') if 'Z' in series.axes[:2] else 1
+        else:
+            return "ERROR: I'm sorry, I don't know this image shape: {0}".format(shape)
+        if len(pages) != int(np.prod(stackshape)) or any(page is None for page in pages):
+            return "ERROR: I'm sorry, cannot read this image stack page by page: {0}".format(shape)
+        nz = stackshape[zaxis]
+        outshape = stackshape[:zaxis]+stackshape[zaxis+1:]+pageshape
+        dtype = series.dtype
+        ## x is the second last axis of RGB pages
+        flipaxis = -2 if series.axes.endswith('S') else -1
+        running = {}
+        if 'max' in projections or 'argmax' in projections:
+            running['max'] = np.empty(outshape, dtype=dtype)
+        if 'min' in projections:
+            running['min'] = np.empty(outshape, dtype=dtype)
+        if 'sum' in projections or 'mean' in projections:
+            running['sum'] = np.zeros(outshape, dtype=np.float64)
+        if 'argmax' in projections:
+            running['argmax'] = np.zeros(outshape, dtype=np.uint16 if nz < 65536 else np.uint32)
+        ping = time.time()
+        for p, page in enumerate(pages):
+            data = page.asarray()
+            index = np.unravel_index(p, stackshape)
+            z = index[zaxis]
+            c = index[:zaxis]+index[zaxis+1:]
+            if z == 0:
+                for name in ['max', 'min']:
+                    if name in running:
+                        running[name][c] = data
+            else:
+                if 'argmax' in running:
+                    np.putmask(running['argmax'][c], data > running['max'][c], z)
+                if 'max' in running:
+                    np.maximum(running['max'][c], data, out=running['max'][c])
+                if 'min' in running:
+                    np.minimum(running['min'][c], data, out=running['min'][c])
+            if 'sum' in running:
+                running['sum'][c] += data
+            if qtprocessbar:
+                qtprocessbar.setValue(int(progressrange[0]+(progressrange[1]-progressrange[0])*(p+1)/len(pages)))
+                QtWidgets.QApplication.processEvents()
+    if debug is True: print(clrmsg.DEBUG, "Projected {0} pages in {1:.2f} s".format(len(pages), time.time()-ping))
+    result = {}
+    for name in projections:
+        if name == 'mean':
+            result[name] = (running['sum']/nz).astype(np.float32)
+        else:
+            result[name] = running[name]
+        if flip:
+            result[name] = np.flip(result[name], axis=flipaxis)
+    return result
+
+
+def mip(path,qtprocessbar=None, customSaveDir=None, flip=False, normalize=False, projections=('max',), saveformat=None):
+    """Save the maximum intensity projection (MIP) of an image stack as MIP_<filename> (MIP_norm_<filename>
+    if normalized). Additional projections computed in the same pass (see projectStack) are saved as
+    MIN_, SUM_, MEAN_ and DEPTH_ (argmax) <filename>. The stack is read page by page."""
     if debug is True: print(clrmsg.DEBUG, "Creating normalized Maximum Intensity Projection (MIP):", path)
-    img = tf.imread(path)
+    errmsg = checkSaveformat(saveformat)
+    if errmsg is not None:
+        print(clrmsg.ERROR, errmsg)
+        return
     if qtprocessbar:
         qtprocessbar.setValue(10)
         QtWidgets.QApplication.processEvents()
+    imgs = projectStack(path, projections, flip=flip, qtprocessbar=qtprocessbar, progressrange=(10,90))
+    if type(imgs) == str:
+        print(clrmsg.ERROR, imgs)
+        return
     fpath,fname = os.path.split(path)
-    fname_mip = "flip_MIP_"+fname if flip else "MIP_"+fname
-    fname_mip_norm = "flip_MIP_norm_"+fname if flip else "MIP_norm_"+fname
-    if customSaveDir:
-        fname_mip = os.path.join(customSaveDir, fname_mip)
-        fname_mip_norm = os.path.join(customSaveDir, fname_mip_norm)
-    else:
-        fname_mip = os.path.join(fpath, fname_mip)
-        fname_mip_norm = os.path.join(fpath, fname_mip_norm)
-    if len(img.shape) == 4:
-        img = np.amax(img, axis=1)
-        if flip:
-            if debug is True: print(clrmsg.DEBUG, "Flipping...")
-            img = np.flip(img, axis=-1)
-        if normalize:
-            if debug is True: print(clrmsg.DEBUG, "Normalizing...")
-            img = norm_img(img)
-        if debug is True: print(clrmsg.DEBUG, "Saving...")
-        tf.imsave(fname_mip_norm if normalize else fname_mip, img, imagej=True)
-        if debug is True: print(clrmsg.DEBUG, "		...done")
-    elif len(img.shape) == 3:
-        img = np.amax(img, axis=0)
-        if flip:
-            if debug is True: print(clrmsg.DEBUG, "Flipping...")
-            img = np.flip(img, axis=-1)
-        if normalize:
+    for name, img in imgs.items():
+        prefix = projectionTypes[name]
+        if normalize and name != 'argmax':
             if debug is True: print(clrmsg.DEBUG, "Normalizing...")
             img = norm_img(img)
-        if debug is True: print(clrmsg.DEBUG, "Saving...")
-        tf.imsave(fname_mip_norm if normalize else fname_mip, img)
+            prefix += "_norm"
+        fname_out = "flip_"+prefix+"_"+fname if flip else prefix+"_"+fname
+        fname_out = os.path.join(customSaveDir if customSaveDir else fpath, fname_out)
+        if debug is True: print(clrmsg.DEBUG, "Saving...", fname_out)
+        ## Multichannel projections as ImageJ hyperstack if ImageJ can handle the data type
+        imsave(fname_out, img, imagej=img.ndim == 3 and img.dtype in (np.uint8, np.uint16, np.float32), saveformat=saveformat)
         if debug is True: print(clrmsg.DEBUG, "		...done")
-    else: print(clrmsg.ERROR, "I'm sorry, I don't know this image shape: {0}".format(img.shape))
+
+
+def normalizeFiles(files, qtprocessbar=None, flip=False, customSaveDir=None, saveformat=None):
+    """Normalize every tiff file of files (see normalize). Used by the Qt and the tkinter front-end.
+    Returns the list of processed files."""
+    done = []
+    for filename in files:
+        if os.path.splitext(filename)[1] in ('.tif', '.tiff'):
+            print("Normalizing:", filename)
+            normalize(filename, qtprocessbar=qtprocessbar, flip=flip, customSaveDir=customSaveDir, saveformat=saveformat)
+            print("		...done")
+            done.append(filename)
+    print("Finished normalizing.")
+    return done
+
+
+def mipFiles(files, qtprocessbar=None, customSaveDir=None, flip=False, normalize=True, projections=('max',), saveformat=None):
+    """Save the (normalized) MIP of every tiff file of files (see mip). Used by the Qt and the tkinter front-end.
+    Returns the list of processed files."""
+    done = []
+    for filename in files:
+        if os.path.splitext(filename)[1] in ('.tif', '.tiff'):
+            print("Creating {0}Maximum Intensity Projection (MIP): {1}".format("normalized " if normalize else "", filename))
+            mip(filename, qtprocessbar=qtprocessbar, customSaveDir=customSaveDir, flip=flip, normalize=normalize,
+                projections=projections, saveformat=saveformat)
+            print("		...done")
+            done.append(filename)
+    print("Maximum Intensity Projection finished.")
+    return done
 
 
 if __name__ == '__main__':
@@ -668,52 +1178,18 @@ if __name__ == '__main__':
         print("Finished converting image stack sequences to single stack file(s).")
         print("="*40)
 
-    ## Normalize Image
-    def normalize():
+    ## Normalize Image (same code path as the Qt front-end, see normalizeFiles())
+    def normalizeFilesTk():
         files = tkinter.filedialog.askopenfilenames(parent=root,title='Choose image(stack) file(s)')
         if not files: return
-        for filename in files:
-            if filename.endswith('.tif'):
-                print("Normalizing:", filename)
-                img = tf.imread(filename)
-                img = norm_img(img)
-                fpath,fname = os.path.split(filename)
-                fname_norm = os.path.join(fpath,"norm_"+fname)
-                if len(img.shape) == 4:
-                    tf.imsave(fname_norm, img, imagej=True)
-                else:
-                    tf.imsave(fname_norm, img)
-                print("		...done")
-        print("Finished normalizing.")
+        normalizeFiles(files)
         print("="*40)
 
-    def mip():
+    ## Normalized MIP (same code path as the Qt front-end, see mipFiles())
+    def mipFilesTk():
         files = tkinter.filedialog.askopenfilenames(parent=root,title='Choose image(stack) files')
         if not files: return
-        for filename in files:
-            if filename.endswith('.tif'):
-                print("Creating normalized Maximum Intensity Projection (MIP):", filename)
-                img = tf.imread(filename)
-                fpath,fname = os.path.split(filename)
-                fname_norm = os.path.join(fpath,"MIP_"+fname)
-                if len(img.shape) == 4:
-                    img_MIP = np.zeros((img.shape[0],img.shape[2],img.shape[3]), dtype=img.dtype)
-                    for i in range(0,img.shape[0]):
-                        for ii in range(0,img.shape[2]):
-                            for iii in range(0,img.shape[3]):
-                                img_MIP[i,ii,iii] = img[i,:,ii,iii].max()
-                    img_MIP = norm_img(img_MIP)
-                    tf.imsave(fname_norm, img_MIP, imagej=True)
-                elif len(img.shape) == 3:
-                    img_MIP = np.zeros((img.shape[1],img.shape[2]), dtype=img.dtype)
-                    for i in range(0,img.shape[1]):
-                        for ii in range(0,img.shape[2]):
-                            img_MIP[i,ii] = img[:,i,ii].max()
-                    img_MIP = norm_img(img_MIP)
-                    tf.imsave(fname_norm, img_MIP)
-                else: print("I'm sorry, I don't know this image shape: {0}".format(img.shape))
-                print("		...done")
-        print("Maximum Intensity Projection finished.")
+        mipFiles(files, normalize=True)
         print("="*40)
 
     ## Set up UI elements
@@ -731,10 +1207,10 @@ if __name__ == '__main__':
     B3 = tkinter.Button(root, text="Just convert image stack sequence to single stack files...", command=getdircon)
     B3.config(width=50)
     B3.grid(row=7,column=0,columnspan=2)
-    B4 = tkinter.Button(root, text="Normalize image(stack) files...", command=normalize)
+    B4 = tkinter.Button(root, text="Normalize image(stack) files...", command=normalizeFilesTk)
     B4.config(width=50)
     B4.grid(row=8,column=0,columnspan=2)
-    B5 = tkinter.Button(root, text="Create normalized MIP of image stack files...", command=mip)
+    B5 = tkinter.Button(root, text="Create normalized MIP of image stack files...", command=mipFilesTk)
     B5.config(width=50)
     B5.grid(row=9,column=0,columnspan=2)
     ### Check-boxes
@@ -62,3 +62,119 @@ def test_2Dgauss():
     params = beadPos.fitgaussian(data)
 
     assert (round(params[1]), round(params[2])) == (100, 100)
+
+
+def test_localize(testVolume):
+    xy = np.array([[70, 20], [71.4, 18.7], [150, 20]])
+    positions, quality = beadPos.localize(xy,testVolume,optimize=False)
+    assert abs(positions[0,2]-beadPos.getzGauss(70,20,testVolume)) < 0.0001
+    assert np.isnan(positions[2,2]) and np.isnan(quality[2])
+    assert (positions[2,:2] == xy[2]).all()
+    positions, quality = beadPos.localize(xy,testVolume,optimize=True,cutout=15)
+    for i in range(2):
+        assert np.abs(positions[i]-(70,20,40)).max() < 0.1
+        assert quality[i] > 0.8
+    ## the beads are fitted independently of each other in the batch
+    for i in range(3):
+        position, r2 = beadPos.localize(xy[i],testVolume,optimize=True,cutout=15)
+        assert np.allclose(positions[i], position[0], equal_nan=True)
+        assert np.allclose(quality[i], r2[0], equal_nan=True)
+
+
+def test_fitGauss1D():
+    rng = np.random.default_rng(0)
+    x = np.arange(60.)
+    mu, sigma = rng.uniform(20, 40, 200), rng.uniform(2, 4, 200)
+    clean = 100*np.exp(-(x-mu[:,None])**2/(2*sigma[:,None]**2))
+    ## closed-form start values are exact without noise
+    assert np.allclose(beadPos.gaussInit1D(clean)[:,1], mu)
+    for snr, limit in ((50, 0.1), (10, 0.4)):
+        popt, pcov, success = beadPos.fitGauss1D(clean + rng.normal(0, 100/snr, clean.shape))
+        assert success.all()
+        assert np.sqrt(np.mean((popt[:,1]-mu)**2)) < limit
+        assert np.sqrt(np.mean((popt[:,2]-sigma)**2)) < 2*limit
+    ## no peak
+    assert not beadPos.fitGauss1D(np.zeros(60))[2][0]
+
+
+def test_fitGauss2D():
+    rng = np.random.default_rng(1)
+    X, Y = np.indices((30, 30))
+    cx, cy, width = rng.uniform(12, 18, 100), rng.uniform(12, 18, 100), rng.uniform(2, 3.5, 100)
+    clean = 10 + 100*np.exp(-((X-cx[:,None,None])**2+(Y-cy[:,None,None])**2)/(2*width[:,None,None]**2))
+    for snr, limit in ((50, 0.05), (10, 0.25), (3, 0.8)):
+        popt, pcov, success = beadPos.fitGauss2D(clean + rng.normal(0, 100/snr, clean.shape))
+        assert success.all()
+        assert np.sqrt(np.mean((popt[:,1]-cx)**2 + (popt[:,2]-cy)**2)) < limit
+        assert np.abs(np.median(popt[:,5]) - 10) < limit*10
+    ## drop-in: fit2Dgaussian returns (height, center_x, center_y, width_x, width_y)
+    p = beadPos.fit2Dgaussian(clean[0])
+    assert np.allclose(p, (100, cx[0], cy[0], width[0], width[0]))
+
+
+def test_localize3D(testVolume):
+    rng = np.random.default_rng(2)
+    Z, Y, X = np.indices((15, 17, 17))
+    center = np.column_stack([rng.uniform(6, 8, 10), rng.uniform(7, 9, 10), rng.uniform(7, 9, 10)])
+    width = (3., 2., 2.)
+    volumes = 5 + 100*np.exp(-sum(((c-center[:,i,None,None,None])/width[i])**2 for i, c in enumerate((Z, Y, X)))/2)
+    popt, pcov, success = beadPos.fitGauss3D(volumes)
+    assert success.all()
+    assert np.allclose(popt[:,1:4], center) and np.allclose(popt[:,4:7], width) and np.allclose(popt[:,7], 5)
+    centers, quality = beadPos.radialCenter3D(volumes + rng.normal(0, 1, volumes.shape))
+    assert np.abs(centers-center).max() < 0.1
+    assert (quality > 0.9).all()
+    ## flat volume
+    assert np.isnan(beadPos.radialCenter3D(np.ones((9, 9, 9)))[0]).all()
+    xy = np.array([[71.4, 18.7], [150, 20]])
+    for method in ('gauss3D', 'radial'):
+        positions, quality = beadPos.localize(xy,testVolume,cutout=15,method=method)
+        assert np.abs(positions[0]-(70,20,40)).max() < 0.05
+        assert quality[0] > 0.7
+        assert np.isnan(positions[1,2]) and np.isnan(quality[1])
+
+
+def test_detect(testVolume):
+    rng = np.random.default_rng(3)
+    shape = (24, 96, 96)
+    beads = np.column_stack([rng.uniform(12, 84, (12, 2)), rng.uniform(5, 19, 12)])
+    z, y, x = np.indices(shape, sparse=True)
+    img = 20 + sum(200*np.exp(-((x-bx)**2/12.5 + (y-by)**2/12.5 + (z-bz)**2/8.)) for bx, by, bz in beads)
+    img = rng.poisson(img).astype('uint16')
+    ## chunked, threaded filter equals the whole stack filter
+    whole = beadPos.dogFilter(img, (1.5, 2., 2.), chunk=shape[0])
+    assert np.array_equal(beadPos.dogFilter(img, (1.5, 2., 2.), chunk=5, workers=3), whole)
+    positions, response = beadPos.detect(img, chunk=5, workers=2)
+    assert len(positions) == len(beads) and (np.diff(response) <= 0).all()
+    distance = np.linalg.norm(positions[:, None] - beads[None], axis=-1)
+    assert distance.min(axis=1).max() < 0.3 and len(set(distance.argmin(axis=1))) == len(beads)
+    ## sphere of radius 10 in the test volume
+    positions, response = beadPos.detect(testVolume, sigma=6., threshold=1.)
+    assert len(positions) == 1 and np.abs(positions[0] - (70, 20, 40)).max() < 1
+
+
+class _Recorder():
+    ## Stands in for the main window, records the calls to its widget_matplotlib
+    def __init__(self):
+        self.calls = []
+        self.widget_matplotlib = self
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append(name)
+
+
+def test_fitResults(testVolume):
+    data = np.array([np.arange(30), 3 + 50*np.exp(-(np.arange(30)-12.3)**2/8.)])
+    result = beadPos.fitProfile(data)
+    assert result.success and np.allclose(result.params, (50, 12.3, 2)) and result.residual < 1e-12
+    ## data is not modified
+    assert data[1].min() > 3 - 1e-9 and np.allclose(result.fit, result.data[1])
+    result = beadPos.fitImage(np.ones((9, 9)))
+    assert not result.success and np.isnan(result.params).all()
+    ## fits draw once at the end, failed fits also without parent
+    parent = _Recorder()
+    beadPos.getzGauss(70,20,testVolume,parent=parent,optimize=True,cutout=15)
+    assert parent.calls == ['setupScatterCanvas', 'xyPlot', 'xyPlot', 'matshowPlot']
+    assert beadPos.fit2Dgaussian(np.ones((9, 9))) is None
+    parent.calls = []
+    assert beadPos.fit2Dgaussian(np.ones((9, 9)), parent) is None and parent.calls == ['matshowPlot']
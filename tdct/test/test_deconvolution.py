@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""pytest tests of tdct.deconvolution"""
+import os
+import pytest
+import numpy as np
+import scipy.signal
+import scipy.ndimage
+import tifffile as tf
+from tdct import deconvolution
+
+deconvolution.debug = False
+
+
+def _data(shape=(12, 20, 18), seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.random(shape) + 0.1
+    z, y, x = np.mgrid[-2:3, -3:4, -3:4]
+    psf = np.exp(-(x**2 + y**2)/4. - z**2/2.)
+    return data, psf/psf.sum()
+
+
+def test_RLEngine():
+    data, psf = _data()
+    ## reference: the plain scipy.signal version of the iteration
+    xn = data.copy()
+    for i in range(3):
+        yhx = data/scipy.signal.convolve(xn, psf, mode='same', method='fft')
+        xn = xn*scipy.signal.correlate(yhx, psf, mode='same', method='fft')
+    engine = deconvolution.RLEngine(data.shape, psf, dtype='float64')
+    assert np.allclose(engine.run(data, 3), xn)
+    ## engine is reusable and float32 stays close
+    assert np.allclose(engine.run(data, 3), xn)
+    result = deconvolution.RLEngine(data.shape, psf).run(data, 3)
+    assert result.dtype == np.float32
+    assert np.allclose(result, xn, rtol=1e-4)
+
+
+def test_RLEngineCallback():
+    data, psf = _data()
+    engine = deconvolution.RLEngine(data.shape, psf, dtype='float64')
+    iterations = []
+
+    def callback(i, change):
+        iterations.append(i)
+        return i < 2
+    stopped = engine.run(data, 10, callback)
+    assert iterations == [1, 2]
+    assert np.allclose(stopped, engine.run(data, 2))
+    with pytest.raises(ValueError):
+        engine.run(data[1:], 1)
+
+
+def test_RLEngineWorkers():
+    assert deconvolution.workerCount(4) == 4
+    assert deconvolution.workerCount(0) == 1
+    assert deconvolution.workerCount(-1) == (os.cpu_count() or 1)
+    data, psf = _data()
+    with deconvolution.RLEngine(data.shape, psf, workers=1) as engine:
+        single = engine.run(data, 3)
+    with deconvolution.RLEngine(data.shape, psf, workers=3) as engine:
+        assert engine._pool is not None
+        assert np.allclose(engine.run(data, 3), single)
+    assert engine._pool is None
+
+
+def test_tileGrid():
+    tiles = deconvolution.tileGrid((5, 50, 37), (20, 16), (4, 3))
+    assert len(tiles) == 3*3
+    weightsum = np.zeros((50, 37))
+    for outer, weights in tiles:
+        assert weightsum[outer[1:]].shape == weights.shape
+        weightsum[outer[1:]] += weights
+    assert np.allclose(weightsum, 1)
+    with pytest.raises(ValueError):
+        deconvolution.tileGrid((50, 50), (8, 8), (4, 4))
+
+
+def test_deconvolveTiled(tmpdir):
+    data, psf = _data((6, 70, 64))
+    whole = deconvolution.RLEngine(data.shape, psf).run(data, 5)
+    tiled = deconvolution.deconvolveTiled(data, psf, 5, tile=(32, 32), processes=2)
+    assert np.abs(tiled - whole).max() < 1e-3*(whole.max() - whole.min())
+    ## cancelled after the first tile
+    done = []
+    assert deconvolution.deconvolveTiled(
+        data, psf, 5, tile=(32, 32), processes=1, callback=lambda n, ntiles: done.append(n) or False) is None
+    assert done == [1]
+    ## file version, memory mapped input
+    datapath, psfpath = str(tmpdir.join('data.tif')), str(tmpdir.join('psf.tif'))
+    tf.imwrite(datapath, data.astype('float32'))
+    tf.imwrite(psfpath, psf.astype('float32'))
+    deconvolution.doRLDeconvolutionTiled(datapath, psfpath, 5, tile=(32, 32), processes=1)
+    result = tf.imread(str(tmpdir.join('DeconvRL5it_data.tif')))
+    assert result.shape == data.shape and result.dtype == np.uint8
+    ## temporary accumulator is removed
+    assert sorted(os.listdir(str(tmpdir))) == ['DeconvRL5it_data.tif', 'data.tif', 'psf.tif']
+
+
+def test_RLEngineVariants():
+    ## blurred (noise free) spots
+    rng = np.random.default_rng(0)
+    truth = np.full((24, 48, 48), 0.1)
+    truth[tuple(rng.integers([6, 8, 8], [18, 40, 40], (10, 3)).T)] = 50
+    truth = scipy.ndimage.gaussian_filter(truth, 1.)
+    z, y, x = np.mgrid[-2:3, -5:6, -5:6]
+    psf = np.exp(-(x**2 + y**2)/6. - z**2/3.)
+    psf /= psf.sum()
+    data = scipy.signal.fftconvolve(truth, psf, mode='same')
+    inner = (slice(4, -4), slice(8, -8), slice(8, -8))
+
+    def error(estimate):
+        return np.linalg.norm((estimate - truth)[inner])/np.linalg.norm(truth[inner])
+    engine = deconvolution.RLEngine(data.shape, psf, dtype='float64')
+    plain = engine.run(data, 10)
+    assert len(engine.changes) == 10 and engine.changes[-1] < engine.changes[0]
+    assert error(engine.run(data, 10, accelerate=True)) < 0.8*error(plain)
+    ## early stopping on the relative change
+    engine.run(data, 100, tol=0.02)
+    assert len(engine.changes) < 100 and engine.changes[-1] < 0.02 <= engine.changes[-2]
+    ## total variation smooths the estimate
+    smooth = engine.run(data, 10, tv=0.01)
+    assert np.isfinite(smooth).all()
+    assert np.abs(np.diff(smooth, axis=-1)).sum() < np.abs(np.diff(plain, axis=-1)).sum()
+
+
+def test_PSFCache(tmpdir):
+    data, psf = _data()
+    cache = deconvolution.PSFCache(cachedir=str(tmpdir.join('cache')))
+    engine = deconvolution.RLEngine(data.shape, psf, cache=cache)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert len(os.listdir(str(tmpdir.join('cache')))) == 2
+    again = deconvolution.RLEngine(data.shape, psf, cache=cache)
+    assert cache.hits == 1 and again.psf_fft is engine.psf_fft
+    reference = deconvolution.RLEngine(data.shape, psf)
+    assert np.allclose(engine.run(data, 2), reference.run(data, 2))
+    ## other shape or dtype is another entry, LRU eviction by size
+    deconvolution.RLEngine(data[1:].shape, psf, cache=cache)
+    deconvolution.RLEngine(data.shape, psf, dtype='float64', cache=cache)
+    assert (cache.hits, cache.misses, len(cache._entries)) == (1, 3, 3)
+    cache.maxbytes = 1
+    deconvolution.RLEngine(data.shape, psf*2, cache=cache)
+    assert len(cache._entries) == 1
+    ## a new session loads the spectra from disk
+    fresh = deconvolution.PSFCache(cachedir=str(tmpdir.join('cache')))
+    loaded = deconvolution.RLEngine(data.shape, psf, cache=fresh)
+    assert fresh.misses == 1 and np.array_equal(loaded.psf_fft, engine.psf_fft)
+    assert len(os.listdir(str(tmpdir.join('cache')))) == 8
+    ## the disk cache is limited, the latest spectra are kept
+    fresh.maxdiskbytes = 1
+    deconvolution.RLEngine(data.shape, psf*3, cache=fresh)
+    assert len(os.listdir(str(tmpdir.join('cache')))) == 2
+
+
+def test_DeconvolutionQueue(tmpdir):
+    data, psf = _data((5, 16, 16))
+    psfpath = str(tmpdir.join('psf.tif'))
+    tf.imwrite(psfpath, psf.astype('float32'))
+    datapaths = [str(tmpdir.join('data{0}.tif'.format(i))) for i in range(3)]
+    for datapath in datapaths:
+        tf.imwrite(datapath, data.astype('float32'))
+    cachedir = tmpdir.join('cache')
+    queue = deconvolution.DeconvolutionQueue(processes=2, cachedir=str(cachedir))
+    finished, failed, progress = [], [], []
+    queue.fileFinished.connect(lambda datapath, fname: finished.append(fname))
+    queue.fileFailed.connect(lambda datapath, errmsg: failed.append((datapath, errmsg)))
+    queue.progress.connect(progress.append)
+    changes = []
+    queue.change.connect(lambda datapath, i, change: changes.append((datapath, i, change)))
+    for datapath in datapaths:
+        queue.add(datapath, psfpath, 3, workers=1)
+    queue.add(str(tmpdir.join('missing.tif')), psfpath, 3)
+    assert queue.pending() == 4
+    queue.wait()
+    assert queue.pending() == 0 and progress[-1] == 100
+    assert sorted(finished) == [str(tmpdir.join('DeconvRL3it_data{0}.tif'.format(i))) for i in range(3)]
+    assert [datapath for datapath, errmsg in failed] == [str(tmpdir.join('missing.tif'))]
+    assert changes and set(datapath for datapath, i, change in changes) <= set(datapaths)
+    assert all(1 <= i <= 3 and change > 0 for datapath, i, change in changes)
+    ## the job processes share the psf spectra through the disk cache, later batches load them
+    spectra = sorted(str(fn) for fn in cachedir.listdir())
+    assert len(spectra) == 2
+    mtimes = [os.path.getmtime(fn) for fn in spectra]
+    ## early stopping and TV are passed on to the jobs
+    changes.clear()
+    queue.add(datapaths[0], psfpath, 50, workers=1, tol=0.5, tv=0.001)
+    queue.wait()
+    assert 0 < max(i for datapath, i, change in changes) < 50 and changes[-1][2] < 0.5
+    assert sorted(str(fn) for fn in cachedir.listdir()) == spectra
+    assert [os.path.getmtime(fn) for fn in spectra] == mtimes
+    ## cancelled jobs do not write anything
+    failed.clear()
+    queue.add(datapaths[0], psfpath, 200, workers=1)
+    queue.cancel()
+    queue.wait()
+    assert failed == [(datapaths[0], 'Cancelled')]
+    assert not os.path.isfile(str(tmpdir.join('DeconvRL200it_data0.tif')))
+    ## files added after a cancel (while the cancelled jobs still finish) run
+    failed.clear()
+    finished.clear()
+    queue.add(datapaths[0], psfpath, 200, workers=1)
+    queue.cancel()
+    queue.add(datapaths[1], psfpath, 4, workers=1)
+    queue.wait()
+    assert failed == [(datapaths[0], 'Cancelled')]
+    assert finished == [str(tmpdir.join('DeconvRL4it_data1.tif'))]
+    ## tiled jobs run in the background too, without change reports
+    finished.clear()
+    changes.clear()
+    queue.add(datapaths[2], psfpath, 3, tiled=True, tile=(8, 8), overlap=(2, 2), processes=1)
+    queue.wait()
+    assert finished == [str(tmpdir.join('DeconvRL3it_data2.tif'))] and not changes and progress[-1] == 100
+    failed.clear()
+    queue.add(datapaths[2], psfpath, 5, tiled=True, tile=(8, 8), overlap=(2, 2), processes=1)
+    queue.cancel()
+    queue.wait()
+    assert failed == [(datapaths[2], 'Cancelled')]
+    assert not os.path.isfile(str(tmpdir.join('DeconvRL5it_data2.tif')))
+
+
+def test_outputdtype(tmpdir):
+    data, psf = _data((5, 16, 16))
+    datapath, psfpath = str(tmpdir.join('data.tif')), str(tmpdir.join('psf.tif'))
+    tf.imwrite(datapath, data.astype('float32'))
+    tf.imwrite(psfpath, psf.astype('float32'))
+    engine = deconvolution.RLEngine(data.shape, psf)
+    result = engine.run(data, 3)
+    fname = deconvolution.doRLDeconvolution7(datapath, psfpath, 3, outputdtype='float32')
+    assert fname == str(tmpdir.join('DeconvRL3it_data.tif'))
+    assert np.array_equal(tf.imread(fname), result)
+    ## the maximum is the largest integer (no overflow to 0)
+    for outputdtype in ['uint8', 'uint16']:
+        deconvolution.doRLDeconvolution7(datapath, psfpath, 3, outputdtype=outputdtype)
+        saved = tf.imread(fname)
+        imax = np.iinfo(outputdtype).max
+        assert saved.dtype == outputdtype and saved.min() == 0 and saved.max() == imax
+        assert saved.flat[np.argmax(result)] == imax and saved.flat[np.argmin(result)] == 0
+    assert deconvolution.doRLDeconvolution7(datapath, psfpath, 3, outputdtype='int8') is None
+
+
+def test_deconvolveROI(tmpdir):
+    data, psf = _data((6, 70, 64))
+    whole = deconvolution.RLEngine(data.shape, psf).run(data, 5)
+    points = [(30.2, 35.7, 2.), (2., 66., None), (100., 5., None)]
+    crops = deconvolution.deconvolveROI(data, psf, points, 5, radius=(8, 6), processes=2)
+    assert crops[2] is None
+    ## crop clipped at the stack border
+    assert crops[1].offset == (58, 0) and crops[1].data.shape == (6, 12, 9)
+    for crop in crops[:2]:
+        y0, x0 = crop.offset
+        ny, nx = crop.data.shape[1:]
+        assert np.abs(crop.data - whole[:, y0:y0+ny, x0:x0+nx]).max() < 1e-3*(whole.max() - whole.min())
+    assert crops[0].offset == (28, 24) and crops[0].point == points[0]
+    ## points from a correlation table export
+    csvpath = str(tmpdir.join('points.csv'))
+    with open(csvpath, 'w') as f:
+        f.write("x\ty\tz\n30.2\t35.7\t2.0\n2\t66\t\n")
+    assert deconvolution.pointsFromCSV(csvpath) == points[:2]
+    datapath, psfpath = str(tmpdir.join('data.tif')), str(tmpdir.join('psf.tif'))
+    tf.imwrite(datapath, data.astype('float32'))
+    tf.imwrite(psfpath, psf.astype('float32'))
+    filecrops = deconvolution.doRLDeconvolutionROI(datapath, psfpath, csvpath, 5, radius=(8, 6), processes=1)
+    assert np.allclose(filecrops[0].data, crops[0].data)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""pytest tests of tdct.deconvolutionBenchmark"""
+
+import json
+import numpy as np
+from tdct import deconvolutionBenchmark as bench
+
+
+def test_referenceVolume(tmpdir):
+    data, truth, psf = bench.referenceVolume((16, 32, 32), seed=1, datadir=str(tmpdir))
+    assert data.shape == truth.shape == (16, 32, 32)
+    assert truth.max() >= 500
+    ## Second call loads the stored volumes
+    data2, truth2, _ = bench.referenceVolume((16, 32, 32), seed=1, datadir=str(tmpdir))
+    assert isinstance(data2, np.memmap)
+    assert np.array_equal(data, data2) and np.array_equal(truth, truth2)
+
+
+def test_run(tmpdir):
+    report = str(tmpdir.join('report.json'))
+    caselist = bench.cases([(16, 48, 48)], dtypes=('float32', 'float64'), tiles=(0, 32), iterations=5)
+    assert len(caselist) == 4
+    summary = bench.run(caselist, str(tmpdir), report)
+    with open(report) as f:
+        assert json.load(f)['cases'] == json.loads(json.dumps(summary['cases']))
+    for case in summary['cases']:
+        assert not case.get('failed')
+        assert case['seconds'] > 0
+        ## Deconvolution brings the estimate closer to the truth than the blurred data
+        assert case['error'] < case['dataError']
+    assert len(bench.compare(report, summary)) == 4
+    assert bench.main(['--compare', report, report]) == 0
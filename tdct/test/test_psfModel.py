@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""pytest tests of tdct.psfModel"""
+import pytest
+import numpy as np
+import tifffile as tf
+from tdct import psfModel, deconvolution
+
+psfModel.debug = False
+deconvolution.debug = False
+
+
+def test_gaussian():
+    psf = psfModel.generate('gaussian', (50., 20., 20.), 1.4, 520.)
+    assert all(n % 2 == 1 for n in psf.shape) and psf.dtype == np.float32
+    assert np.isclose(psf.sum(), 1) and np.unravel_index(psf.argmax(), psf.shape) == tuple(n//2 for n in psf.shape)
+    ## standard deviations from the second moments
+    sigmaZ, sigmaXY = psfModel.gaussianSigmas(1.4, 520.)
+    z = (np.arange(psf.shape[0]) - psf.shape[0]//2)*50.
+    x = (np.arange(psf.shape[2]) - psf.shape[2]//2)*20.
+    assert np.isclose(np.sqrt((psf.sum(axis=(1, 2))*z**2).sum()), sigmaZ, rtol=0.05)
+    assert np.isclose(np.sqrt((psf.sum(axis=(0, 1))*x**2).sum()), sigmaXY, rtol=0.05)
+    assert psfModel.generate('gaussian', (20., 20.), 1.4, 520.).ndim == 2
+
+
+def test_gibsonLanni():
+    matched = psfModel.generate('gibsonLanni', (100., 40., 40.), 1.4, 520., ni=1.515, ns=1.515, depth=5000.)
+    assert np.allclose(matched, matched[::-1], atol=1e-6) and np.allclose(matched, matched[:, ::-1], atol=1e-6)
+    assert np.allclose(matched, psfModel.generate('gibsonLanni', (100., 40., 40.), 1.4, 520., ni=1.515, ns=1.515))
+    ## refractive index mismatch elongates the psf and breaks the axial symmetry
+    mismatch = psfModel.generate('gibsonLanni', (100., 40., 40.), 1.2, 520., ni=1.515, ns=1.33, depth=10000.)
+    assert mismatch.shape[0] > matched.shape[0] and not np.allclose(mismatch, mismatch[::-1], atol=1e-4)
+    confocal = psfModel.generate('gibsonLanni', (100., 40., 40.), 1.4, 520., confocal=True)
+    widefield = psfModel.generate('gibsonLanni', (100., 40., 40.), 1.4, 520.)
+    assert confocal.max() > widefield.max()
+
+
+def test_cache(tmpdir):
+    psfModel.clearCache()
+    psf = psfModel.generate('gaussian', (50., 20., 20.), 1.4, 520.)
+    assert psfModel.generate('gaussian', (50, 20, 20), 1.4, 520) is psf
+    assert not psf.flags.writeable
+    with pytest.raises(ValueError):
+        psfModel.generate('airy', (50., 20., 20.), 1.4, 520.)
+    ## voxel size from the header
+    fn = str(tmpdir.join('stack.ome.tif'))
+    data = np.random.default_rng(0).random((9, 32, 32)).astype('float32')
+    tf.imwrite(fn, data, ome=True, metadata={
+        'axes': 'ZYX', 'PhysicalSizeX': 0.02, 'PhysicalSizeY': 0.02, 'PhysicalSizeZ': 0.05})
+    assert psfModel.fromStack(fn, na=1.4, wavelength=520.) is psf
+    with pytest.raises(ValueError):
+        psfModel.fromStack(str(tmpdir.join('stack.ome.tif')), voxelsize=(None, 20., 20.))
+    ## used directly by the deconvolution
+    fname = deconvolution.doRLDeconvolution7(fn, psf, 2, outputdtype='float32')
+    engine = deconvolution.RLEngine(data.shape, psf)
+    assert np.allclose(tf.imread(fname), engine.run(data, 2))
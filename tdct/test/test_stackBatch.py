@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""pytest tests of tdct.stackBatch"""
+from tdct import stackBatch, stackProcessing
+import numpy as np
+import tifffile as tf
+
+stackBatch.debug = False
+
+
+def test_run(tmpdir):
+    img = np.random.randint(65536, size=(6,15,13)).astype('uint16')
+    for name in ['a.tif', 'b.tif']:
+        tf.imwrite(str(tmpdir.join(name)), img)
+    seqdir = tmpdir.mkdir('seq')
+    for z in range(img.shape[0]):
+        tf.imwrite(str(seqdir.join('Tile_001-001-{0:03d}_0-000.tif'.format(z))), img[z])
+    manifest = tmpdir.join('manifest.tsv')
+    manifest.write(
+        "path\ttask\tss_in\tss_out\n"
+        "# comment\n"
+        "a.tif\tinterpolate\t309\t161.25\n"
+        "b.tif\tmip\t\t\n"
+        "seq\tpack\t\t\n"
+        "b.tif\tinterpolate\t\t\n"
+        "missing.tif\tmip\t\t\n")
+    jobs = stackBatch.readManifest(str(manifest), {'method': 'linear'})
+    assert [job.task for job in jobs] == ['interpolate', 'mip', 'pack', 'interpolate', 'mip']
+    outdir = str(tmpdir.join('out'))
+    results = stackBatch.run(jobs, workers=2, customSaveDir=outdir)
+    assert [r[1] for r in results] == ['done', 'done', 'done', 'invalid', 'invalid']
+    compArray = stackProcessing.interpol(img, 309, 161.25, 'linear', showgraph=False)
+    assert np.testing.assert_array_equal(tf.imread(str(tmpdir.join('out', 'a_resliced.tif'))), compArray) is None
+    assert np.testing.assert_array_equal(tf.imread(str(tmpdir.join('out', 'MIP_b.tif'))), img.max(axis=0)) is None
+    assert np.testing.assert_array_equal(tf.imread(str(tmpdir.join('out', 'seq_0.tif'))), img) is None
+    ## Outputs are up to date now
+    results = stackBatch.run(jobs[:3], customSaveDir=outdir)
+    assert [r[1] for r in results] == ['skipped']*3
+    results = stackBatch.run(jobs[:1], customSaveDir=outdir, force=True)
+    assert results[0][1] == 'done'
+
+
+def test_globJobs(tmpdir):
+    for name in ['a.tif', 'b.tif', 'c.txt']:
+        tmpdir.join(name).write('')
+    jobs = stackBatch.globJobs([str(tmpdir.join('*.tif'))], task='normalize')
+    assert [(job.task, job.path) for job in jobs] == [('normalize', str(tmpdir.join('a.tif'))), ('normalize', str(tmpdir.join('b.tif')))]
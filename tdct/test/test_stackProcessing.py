@@ -21,14 +21,34 @@
 # ======================================================================================================================
 from tdct import stackProcessing
 import numpy as np
+from scipy import interpolate
+import tifffile as tf
 
 stackProcessing.debug = False
 
 
 def test_norm_img():
-    compArray = np.array([[127, 127, 127],[254, 254, 254]], dtype='uint8')
+    compArray = np.array([[127, 127, 127],[255, 255, 255]], dtype='uint8')
     retArray = stackProcessing.norm_img(np.array([[1,1,1],[2,2,2]],dtype='uint8'))
     assert np.testing.assert_array_equal(retArray, compArray) is None
+    ## Every slice/channel is scaled to its own maximum
+    for shape, axes in [((6,20,30), (1,2)), ((20,30,3), (0,1)), ((2,6,20,30), (2,3))]:
+        img = np.random.randint(1, 1000, size=shape).astype('uint16')
+        compArray = (img*(65535/img.max(axis=axes, keepdims=True))).astype('uint16')
+        retArray = stackProcessing.norm_img(img, copy=True)
+        assert np.testing.assert_array_equal(retArray, compArray) is None
+        ## In place unless a copy or another data type is requested
+        assert retArray is not img
+        assert stackProcessing.norm_img(img) is img
+        assert np.testing.assert_array_equal(img, compArray) is None
+        retArray = stackProcessing.norm_img(img, dtype='float32')
+        assert retArray.dtype == np.float32
+        assert np.allclose(retArray.max(axis=axes), 1)
+    ## Percentile clipping
+    img = np.arange(1000, dtype='uint16').reshape(10,10,10)
+    retArray = stackProcessing.norm_img(img, copy=True, percentile=(1, 99))
+    assert retArray[:,0,0].max() == 0 and retArray[:,-1,-1].min() == 65535
+    assert retArray.dtype == np.uint16
 
 
 def test_pxSize(image_RGB, image_Grey):
@@ -98,8 +118,198 @@ def test_interpolation():
             [0, 0, 0, 0, 0],
             [0, 0, 0, 0, 0],
             [0, 0, 0, 0, 0]]], dtype="uint8")
+    compArray[0] += 1
     retArray = stackProcessing.interpol(calcArray, 300., 100., "spline", showgraph=False)
     assert np.testing.assert_array_equal(retArray, compArray) is None
-    compArray[0] += 1
     retArray = stackProcessing.interpol(calcArray, 300., 100., "linear", showgraph=False)
     assert np.testing.assert_array_equal(retArray, compArray) is None
+
+
+def test_linearChunked():
+    ## Reference: former slice by slice implementation
+    img = np.random.randint(65536, size=(13,17,19)).astype('uint16')
+    ss_in, ss_out = 309., 161.25
+    sl_in = img.shape[0]
+    sl_out = int((sl_in-1)*(ss_in/ss_out)) + 1
+    compArray = np.zeros((sl_out,)+img.shape[1:], dtype=img.dtype)
+    for k, i in enumerate(np.arange(0,sl_in-1,ss_out/ss_in)):
+        lower = i-int(i)
+        compArray[k] = img[int(i)]*(1-lower) + img[int(i)+1]*lower
+    for chunksize, workers in [(1,1), (4,1), (5,3), (100,2)]:
+        retArray = stackProcessing.linear(img, compArray.shape, ss_in, ss_out, sl_in, sl_out, chunksize=chunksize, workers=workers)
+        assert np.testing.assert_array_equal(retArray, compArray) is None
+
+
+def test_splineBatched():
+    ## Reference: former per pixel implementation. Values stay clear of 0 and 65535 so the spline does not
+    ## overshoot the uint16 range (no wraparound when casting back)
+    img = np.random.randint(16384, 49152, size=(12,9,11)).astype('uint16')
+    ss_in, ss_out = 309., 161.25
+    sl_in = img.shape[0]
+    sl_out = int((sl_in-1)*(ss_in/ss_out)) + 1
+    zx = np.arange(0,sl_out,ss_in/ss_out)[:sl_in]
+    zxnew = np.arange(0, (sl_in-1)*ss_in/ss_out, 1)
+    compArray = np.zeros((len(zxnew),)+img.shape[1:])
+    for px in range(img.shape[-1]):
+        for py in range(img.shape[-2]):
+            compArray[:,py,px] = interpolate.InterpolatedUnivariateSpline(zx, img[:,py,px])(zxnew)
+    compArray = compArray.astype(img.dtype)
+    for striprows in [None, 1, 4]:
+        retArray = stackProcessing.spline(img, (sl_out,)+img.shape[1:], ss_in, ss_out, sl_in, sl_out, striprows=striprows)
+        ## Values lying on integers may be truncated differently due to floating point round off
+        diff = retArray[:len(zxnew)].astype(int)-compArray.astype(int)
+        assert np.abs(diff).max() <= 1
+
+
+def test_interpolStream(tmpdir):
+    img = np.random.randint(65536, size=(9,15,13)).astype('uint16')
+    ss_in, ss_out = 309., 161.25
+    fn = str(tmpdir.join('stack.tif'))
+    fn_zlib = str(tmpdir.join('stack_zlib.tif'))
+    tf.imsave(fn, img)
+    tf.imsave(fn_zlib, img, compression='zlib')
+    filelist = []
+    for z in range(img.shape[0]):
+        filelist.append(str(tmpdir.join('Tile_001-001-{0:03d}_0-000.tif'.format(z))))
+        tf.imsave(filelist[-1], img[z])
+    fn_out = str(tmpdir.join('stack_resliced.tif'))
+    for method in ['linear', 'spline']:
+        compArray = stackProcessing.interpol(img, ss_in, ss_out, method, showgraph=False)
+        for path, memmap in [(fn, False), (fn, True), (fn_zlib, True), (filelist, False)]:
+            with stackProcessing.StackReader(path, memmap=memmap) as reader:
+                ## Window spanning the whole stack equals the in-memory spline
+                stackProcessing.interpolStream(reader, fn_out, ss_in, ss_out, method, window=img.shape[0])
+            assert np.testing.assert_array_equal(tf.imread(fn_out), compArray) is None
+    ## Local spline through a window of neighbouring slices
+    z = np.arange(img.shape[0])[:,None,None]
+    img = (30000+20000*np.sin(z/2.+np.random.rand(1,15,13))).astype('uint16')
+    tf.imsave(fn, img)
+    compArray = stackProcessing.interpol(img, ss_in, ss_out, 'spline', showgraph=False)
+    with stackProcessing.StackReader(fn) as reader:
+        stackProcessing.interpolStream(reader, fn_out, ss_in, ss_out, 'spline', window=4)
+    assert np.abs(tf.imread(fn_out).astype(int)-compArray.astype(int)).max() < 500
+
+
+def test_channelWorkers(tmpdir):
+    img = np.random.randint(65536, size=(2,6,15,13)).astype('uint16')
+    seqdir = tmpdir.mkdir('seq')
+    for c in range(2):
+        for z in range(img.shape[1]):
+            tf.imsave(str(seqdir.join('Tile_001-001-{0:03d}_{1}-000.tif'.format(z, c))), img[c,z])
+    for workers in [1, 2]:
+        outdir = tmpdir.mkdir('out{0}'.format(workers))
+        stackProcessing.main(str(seqdir), 309., 161.25, interpolationmethod='linear', customSaveDir=str(outdir), workers=workers)
+    for c in range(2):
+        compArray = stackProcessing.interpol(img[c], 309., 161.25, 'linear', showgraph=False)
+        for name in ['seq_{0}.tif', 'seq_{0}_resliced.tif']:
+            assert np.testing.assert_array_equal(
+                tf.imread(str(tmpdir.join('out1', name.format(c)))), tf.imread(str(tmpdir.join('out2', name.format(c))))) is None
+        assert np.testing.assert_array_equal(tf.imread(str(tmpdir.join('out2', 'seq_{0}.tif'.format(c)))), img[c]) is None
+        assert np.testing.assert_array_equal(tf.imread(str(tmpdir.join('out2', 'seq_{0}_resliced.tif'.format(c)))), compArray) is None
+
+
+def test_projectStack(tmpdir):
+    img = np.random.randint(65536, size=(7,2,15,13)).astype('uint16')
+    fn = str(tmpdir.join('stack.tif'))
+    projections = ['max', 'min', 'sum', 'mean', 'argmax']
+    for data, kwargs, zaxis in [
+            (img[:,0], {}, 0),
+            (img, {'imagej': True, 'metadata': {'axes': 'ZCYX'}}, 0),
+            (img.swapaxes(0,1), {'ome': True, 'metadata': {'axes': 'CZYX'}}, 1)]:
+        tf.imwrite(fn, data, **kwargs)
+        ret = stackProcessing.projectStack(fn, projections)
+        comp = {
+            'max': data.max(axis=zaxis), 'min': data.min(axis=zaxis), 'sum': data.sum(axis=zaxis, dtype=np.float64),
+            'mean': data.mean(axis=zaxis).astype(np.float32), 'argmax': data.argmax(axis=zaxis)}
+        for name in projections:
+            assert np.testing.assert_array_equal(ret[name], comp[name]) is None
+        assert ret['max'].dtype == data.dtype
+    assert np.testing.assert_array_equal(stackProcessing.projectStack(fn, flip=True)['max'], np.flip(comp['max'], axis=-1)) is None
+    assert type(stackProcessing.projectStack(fn, ['median'])) == str
+    ## mip saves every projection next to the stack
+    stackProcessing.mip(fn, projections=('max', 'argmax'))
+    assert np.testing.assert_array_equal(tf.imread(str(tmpdir.join('MIP_stack.tif'))), comp['max']) is None
+    assert np.testing.assert_array_equal(tf.imread(str(tmpdir.join('DEPTH_stack.tif'))), comp['argmax']) is None
+
+
+def test_mipNormalized(tmpdir):
+    ## Per-pixel reference of the former standalone tool, [c,z,y,x] and [z,y,x]
+    img = np.random.randint(4000, size=(2,6,15,13)).astype('uint16')
+    compArray = np.zeros((img.shape[0],img.shape[2],img.shape[3]), dtype=img.dtype)
+    for i in range(0,img.shape[0]):
+        for ii in range(0,img.shape[2]):
+            for iii in range(0,img.shape[3]):
+                compArray[i,ii,iii] = img[i,:,ii,iii].max()
+    for data, comp in [(img, compArray), (img[0], compArray[0])]:
+        fn = str(tmpdir.join('stack.tif'))
+        tf.imwrite(fn, data)
+        stackProcessing.mip(fn, normalize=True)
+        retArray = tf.imread(str(tmpdir.join('MIP_norm_stack.tif')))
+        assert np.testing.assert_array_equal(retArray, stackProcessing.norm_img(comp, copy=True)) is None
+
+
+def test_mipFilesFrontends(tmpdir):
+    ## Qt front-end (one file, progress bar, save directory) and tkinter front-end (file list) share mipFiles and
+    ## normalizeFiles, compared with the per-pixel reference of the former tkinter tool
+    from PyQt5 import QtWidgets
+    img = np.random.randint(4000, size=(2,6,15,13)).astype('uint16')
+    compArray = np.zeros((img.shape[0],img.shape[2],img.shape[3]), dtype=img.dtype)
+    for i in range(0,img.shape[0]):
+        for ii in range(0,img.shape[2]):
+            for iii in range(0,img.shape[3]):
+                compArray[i,ii,iii] = img[i,:,ii,iii].max()
+    fn = str(tmpdir.join('stack.tif'))
+    tf.imwrite(fn, img)
+    tmpdir.join('notes.txt').write('not an image')
+    qtdir = tmpdir.mkdir('qt')
+    assert stackProcessing.mipFiles([fn], qtprocessbar=QtWidgets.QProgressBar(), customSaveDir=str(qtdir), normalize=True) == [fn]
+    assert stackProcessing.normalizeFiles([fn], qtprocessbar=QtWidgets.QProgressBar(), customSaveDir=str(qtdir)) == [fn]
+    assert stackProcessing.mipFiles([fn, str(tmpdir.join('notes.txt'))]) == [fn]
+    assert stackProcessing.normalizeFiles([fn, str(tmpdir.join('notes.txt'))]) == [fn]
+    qtArray = tf.imread(str(qtdir.join('MIP_norm_stack.tif')))
+    assert np.testing.assert_array_equal(qtArray, stackProcessing.norm_img(compArray, copy=True)) is None
+    assert np.testing.assert_array_equal(tf.imread(str(tmpdir.join('MIP_norm_stack.tif'))), qtArray) is None
+    assert np.testing.assert_array_equal(tf.imread(str(tmpdir.join('norm_stack.tif'))), tf.imread(str(qtdir.join('norm_stack.tif')))) is None
+
+
+def test_saveformat(tmpdir):
+    img = np.random.randint(4000, size=(6,40,50)).astype('uint16')
+    ss_in, ss_out = 309., 161.25
+    fn = str(tmpdir.join('stack.tif'))
+    tf.imwrite(fn, img, metadata={'PixelSize': '0.1'})
+    compArray = stackProcessing.interpol(img, ss_in, ss_out, 'linear', showgraph=False)
+    for streaming in [False, True]:
+        for saveformat in [{'compression': 'zlib', 'tile': 32}, {'compression': 'zlib'}, {'tile': (16, 32), 'bigtiff': True}]:
+            outdir = tmpdir.mkdir('out{0}{1}'.format(int(streaming), len(tmpdir.listdir())))
+            stackProcessing.main(fn, ss_in, ss_out, customSaveDir=str(outdir), streaming=streaming, saveformat=saveformat)
+            with tf.TiffFile(str(outdir.join('stack_resliced.tif'))) as tif:
+                assert np.testing.assert_array_equal(tif.asarray(), compArray) is None
+                ## Pixel size information is preserved
+                assert '"FocusStepSize": "{0}"'.format(ss_out/1000) in tif.pages[0].description
+                assert '"PixelSize": "0.1"' in tif.pages[0].description
+                assert tif.pages[0].is_tiled == ('tile' in saveformat or (streaming and 'compression' in saveformat))
+                assert (tif.pages[0].compression == 8) == ('compression' in saveformat)
+                assert tif.is_bigtiff == ('bigtiff' in saveformat)
+    stackProcessing.normalize(fn, saveformat={'compression': 'zlib', 'tile': 16})
+    assert np.testing.assert_array_equal(
+        tf.imread(str(tmpdir.join('norm_stack.tif'))), stackProcessing.norm_img(img, copy=True)) is None
+    ## Invalid options are reported before anything is written
+    stackProcessing.mip(fn, saveformat={'tile': 20})
+    stackProcessing.mip(fn, saveformat={'compression': 'lzma'})
+    assert not tmpdir.join('MIP_stack.tif').check()
+    assert stackProcessing.checkSaveformat({'compression': 'zstd', 'level': 3}) is None or 'imagecodecs' in stackProcessing.checkSaveformat({'compression': 'zstd'})
+
+
+def test_channelWorkersFailure(tmpdir, capsys):
+    img = np.random.randint(65536, size=(2,6,15,13)).astype('uint16')
+    seqdir = tmpdir.mkdir('seq')
+    for c in range(2):
+        for z in range(img.shape[1]):
+            tf.imsave(str(seqdir.join('Tile_001-001-{0:03d}_{1}-000.tif'.format(z, c))), img[c,z])
+    ## A slice of another size breaks channel 1, channel 0 is still processed
+    tf.imsave(str(seqdir.join('Tile_001-001-003_1-000.tif')), img[1,3,:5])
+    outdir = tmpdir.mkdir('out')
+    stackProcessing.main(str(seqdir), 309., 161.25, interpolationmethod='linear', customSaveDir=str(outdir), workers=2)
+    assert 'Channel 1 failed' in capsys.readouterr().out
+    assert np.testing.assert_array_equal(tf.imread(str(outdir.join('seq_0.tif'))), img[0]) is None
+    assert outdir.join('seq_0_resliced.tif').check()
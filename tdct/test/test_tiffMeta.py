@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""pytest tests of tdct.tiffMeta"""
+import os
+from tdct import tiffMeta, stackProcessing, psfModel
+import numpy as np
+import tifffile as tf
+
+tiffMeta.debug = False
+stackProcessing.debug = False
+
+
+def test_read(image_RGB, image_Grey):
+    meta = tiffMeta.read(str(image_RGB))
+    assert (meta.pixelsize, meta.pixelsizeKey, meta.pixelsizeZ, meta.pixelsizeZKey) == (123., 'PhysicalSizeX', 456., 'FocusStepSize')
+    assert meta.shape == (941, 1024, 3) and meta.dtype == np.uint8
+    meta = tiffMeta.read(str(image_Grey))
+    assert (meta.pixelsize, meta.pixelsizeKey, meta.pixelsizeZ, meta.pixelsizeZKey) == (4.56e-006, 'PixelWidth', 0.123, 'PhysicalSizeZ')
+    assert meta.channels == 1
+
+
+def test_readOME(tmpdir):
+    fn = str(tmpdir.join('ome.ome.tif'))
+    tf.imwrite(fn, np.zeros((2,5,8,9), dtype='uint16'), ome=True, metadata={
+        'axes': 'CZYX', 'PhysicalSizeX': 0.25, 'PhysicalSizeY': 0.25, 'PhysicalSizeZ': 0.3})
+    meta = tiffMeta.read(fn)
+    assert (meta.pixelsize, meta.pixelsizeZ, meta.channels, meta.shape) == (0.25, 0.3, 2, (2,5,8,9))
+
+
+def test_cache(tmpdir):
+    fn = str(tmpdir.join('img.tif'))
+    tf.imwrite(fn, np.zeros((3,4,5), dtype='uint8'), metadata={'PixelSize': '1.5'})
+    tiffMeta.clearCache()
+    assert tiffMeta.read(fn).pixelsize == 1.5
+    assert tiffMeta.read(fn).pixelsize == 1.5
+    assert tiffMeta._read.cache_info().hits == 1
+    ## A rewritten file is parsed again
+    tf.imwrite(fn, np.zeros((3,4,5), dtype='uint8'), metadata={'PixelSize': '2.5'})
+    os.utime(fn, ns=(0, os.stat(fn).st_mtime_ns+1000))
+    assert tiffMeta.read(fn).pixelsize == 2.5
+
+
+def test_voxelSizeNm(tmpdir, image_Grey):
+    fn = str(tmpdir.join('ome.ome.tif'))
+    tf.imwrite(fn, np.zeros((5,8,9), dtype='uint16'), ome=True, metadata={
+        'axes': 'ZYX', 'PhysicalSizeX': 0.1, 'PhysicalSizeY': 0.1, 'PhysicalSizeZ': 0.3})
+    assert np.allclose(tiffMeta.voxelSizeNm(fn), (300, 100, 100))
+    ## FEI PixelWidth is in m
+    assert np.allclose(tiffMeta.voxelSizeNm(str(image_Grey)), (123, 4560, 4560))
+    fn = str(tmpdir.join('img.tif'))
+    tf.imwrite(fn, np.zeros((3,4,5), dtype='uint8'))
+    assert tiffMeta.voxelSizeNm(fn) == (None, None, None)
+
+
+def test_voxelSizeNmResliced(tmpdir):
+    ## The reslicer writes PixelSize and FocusStepSize in um
+    fn = str(tmpdir.join('stack.tif'))
+    tf.imwrite(fn, np.random.default_rng(0).integers(0, 255, (6,16,16)).astype('uint8'), metadata={'PixelSize': '0.02'})
+    stackProcessing.main(fn, 300., 50., interpolationmethod='linear', saveorigstack=False)
+    resliced = str(tmpdir.join('stack_resliced.tif'))
+    assert np.allclose(tiffMeta.voxelSizeNm(resliced), (50, 20, 20))
+    assert psfModel.fromStack(resliced, 'gaussian', 1.4, 520.) is psfModel.generate('gaussian', (50., 20., 20.), 1.4, 520.)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parse-once index of the tiff header information 3DCT needs (pixel size, focus step size, dimensions).
+
+The OME-XML, FEI and CorrSight/LA headers are parsed from the first IFD only. Results are cached per file,
+keyed by path, modification time and file size, so repeated lookups (e.g. xy and z pixel size of the
+same file) do not reopen the file.
+
+Usage:
+    from tdct import tiffMeta
+    >>> meta = tiffMeta.read('image_stack.tif')
+    >>> meta.pixelsize, meta.pixelsizeZ, meta.shape, meta.dtype, meta.channels
+
+Pixel sizes are returned in the unit of the header they were found in (see TiffMeta), voxelSizeNm
+converts them to nm.
+"""
+
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+import tifffile as tf
+from . import clrmsg
+from . import TDCT_debug
+
+debug = TDCT_debug.debug
+
+## Header keywords in order of precedence. FEI_HELIOS and PixelWidth are in m, PhysicalSizeX/Z in um (OME),
+## PixelSize and FocusStepSize in um as written by CorrSight/LA and the 3DCT reslicer (stackProcessing).
+keywordsXY = ['FEI_HELIOS', 'PhysicalSizeX', 'PixelWidth', 'PixelSize']
+keywordsZ = ['PhysicalSizeZ', 'FocusStepSize']
+
+_number = r'([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)'
+## e.g. PhysicalSizeX="0.5" (OME-XML), "FocusStepSize": "300" (json description) or PixelWidth=4.56e-006 (FEI)
+_keyvalue = re.compile(r'(PhysicalSizeX|PhysicalSizeZ|PixelSize|FocusStepSize)"?\s*[:=]\s*"?'+_number)
+_pixelwidth = re.compile(r'PixelWidth\s*=\s*'+_number)
+
+## pixelsize(Z)Key is the header keyword the value was taken from (None if not found)
+TiffMeta = namedtuple('TiffMeta', ['pixelsize', 'pixelsizeKey', 'pixelsizeZ', 'pixelsizeZKey', 'shape', 'dtype', 'channels'])
+
+
+def read(img_path):
+    """Return the TiffMeta record of img_path. Parsed once, then served from the cache until the file changes."""
+    img_path = os.path.abspath(img_path)
+    stat = os.stat(img_path)
+    return _read(img_path, stat.st_mtime_ns, stat.st_size)
+
+
+## Factors to nm of the header keywords
+toNm = {'FEI_HELIOS': 1e9, 'PixelWidth': 1e9, 'PhysicalSizeX': 1e3, 'PixelSize': 1e3, 'PhysicalSizeZ': 1e3, 'FocusStepSize': 1e3}
+
+
+def voxelSizeNm(img_path):
+    """Return the voxel size (z, y, x) of img_path in nm, None for sizes not found in the header"""
+    meta = read(img_path)
+    xy = meta.pixelsize*toNm[meta.pixelsizeKey] if meta.pixelsize is not None else None
+    z = meta.pixelsizeZ*toNm[meta.pixelsizeZKey] if meta.pixelsizeZ is not None else None
+    return (z, xy, xy)
+
+
+def clearCache():
+    _read.cache_clear()
+
+
+@lru_cache(maxsize=256)
+def _read(img_path, mtime, size):
+    if debug is True: print(clrmsg.DEBUG, "Parsing tiff header:", img_path)
+    with tf.TiffFile(img_path) as tif:
+        page = tif.pages[0]
+        values = {}
+        for tag in page.tags.values():
+            if tag.name == 'FEI_HELIOS' and isinstance(tag.value, dict):
+                try:
+                    values.setdefault('FEI_HELIOS', float(tag.value['Scan']['PixelWidth']))
+                except (KeyError, TypeError, ValueError):
+                    pass
+            elif isinstance(tag.value, str):
+                for match in _keyvalue.finditer(tag.value):
+                    values.setdefault(match.group(1), float(match.group(2)))
+                for match in _pixelwidth.finditer(tag.value):
+                    values.setdefault('PixelWidth', float(match.group(1)))
+        series = tif.series[0]
+        shape = tuple(series.shape)
+        axes = series.axes
+        channels = shape[axes.index('C')] if 'C' in axes else 1
+        dtype = series.dtype
+    keyXY = next((key for key in keywordsXY if key in values), None)
+    keyZ = next((key for key in keywordsZ if key in values), None)
+    return TiffMeta(values.get(keyXY), keyXY, values.get(keyZ), keyZ, shape, dtype, channels)
@@ -111,14 +111,14 @@ def test_pxSize(tdct_CorrelationInstance_setup, image_RGB, image_Grey):
 	pixelSize = tdct_CorrelationInstance_setup.window.pxSize(str(image_Grey),z=False)
 	assert pixelSize == 4.56e-006*1e006
 	pixelSize = tdct_CorrelationInstance_setup.window.pxSize(str(image_RGB),z=True)
-	assert pixelSize == 456.
+	assert pixelSize == 456.*1000
 	pixelSize = tdct_CorrelationInstance_setup.window.pxSize(str(image_Grey),z=True)
 	assert pixelSize == 123.
 
 
 @pytest.mark.skipif(TDCT_error != "", reason="TDCT_correlation import failed: {0}".format(TDCT_error))
 def test_norm_img(tdct_CorrelationInstance_setup):
-	compArray = TDCT_correlation.np.array([[127, 127, 127],[254, 254, 254]], dtype='uint8')
+	compArray = TDCT_correlation.np.array([[127, 127, 127],[255, 255, 255]], dtype='uint8')
 	retArray = tdct_CorrelationInstance_setup.window.norm_img(TDCT_correlation.np.array([[1,1,1],[2,2,2]],dtype='uint8'))
 	assert TDCT_correlation.np.testing.assert_array_equal(retArray, compArray) is None
 